@@ -0,0 +1,114 @@
+from typing import Dict
+import numpy as np
+import joule.api
+import joule.errors
+
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+
+LINE_CYCLE = 1e6 / 60
+READ_BLOCK_ROWS = 10000  # rows returned by each read of a data pipe
+EXEMPLAR_SPACING = 60 * int(1e6)  # exemplars of a library stream start every minute
+# exemplar segments in us from the start of the exemplar
+ON_SEGMENT = (0, 2 * int(1e6))
+SS_SEGMENT = (2 * int(1e6), 12 * int(1e6))
+OFF_SEGMENT = (12 * int(1e6), 15 * int(1e6))
+
+
+class FakeNode:
+    """In-process stand in for the joule node methods used by the builders.
+
+    Any stream under a library path can be read, its data is synthetic 60Hz
+    power that only depends on the stream and timestamps. Data written to
+    the node is counted and discarded, so a benchmark measures nilm-synth
+    and not the network or the Joule server."""
+
+    def __init__(self, name: str = 'fake'):
+        self.name = name
+        self.bytes_read = 0
+        self.rows_written = 0
+        self.events_written = 0
+        self._streams: Dict[str, joule.api.DataStream] = {}
+
+    async def data_stream_get(self, path: str):
+        if path.endswith('/prep'):
+            return path
+        if path not in self._streams:
+            raise joule.errors.ApiError("stream [%s] does not exist" % path)
+        return self._streams[path]
+
+    async def data_stream_create(self, stream: joule.api.DataStream, folder: str):
+        self._streams[folder + '/' + stream.name] = stream
+        return stream
+
+    async def data_read(self, path: str, start_ts: int, end_ts: int) -> '_ReadPipe':
+        first_row = int(np.ceil(start_ts / LINE_CYCLE))
+        last_row = int(np.ceil(end_ts / LINE_CYCLE))
+        sdata = np.empty(max(last_row - first_row, 0), dtype=[('timestamp', '<i8'), ('data', '<f4', (8,))])
+        rows = np.arange(first_row, last_row)
+        sdata['timestamp'] = np.round(rows * LINE_CYCLE)
+        # a different power level for every stream with a 1 minute ripple
+        level = 100 + sum(path.encode()) % 900
+        power = level * (1 + 0.1 * np.sin(rows * 2 * np.pi / 3600))
+        sdata['data'] = power[:, None] * np.array([1, 0.3, 0.1, 0.03, 0.05, 0.01, 0.02, 0.005])
+        self.bytes_read += sdata.nbytes
+        return _ReadPipe(sdata)
+
+    async def data_write(self, stream: joule.api.DataStream, start_ts: int, end_ts: int) -> '_WritePipe':
+        return _WritePipe(self, f"float32_{len(stream.elements)}")
+
+    async def event_stream_create(self, stream, folder: str):
+        return stream
+
+    async def event_stream_write(self, stream, events):
+        self.events_written += len(events)
+
+    async def folder_get(self, path: str):
+        raise joule.errors.ApiError("folder [%s] does not exist" % path)
+
+    async def close(self):
+        pass
+
+
+def fake_library(num_loads: int, exemplars_per_load: int):
+    # loads and exemplars of a library served by FakeNode
+    loads = []
+    exemplars = []
+    for load_id in range(1, num_loads + 1):
+        loads.append(LibraryLoad(f"/Load Library/Benchmark/load{load_id}", 'benchmark',
+                                 f"load{load_id}", "synthetic benchmark load", "", load_id))
+        for i in range(exemplars_per_load):
+            start = i * EXEMPLAR_SPACING
+            exemplars.append(LibraryExemplar(start + ON_SEGMENT[0], start + ON_SEGMENT[1],
+                                             start + SS_SEGMENT[0], start + SS_SEGMENT[1],
+                                             start + OFF_SEGMENT[0], start + OFF_SEGMENT[1],
+                                             load_id=load_id, id=len(exemplars) + 1))
+    return loads, exemplars
+
+
+class _ReadPipe:
+    def __init__(self, sdata: np.ndarray):
+        self.sdata = sdata
+
+    def is_empty(self):
+        return len(self.sdata) == 0
+
+    async def read(self):
+        return self.sdata[:READ_BLOCK_ROWS]
+
+    def consume(self, num_rows: int):
+        self.sdata = self.sdata[num_rows:]
+
+    async def close(self):
+        pass
+
+
+class _WritePipe:
+    def __init__(self, node: FakeNode, layout: str):
+        self.node = node
+        self.layout = layout
+
+    async def write(self, sdata: np.ndarray):
+        self.node.rows_written += len(sdata)
+
+    async def close(self):
+        pass
@@ -0,0 +1,145 @@
+#!/usr/bin/python3
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+import time
+from typing import Dict, List
+import click
+import h5py
+import numpy as np
+import pandas as pd
+
+from nilm_synth.builders import (
+    initialize_hdf_data, add_runs_hd5_data,
+    build_output_pipe, write_stream_data, build_nilmtk_data,
+    RenderBuffer, NoiseSource, WorkingBuffer)
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.segment_cache import SegmentReader
+from nilm_synth.parsers.parse_loads import parse_loads
+from nilm_synth.seeds import SeedStreams
+from benchmarks.fake_node import FakeNode, fake_library
+
+DURATIONS = {'1h': 60 * 60, '1d': 24 * 60 * 60, '1w': 7 * 24 * 60 * 60}
+NUM_LOADS = [5, 50, 500]
+LIBRARY_LOADS = 20
+EXEMPLARS_PER_LOAD = 10
+START_TS = 1625097600 * int(1e6)  # 1 July 2021 UTC
+NOISE = 3.0
+
+
+async def run_case(duration: str, num_loads: int, seed: int, work_dir: str, backend: str = 'hdf5') -> dict:
+    """Time each stage of building a dataset of [duration] with [num_loads] loads.
+
+    Every load runs 1 time per hour for about 2 minutes on a library served
+    by FakeNode. Stages run in the order of the raw file path of main, the
+    raw data is an HDF5 file or a memmap WorkingBuffer ([backend])."""
+    end_ts = START_TS + DURATIONS[duration] * int(1e6)
+    num_runs = max(1, DURATIONS[duration] // 3600)
+    loads_config = [{'name': f"load{i}", 'load_id': i % LIBRARY_LOADS + 1, 'runs': f"random {num_runs}:2m"}
+                    for i in range(num_loads)]
+    catalog = ExemplarCatalog(*fake_library(LIBRARY_LOADS, EXEMPLARS_PER_LOAD))
+    node = FakeNode()
+    reader = SegmentReader(node)
+    seeds = SeedStreams(seed)
+    seconds: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def stage(name: str):
+        start = time.perf_counter()
+        yield
+        seconds[name] = time.perf_counter() - start
+
+    raw_file = os.path.join(work_dir, 'benchmark.hd5.raw')
+    nilmtk_file = os.path.join(work_dir, 'benchmark.hd5')
+    if backend == 'memmap':
+        f = WorkingBuffer(raw_file + '.d')
+    else:
+        f = h5py.File(raw_file, 'w')
+    with pd.HDFStore(nilmtk_file, 'w') as nilmtk_hdf:
+        with stage('parse_loads'):
+            runs = parse_loads(loads_config, START_TS, end_ts, seeds, catalog)
+        with stage('fetch'):
+            await reader.prefetch(runs.segments())
+        initialize_hdf_data(f, START_TS, end_ts)
+        num_rows = len(f['data'])
+        noise = NoiseSource(seeds, NOISE, num_rows, columns=8)
+        with stage('render'):
+            # the buffers are built as in main.py, with no baseline the noise is added
+            # in the aggregate writes of the first submeter
+            stale_tiles = set()
+            for meter_id in range(2, num_loads + 2):
+                phase = runs.phase(meter_id)
+                buffer = RenderBuffer(f['submeter'], zeroed=True, aggregate=f['data'],
+                                      aggregate_columns=slice(phase * 8, (phase + 1) * 8),
+                                      aggregate_noise=noise if meter_id == 2 else None)
+                await add_runs_hd5_data(runs.for_meter(meter_id), START_TS, end_ts, reader, hdf_group=buffer)
+                buffer.clear_tiles(stale_tiles - buffer.written_tiles)
+                stale_tiles = buffer.written_tiles
+        noise.close()
+        with stage('write_stream_data'):
+            pipe = await build_output_pipe('/benchmark/main', START_TS, end_ts, node)
+            await write_stream_data(f, pipe)
+        with stage('build_nilmtk_data'):
+            build_nilmtk_data(nilmtk_hdf, ['/building1/elec/meter1'], f, 'UTC')
+    f.close()
+    if backend == 'memmap':
+        shutil.rmtree(raw_file + '.d')
+    else:
+        os.remove(raw_file)
+    os.remove(nilmtk_file)
+    # stages that process every row of the dataset
+    row_stages = ['render', 'write_stream_data', 'build_nilmtk_data']
+    return {
+        'duration': duration,
+        'loads': num_loads,
+        'backend': backend,
+        'runs': len(runs),
+        'rows': num_rows,
+        'seconds': seconds,
+        'rows_per_second': {name: num_rows / seconds[name] for name in row_stages if seconds[name] > 0},
+        'bytes_read': node.bytes_read,
+    }
+
+
+@click.command()
+@click.option("-o", "--output", default="benchmarks.json", help="JSON results file")
+@click.option("-d", "--duration", "durations", multiple=True, type=click.Choice(list(DURATIONS)),
+              help="dataset durations to run (default all)")
+@click.option("-l", "--loads", "num_loads", multiple=True, type=int,
+              help="number of loads to run (default 5, 50 and 500)")
+@click.option("-s", "--seed", default=0, help="dataset seed")
+@click.option("-b", "--backend", default="hdf5", type=click.Choice(['hdf5', 'memmap']),
+              help="raw working data backend")
+def main(output, durations: List[str], num_loads: List[int], seed: int, backend: str):
+    durations = durations or list(DURATIONS)
+    num_loads = num_loads or NUM_LOADS
+    cases = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        for duration in durations:
+            for count in num_loads:
+                # progress output of the builders is not part of the benchmark
+                with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                    case = asyncio.run(run_case(duration, count, seed, work_dir, backend))
+                cases.append(case)
+                print(f"{duration} {count} loads: " +
+                      ", ".join(f"{name} {value:.2f}s" for (name, value) in case['seconds'].items()))
+    results = {
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'cases': cases,
+    }
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,12 @@
-from .build_data_stream import build_output_pipe, write_stream_data
+from .build_data_stream import build_output_pipe, write_stream_data, OutputPipe
 from .build_hdf_data import (
     add_runs_hd5_data,
-    initialize_hdf_data, add_baseline_hd5_data, add_noise_hd5_data)
-from .build_nilmtk_data import build_nilmtk_data, build_nilmtk_metadata
+    initialize_hdf_data, add_baseline_hd5_data, hdf_timestamps)
+from .baseline import BaselineStream, align_samples
+from .build_nilmtk_data import build_nilmtk_data, build_nilmtk_metadata, NilmtkWriter, site_meter_ids
+from .build_streaming_data import build_streaming_data
+from .build_sharded_data import build_sharded_data, add_submeter_datasets, submeter_dataset, BaselineSource
+from .render_buffer import RenderBuffer
+from .decimate import decimate_power, PowerDecimator
+from .noise import NoiseSource
+from .working_buffer import WorkingBuffer, zero_rows
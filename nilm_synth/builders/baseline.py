@@ -0,0 +1,201 @@
+import time
+from typing import Optional, Dict
+import joule.api
+import joule.errors
+import numpy as np
+
+from nilm_synth.models.segment_cache import SegmentCache
+from nilm_synth.flow_control import FlowControl
+
+SAMPLE_RATE = 60
+WINDOW_US = 60 * 60 * int(1e6)  # baseline is fetched and cached in 1 hour windows
+TOLERANCE_US = round(1e6 / SAMPLE_RATE / 2)  # a sample within half a line cycle is on the grid
+FILL_POLICIES = ['zero', 'hold', 'interpolate']
+FILL_LIMIT_US = 24 * WINDOW_US  # gaps are only filled from samples at most a day away
+
+
+class BaselineStream:
+    """Reads one phase of a baseline stream onto the 60Hz grid of the dataset,
+    or all three phases if the dataset has [num_phases] = 3.
+
+    The stream is fetched in WINDOW_US windows aligned to UNIX time so the
+    windows can be cached and shared by every dataset over the same house.
+    Each grid row takes the nearest sample by timestamp, rows with no sample
+    within half a line cycle (gaps and interval breaks) are filled with
+    [fill]: zero, hold (the last sample) or interpolate (between the samples
+    on either side). The samples on either side of a gap are searched for
+    outside the windows of a read, up to FILL_LIMIT_US from each row, so every
+    row is filled the same however the reads are split. Reads start at row
+    [start_row] of the grid, so a part of the dataset can be read on its own
+    with the same result."""
+
+    def __init__(self, node: joule.api.BaseNode, stream_config: str, start_ts, end_ts,
+                 flow_control: Optional[FlowControl] = None,
+                 cache: Optional[SegmentCache] = None, fill: str = 'zero',
+                 num_phases: int = 1, start_row: int = 0):
+        (self.path, _, phase) = stream_config.partition(':')
+        if num_phases == 3:
+            # every phase of the baseline goes to the matching phase of the dataset
+            if phase not in ["", 'ABC']:
+                raise ValueError("A 3 phase dataset uses every phase of the baseline stream, do not specify a phase")
+            self.phase = 'ABC'
+            self.columns = np.s_[:, 0:24]
+        else:
+            if phase == "":
+                phase = 'A'
+            if phase not in ['A', 'B', 'C']:
+                raise ValueError("Invalid phase for baseline stream, must be [A|B|C]")
+            self.phase = phase
+            self.columns = np.s_[:, 'ABC'.index(phase) * 8:('ABC'.index(phase) + 1) * 8]
+        self.dtype = np.dtype([('timestamp', '<i8'), ('data', '<f4', (num_phases * 8,))])
+        if fill not in FILL_POLICIES:
+            raise ValueError("Invalid baseline fill policy, must be [%s]" % '|'.join(FILL_POLICIES))
+        self.fill = fill
+        if flow_control is None:
+            flow_control = FlowControl()
+        self.flow_control = flow_control
+        self.cache = cache
+        self.node = node
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        # the next row of the dataset grid to read
+        self._row = start_row
+        self._windows: Dict[int, np.ndarray] = {}
+        # first and last sample of each window searched for the edges of a gap
+        self._edges: Dict[int, np.ndarray] = {}
+
+    async def open(self):
+        # make sure the stream exists before any data is requested
+        try:
+            await self.flow_control.call(self.node.data_stream_get, self.path)
+        except joule.errors.ApiError:
+            raise ValueError("Cannot find baseline stream [%s] on node [%s]" % (self.path, self.node.name))
+
+    async def read(self, num_rows: int) -> np.ndarray:
+        # the next [num_rows] rows of the dataset grid
+        grid_ts = (self.start_ts + np.arange(self._row, self._row + num_rows) * (1e6 / SAMPLE_RATE)).astype('i8')
+        self._row += num_rows
+        if num_rows == 0:
+            return np.zeros((0, self.dtype['data'].shape[0]), dtype='float32')
+        # the windows holding the rows and one window on either side to fill gaps
+        first_window = int(grid_ts[0] // WINDOW_US) - 1
+        last_window = int(grid_ts[-1] // WINDOW_US) + 1
+        for window in [window for window in self._windows if window < first_window]:
+            del self._windows[window]
+        for window in range(first_window, last_window + 1):
+            if window not in self._windows:
+                self._windows[window] = await self._load(window)
+        blocks = [self._windows[window] for window in range(first_window, last_window + 1)]
+        if self.fill != 'zero':
+            blocks = ([await self._sample_before(first_window, grid_ts[0])] + blocks +
+                      [await self._sample_after(last_window, grid_ts[-1])])
+        samples = np.concatenate(blocks)
+        return align_samples(samples['timestamp'], samples['data'], grid_ts, self.fill,
+                             limit=FILL_LIMIT_US)
+
+    async def fill_cache(self, num_rows: int):
+        # load the windows read for the next [num_rows] rows into the cache without keeping
+        # them, readers in other processes with a read only cache then find them there
+        grid_ts = (self.start_ts + np.array([self._row, self._row + num_rows - 1]) * (1e6 / SAMPLE_RATE)).astype('i8')
+        (first_window, last_window) = (int(grid_ts[0] // WINDOW_US) - 1, int(grid_ts[-1] // WINDOW_US) + 1)
+        for window in range(first_window, last_window + 1):
+            await self._load(window)
+        if self.fill != 'zero':
+            await self._sample_before(first_window, grid_ts[0])
+            await self._sample_after(last_window, grid_ts[-1])
+
+    async def close(self):
+        self._windows = {}
+        self._edges = {}
+
+    async def _sample_before(self, window: int, ts: int) -> np.ndarray:
+        # the last sample before [window], searched back to FILL_LIMIT_US before [ts]
+        for window in range(window - 1, int((ts - FILL_LIMIT_US) // WINDOW_US) - 1, -1):
+            edges = await self._window_edges(window)
+            if len(edges) > 0:
+                return edges[-1:]
+        return np.empty(0, dtype=self.dtype)
+
+    async def _sample_after(self, window: int, ts: int) -> np.ndarray:
+        # the first sample after [window], searched up to FILL_LIMIT_US after [ts]
+        for window in range(window + 1, int((ts + FILL_LIMIT_US) // WINDOW_US) + 1):
+            edges = await self._window_edges(window)
+            if len(edges) > 0:
+                return edges[:1]
+        return np.empty(0, dtype=self.dtype)
+
+    async def _window_edges(self, window: int) -> np.ndarray:
+        # only the first and last sample are kept, a long gap is searched again by
+        # every read that ends in it without loading the windows again
+        if window not in self._edges:
+            samples = self._windows.get(window)
+            if samples is None:
+                samples = await self._load(window)
+            self._edges[window] = samples[[0, -1]] if len(samples) > 0 else samples
+        return self._edges[window]
+
+    async def _load(self, window: int) -> np.ndarray:
+        start_ts, end_ts = window * WINDOW_US, (window + 1) * WINDOW_US
+        key = (f"{self.path}:{self.phase}", start_ts, end_ts)
+        if self.cache is not None:
+            samples = self.cache.get(*key)
+            if samples is not None:
+                return samples
+        samples = await self.flow_control.call(self._fetch, start_ts, end_ts)
+        # a window that is still being recorded may get more data, do not cache it
+        if self.cache is not None and end_ts < time.time() * 1e6:
+            self.cache.put(*key, samples)
+        return samples
+
+    async def _fetch(self, start_ts: int, end_ts: int) -> np.ndarray:
+        pipe = await self.node.data_read(self.path, start_ts, end_ts)
+        blocks = [np.empty(0, dtype=self.dtype)]
+        while not pipe.is_empty():
+            sdata = await pipe.read()
+            await self.flow_control.throttle(sdata.nbytes)
+            block = np.empty(len(sdata), dtype=self.dtype)
+            block['timestamp'] = sdata['timestamp']
+            block['data'] = sdata['data'][self.columns]
+            blocks.append(block)
+            pipe.consume(len(sdata))
+        await pipe.close()
+        return np.concatenate(blocks)
+
+
+def align_samples(timestamps: np.ndarray, data: np.ndarray, grid_ts: np.ndarray,
+                  fill: str = 'zero', tolerance: int = TOLERANCE_US,
+                  limit: Optional[int] = None) -> np.ndarray:
+    """Rows of [data] at the [grid_ts] timestamps.
+
+    Each grid row takes the nearest sample if it is within [tolerance],
+    other rows are filled by the [fill] policy from samples at most [limit]
+    away (any distance if omitted). Timestamps must be sorted, of samples
+    with the same timestamp only the last is used."""
+    result = np.zeros((len(grid_ts), data.shape[1]), dtype='float32')
+    if len(timestamps) == 0:
+        return result
+    if np.any(timestamps[1:] == timestamps[:-1]):
+        last = np.append(timestamps[1:] != timestamps[:-1], True)
+        (timestamps, data) = (timestamps[last], data[last])
+    # the first sample at or after each grid timestamp
+    idx = np.searchsorted(timestamps, grid_ts)
+    before = np.clip(idx - 1, 0, len(timestamps) - 1)
+    after = np.clip(idx, 0, len(timestamps) - 1)
+    nearest = np.where(np.abs(timestamps[before] - grid_ts) <= np.abs(timestamps[after] - grid_ts),
+                       before, after)
+    on_grid = np.abs(timestamps[nearest] - grid_ts) <= tolerance
+    result[on_grid] = data[nearest[on_grid]]
+    has_before = ~on_grid & (idx > 0)
+    if limit is not None:
+        has_before &= grid_ts - timestamps[np.maximum(idx - 1, 0)] <= limit
+    if fill == 'hold':
+        result[has_before] = data[idx[has_before] - 1]
+    elif fill == 'interpolate':
+        gap = has_before & (idx < len(timestamps))
+        if limit is not None:
+            gap &= timestamps[np.minimum(idx, len(timestamps) - 1)] - grid_ts <= limit
+        # the samples are unique so t0 < grid_ts <= t1
+        (t0, t1) = (timestamps[idx[gap] - 1], timestamps[idx[gap]])
+        weight = ((grid_ts[gap] - t0) / (t1 - t0))[:, None]
+        result[gap] = data[idx[gap] - 1] + weight * (data[idx[gap]] - data[idx[gap] - 1])
+    return result
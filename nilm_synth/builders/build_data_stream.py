@@ -2,47 +2,110 @@ import numpy as np
 import click
 import joule
 import h5py
-from typing import List
-from joule.api import BaseNode, Element, DataStreamInfo
+from typing import List, Optional
+from joule.api import BaseNode, Element, DataStream, DataStreamInfo
 
 from joule.models.pipes import compute_dtype, Pipe
 from joule.errors import ApiError
+from nilm_synth.flow_control import FlowControl, is_pressure
+from .build_hdf_data import hdf_timestamps
 
 
-async def build_output_pipe(stream_path: str, start_ts, end_ts, node, num_phases=1) -> Pipe:
-    return await get_pipe(stream_path, node, start_ts, end_ts, num_phases)
+INTERVAL_ROWS = 216000  # rows written through one pipe, an hour of 60Hz data
 
 
-async def get_pipe(stream_path: str, node: BaseNode, start_ts: int, end_ts: int, num_phases) -> Pipe:
+async def build_output_pipe(stream_path: str, start_ts, end_ts, node, num_phases=1,
+                            flow_control: Optional[FlowControl] = None) -> 'OutputPipe':
+    if flow_control is None:
+        flow_control = FlowControl()
+    stream = await flow_control.call(get_stream, stream_path, node, num_phases)
+    return OutputPipe(node, stream, start_ts, end_ts, flow_control)
+
+
+async def get_stream(stream_path: str, node: BaseNode, num_phases) -> DataStream:
     try:
-        stream = await node.data_stream_get(stream_path)
-    except ApiError:
-        # create the stream
-        chunks = stream_path.split('/')
-        folder = '/'.join(chunks[:-1])
-        name = chunks[-1]
-        stream = joule.api.DataStream(name,
-                                      datatype='float32',
-                                      elements=_build_elements(num_phases))
-        stream = await node.data_stream_create(stream, folder)
-    return await node.data_write(stream, start_ts, end_ts)
-
-
-async def write_stream_data(hdf: h5py.File, pipe: Pipe, block_size=10000):
+        return await node.data_stream_get(stream_path)
+    except ApiError as e:
+        if is_pressure(e):
+            raise e
+    # create the stream
+    chunks = stream_path.split('/')
+    folder = '/'.join(chunks[:-1])
+    name = chunks[-1]
+    stream = joule.api.DataStream(name,
+                                  datatype='float32',
+                                  elements=_build_elements(num_phases))
+    return await node.data_stream_create(stream, folder)
+
+
+class OutputPipe:
+    """Writes data to [stream] between [start_ts] and [end_ts].
+
+    A write that fails may be partly stored and earlier writes may still be
+    buffered in the pipe, so pipe writes are never retried. Data is written
+    in intervals instead, each through its own pipe: if the node is under
+    pressure the interval is written again through a new pipe, opening it
+    removes anything already stored from the start of the interval."""
+
+    def __init__(self, node: BaseNode, stream: DataStream, start_ts: int, end_ts: int,
+                 flow_control: FlowControl):
+        self.node = node
+        self.stream = stream
+        self.start_ts = start_ts
+        self.end_ts = end_ts
+        self.flow_control = flow_control
+
+    async def write_interval(self, ts: np.ndarray, data: np.ndarray,
+                             flow_control: Optional[FlowControl] = None, block_size=10000):
+        # write the rows, retrying the whole interval with backoff if the node is under pressure
+        if flow_control is None:
+            flow_control = self.flow_control
+        if len(ts) == 0:
+            return
+        await flow_control.call(self._write_interval, ts, data, flow_control, block_size)
+
+    async def close(self):
+        # every interval is closed once it is written
+        pass
+
+    async def _write_interval(self, ts, data, flow_control, block_size):
+        # the node removes any rows stored from the start of the interval
+        pipe = await self.node.data_write(self.stream, int(ts[0]), self.end_ts)
+        try:
+            for idx in range(0, len(ts), block_size):
+                await write_block(pipe, ts[idx:idx + block_size], data[idx:idx + block_size],
+                                  flow_control)
+        except Exception as e:
+            # abandon the pipe, the interval is written again through a new one
+            try:
+                await pipe.close()
+            except Exception:
+                pass
+            raise e
+        await pipe.close()
+
+
+async def write_stream_data(hdf: h5py.File, pipe: OutputPipe, block_size=10000, dataset='data',
+                            flow_control: Optional[FlowControl] = None):
     #print("====Writing Dataset to Joule====")
-    bar_ctx = click.progressbar(length=len(hdf['data']))
+    bar_ctx = click.progressbar(length=len(hdf[dataset]))
     bar = bar_ctx.__enter__()
-    for idx in range(0, len(hdf['data']), block_size):
-        ts = hdf['timestamp'][idx:idx + block_size]
-        data = hdf['data'][idx:idx + block_size]
-        sdata = np.empty(len(ts), dtype=compute_dtype(pipe.layout))
-        sdata['timestamp'] = ts
-        sdata['data'] = data
-        await pipe.write(sdata)
+    for idx in range(0, len(hdf[dataset]), INTERVAL_ROWS):
+        ts = hdf_timestamps(hdf, idx, idx + INTERVAL_ROWS)
+        data = hdf[dataset][idx:idx + INTERVAL_ROWS]
+        await pipe.write_interval(ts, data, flow_control, block_size)
         bar.update(len(data))
     await pipe.close()
     bar_ctx.__exit__(None, None, None)
 
+
+async def write_block(pipe: Pipe, ts: np.ndarray, data: np.ndarray, flow_control: FlowControl):
+    sdata = np.empty(len(ts), dtype=compute_dtype(pipe.layout))
+    sdata['timestamp'] = ts
+    sdata['data'] = data
+    await flow_control.throttle(sdata.nbytes)
+    await pipe.write(sdata)
+
 #async def write_event_data(runs: List[Run], node: BaseNode):
 #    events = [r.to_event for r in runs]
 #    await node.event_stream_write(event_stream, events)
@@ -53,6 +116,12 @@ def _build_elements(num_phases: int) -> List[Element]:
         for i in [1, 3, 5, 7]:
             elements.append(Element(f'P{i}', 'W'))
             elements.append(Element(f'Q{i}', 'W'))
+    elif num_phases == 3:
+        # columns are grouped by phase, the same layout as a 3 phase baseline stream
+        for phase in ['A', 'B', 'C']:
+            for i in [1, 3, 5, 7]:
+                elements.append(Element(f'P{i}{phase}', 'W'))
+                elements.append(Element(f'Q{i}{phase}', 'W'))
     else:
-        raise Exception("Multi-phase not implemented")
+        raise Exception("Number of phases must be 1 or 3")
     return elements
@@ -1,99 +1,126 @@
 import typing
-from typing import List, Callable
+from typing import Optional
 import click
 import joule.api
-import joule.errors
-import pandas as pd
 
-from nilm_synth.models.run import Run
+from nilm_synth.models.run import ts_to_row
+from nilm_synth.models.run_table import RunTable
 import h5py
 import numpy as np
-from nilm_synth.models.library_types import LibraryLoad
-from .build_nilmtk_data import build_nilmtk_data
+from nilm_synth.models.segment_cache import SegmentReader, SegmentCache
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.profiler import Profiler
+from .render_buffer import RenderBuffer, TILE_ROWS
+from .noise import NoiseSource
+from .baseline import BaselineStream
 
 if typing.TYPE_CHECKING:
     pass
 
 
+SAMPLE_RATE = 60  # one sample per line cycle
+BLOCK_SIZE = 10000
+
+
 def initialize_hdf_data(hdf_root, dataset_start_ts,
-                        dataset_end_ts, num_phases=1):
+                        dataset_end_ts, num_phases=1,
+                        materialize_timestamps=False,
+                        chunk_rows: Optional[int] = BLOCK_SIZE,
+                        compression: Optional[str] = None):
     # one sample per line cycle, timestamps are UNIX us
-    num_samples = round((dataset_end_ts - dataset_start_ts) * 60e-6)
-
-    hdf_timestamp = hdf_root.create_dataset('timestamp', (num_samples,), dtype='i8')
-    start_idx = 0
-    start_ts = dataset_start_ts
-    block_size = 60 * 60 * 60  # 1 hour blocks
-    # add the timestamps
-    while True:
-        end_idx = min(num_samples, start_idx + block_size)
-        block_samples = end_idx - start_idx
-        end_ts = start_ts + (block_samples / 60) * 1e6
-        hdf_timestamp[start_idx:end_idx] = np.linspace(start_ts, end_ts, block_samples, endpoint=False)
-        start_idx = end_idx
-        start_ts = end_ts
-        if end_idx == num_samples:
-            break
-    hdf_root.create_dataset('data', shape=(num_samples, num_phases * 8),
-                            dtype='f', fillvalue=0)
+    num_samples = round((dataset_end_ts - dataset_start_ts) * SAMPLE_RATE * 1e-6)
+    # the time axis is computed from these, see hdf_timestamps
+    hdf_root.attrs['start_ts'] = dataset_start_ts
+    hdf_root.attrs['rate'] = SAMPLE_RATE
+    if materialize_timestamps:
+        hdf_timestamp = hdf_root.create_dataset('timestamp', (num_samples,), dtype='i8')
+        block_size = 60 * 60 * 60  # 1 hour blocks
+        for start_idx in range(0, num_samples, block_size):
+            end_idx = min(num_samples, start_idx + block_size)
+            hdf_timestamp[start_idx:end_idx] = compute_timestamps(dataset_start_ts, SAMPLE_RATE,
+                                                                  start_idx, end_idx)
+    # chunks match the export block size, unwritten chunks take no space
+    storage = {}
+    if compression is not None:
+        storage['compression'] = compression
+        storage['shuffle'] = True
+    for (name, num_columns) in [('data', num_phases * 8), ('submeter', 8)]:
+        # the aggregate has every phase, the scratch space for rendering one
+        # submeter at a time holds the phase of its load
+        if chunk_rows is not None:
+            storage['chunks'] = (min(chunk_rows, max(num_samples, 1)), num_columns)
+        hdf_root.create_dataset(name, shape=(num_samples, num_columns),
+                                dtype='f', fillvalue=0, **storage)
 
 
-BLOCK_SIZE = 10000
+def hdf_timestamps(hdf_root, start_idx, end_idx) -> np.ndarray:
+    # timestamps of rows [start_idx, end_idx) of the raw data file
+    if 'timestamp' in hdf_root:
+        return hdf_root['timestamp'][start_idx:end_idx]
+    end_idx = max(start_idx, min(end_idx, len(hdf_root['data'])))
+    return compute_timestamps(hdf_root.attrs['start_ts'], hdf_root.attrs['rate'],
+                              start_idx, end_idx)
 
 
-def add_noise_hd5_data(hdf_root: h5py.File, noise_power):
-    if noise_power == 0:
-        return  # nothing to do
-    for idx in range(0, len(hdf_root['data']), BLOCK_SIZE):
-        block = hdf_root['data'][idx:idx + BLOCK_SIZE, :]
-        noise = np.random.normal(scale=np.sqrt(noise_power), size=block.shape)
-        hdf_root['data'][idx:idx + BLOCK_SIZE, :] += noise
+def compute_timestamps(start_ts, rate, start_idx, end_idx) -> np.ndarray:
+    return (start_ts + np.arange(start_idx, end_idx) * (1e6 / rate)).astype('i8')
 
 
-async def add_baseline_hd5_data(hdf_root: h5py.File, stream_config: str, node: joule.api.BaseNode, start_ts, end_ts):
-    if stream_config is None:
+async def add_baseline_hd5_data(hdf_root: h5py.File, stream_config: Optional[str], node: joule.api.BaseNode,
+                                start_ts, end_ts, flow_control: Optional[FlowControl] = None,
+                                noise: Optional[NoiseSource] = None,
+                                cache: Optional[SegmentCache] = None, fill: str = 'zero',
+                                profiler: Optional[Profiler] = None):
+    # write the baseline and noise (either may be omitted) to the aggregate in one pass
+    if stream_config is None and noise is None:
         return  # nothing to do
-    (path, phase) = stream_config.split(':')
-    if phase == "":
-        phase = 'A'
-    if phase == 'A':
-        indices = np.s_[:, :8]
-    elif phase == 'B':
-        indices = np.s_[:, 8:16]
-    elif phase == 'C':
-        indices = np.s_[:, 16:24]
-    else:
-        raise ValueError("Invalid phase for baseline stream, must be [A|B|C]")
-    try:
-        pipe = await node.data_read(path, start_ts, end_ts)
-    except joule.errors.ApiError:
-        raise ValueError("Cannot find baseline stream [%s] on node [%s]" % (path, node.name))
-    start_idx = 0
+    if profiler is None:
+        profiler = Profiler()
+    baseline = None
+    if stream_config is not None:
+        num_phases = hdf_root['data'].shape[1] // 8
+        baseline = BaselineStream(node, stream_config, start_ts, end_ts, flow_control, cache, fill,
+                                  num_phases)
+        await baseline.open()
     print("====Adding Baseline Data====")
-    bar_ctx = click.progressbar(length=len(hdf_root['data']))
+    num_rows = len(hdf_root['data'])
+    bar_ctx = click.progressbar(length=num_rows)
     bar = bar_ctx.__enter__()
-    while not pipe.is_empty():
-        sdata = await pipe.read()
-        pipe.consume(len(sdata))
-        end_idx = len(sdata) + start_idx
-        hdf_root['data'][start_idx:end_idx] = sdata['data'][indices]
-        start_idx = end_idx
-        bar.update(len(sdata))
+    for start_idx in range(0, num_rows, BLOCK_SIZE):
+        end_idx = min(start_idx + BLOCK_SIZE, num_rows)
+        data = np.zeros((end_idx - start_idx, hdf_root['data'].shape[1]), dtype='float32')
+        if baseline is not None:
+            with profiler.stage('baseline', end_idx - start_idx):
+                data += await baseline.read(end_idx - start_idx)
+        if noise is not None:
+            with profiler.stage('noise', end_idx - start_idx):
+                data += noise.rows(start_idx, end_idx)
+        hdf_root['data'][start_idx:end_idx] = data
+        bar.update(end_idx - start_idx)
     bar_ctx.__exit__(None, None, None)
+    if baseline is not None:
+        await baseline.close()
 
 
-async def add_runs_hd5_data(runs: List[Run],
+async def add_runs_hd5_data(runs: RunTable,
                             dataset_start_ts,
                             dataset_end_ts,
-                            get_load_data: Callable[[int], LibraryLoad],
-                            node: joule.api.BaseNode,
+                            reader: SegmentReader,
                             hdf_group,
                             num_phases=1,
+                            tile_rows=TILE_ROWS,
                             ):
-    sorted_runs = sorted(runs, key=lambda run: run.start_ts, reverse=False)
-    cached_load_data = {}
-    for run in sorted_runs:
-        # if run.load_id not in cached_load_data:
-        #    cached_load_data[run.load_id] = get_load_data(run.load_id)
-        # run.instantiated_load = cached_load_data[run.load_id]
-        await run.execute(node, hdf_group, dataset_start_ts)
+    # fetch the library segments concurrently, rendering then reads them from memory
+    await reader.prefetch(runs.segments())
+    # runs are rendered in memory and each tile is written to the file once
+    if isinstance(hdf_group, RenderBuffer):
+        buffer = hdf_group
+    else:
+        buffer = RenderBuffer(hdf_group, tile_rows)
+    for i in runs.start_order():
+        run = runs.run(i)
+        # later runs start after this one so earlier tiles are complete
+        buffer.flush_before(ts_to_row(run.start_ts, dataset_start_ts))
+        await run.execute(reader, buffer, dataset_start_ts)
+        runs.set_stats(i, run)
+    buffer.flush()
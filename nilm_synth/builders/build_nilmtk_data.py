@@ -3,7 +3,10 @@ import numpy as np
 import h5py
 import yaml
 import click
-from typing import TYPE_CHECKING, Callable
+from typing import TYPE_CHECKING, Callable, List
+
+from .decimate import PowerDecimator
+from .build_hdf_data import hdf_timestamps
 
 if TYPE_CHECKING:
     from nilm_synth.parsers.parse_dataset import Dataset
@@ -12,36 +15,63 @@ if TYPE_CHECKING:
 BLOCK_SIZE = 10000
 
 
-def build_nilmtk_data(nilmtk_hdf: pd.HDFStore, nilmtk_group,
-                      raw_hdf: h5py.File, tz: str):
+def build_nilmtk_data(nilmtk_hdf: pd.HDFStore, nilmtk_groups: List[str],
+                      raw_hdf: h5py.File, tz: str, dataset='data'):
+    # phase i of the dataset is written to nilmtk_groups[i], the raw data is read once
     #print("\texporting NILMTK dataset")
-    labels = [['power'] * 3, ['active', 'reactive', 'apparent']]
-    column_labels = pd.MultiIndex.from_arrays(labels, names=('physical_quantity', 'type'))
-    dataset_length = len(raw_hdf['data'])
+    dataset_length = len(raw_hdf[dataset])
     bar_ctx = click.progressbar(length=dataset_length)
     bar = bar_ctx.__enter__()
-    for idx in range(0, len(raw_hdf['data']), BLOCK_SIZE):
+    writers = [NilmtkWriter(nilmtk_hdf, group, tz, phase) for (phase, group) in enumerate(nilmtk_groups)]
+    for idx in range(0, dataset_length, BLOCK_SIZE):
         end_idx = min(idx + BLOCK_SIZE, dataset_length)
-        active = raw_hdf['data'][idx:end_idx][:, 0]
-        reactive = raw_hdf['data'][idx:end_idx][:, 1]
-        apparent = np.sqrt(active ** 2 + reactive ** 2)
-        df = pd.DataFrame(data=np.hstack((raw_hdf['timestamp'][idx:end_idx][:, None],
-                                          active[:, None], reactive[:, None], apparent[:, None])))
-        df.set_index(0, inplace=True)
-        df.index = pd.to_datetime(df.index.values, unit='us', utc=True)
-        df = df.tz_convert(tz)
-        df.columns = column_labels
-        df = df.resample('1S').mean()
-        # if this sample overlaps with an existing sample ignore it
-        if nilmtk_group in nilmtk_hdf.keys():
-            last_ts = nilmtk_hdf[nilmtk_group].index[-1:]
-            if df.index[0] == last_ts:
-                df = df[1:]
-        nilmtk_hdf.append(nilmtk_group, df)
-        bar.update(BLOCK_SIZE)
+        ts = hdf_timestamps(raw_hdf, idx, end_idx)
+        data = raw_hdf[dataset][idx:end_idx]
+        for writer in writers:
+            writer.write(ts, data)
+        bar.update(end_idx - idx)
+    for writer in writers:
+        writer.close()
     bar_ctx.__exit__(None, None, None)
 
 
+def site_meter_ids(num_phases: int, num_loads: int) -> List[int]:
+    # meter1 is phase A, the other phases follow the load submeters (meter2..)
+    return [1] + [num_loads + 1 + phase for phase in range(1, num_phases)]
+
+
+class NilmtkWriter:
+    """Appends 1 second power data to a NILMTK meter table from consecutive blocks
+    of line cycle data, [phase] selects the columns of a 3 phase block."""
+
+    def __init__(self, nilmtk_hdf: pd.HDFStore, nilmtk_group, tz: str, phase: int = 0):
+        labels = [['power'] * 3, ['active', 'reactive', 'apparent']]
+        self.column_labels = pd.MultiIndex.from_arrays(labels, names=('physical_quantity', 'type'))
+        self.nilmtk_hdf = nilmtk_hdf
+        self.nilmtk_group = nilmtk_group
+        self.tz = tz
+        self.phase = phase
+        self._decimator = PowerDecimator()
+
+    def write(self, timestamps: np.ndarray, data: np.ndarray):
+        (p1, q1) = (self.phase * 8, self.phase * 8 + 1)
+        self._append(self._decimator.process(timestamps, data[:, p1], data[:, q1]))
+
+    def close(self):
+        self._append(self._decimator.flush())
+        if self.nilmtk_group in self.nilmtk_hdf:
+            self.nilmtk_hdf.create_table_index(self.nilmtk_group, optlevel=9, kind='full')
+
+    def _append(self, result: np.ndarray):
+        if len(result) == 0:
+            return
+        df = pd.DataFrame(data=result[:, 1:], columns=self.column_labels,
+                          index=pd.to_datetime(result[:, 0].astype('i8'), unit='us', utc=True))
+        df = df.tz_convert(self.tz)
+        # index the table once it is complete instead of on every append
+        self.nilmtk_hdf.append(self.nilmtk_group, df, index=False)
+
+
 def build_nilmtk_metadata(dataset: 'Dataset', metadata: 'Metadata',
                           load_configs, store: pd.HDFStore,
                           get_appliance_type: Callable[[int], str]):
@@ -80,26 +110,31 @@ def build_nilmtk_metadata(dataset: 'Dataset', metadata: 'Metadata',
     dataset_m['meter_devices'] = meter_devices_m
     store.root._v_attrs.metadata = dataset_m
 
-    site_meter = {
-        'device_model': 'power_meter',
-        'submeter_of': 0,
-        'site_meter': True,
-        'data_location': f'/building1/elec/meter1'
-    }
     building_m = {
         'instance': 1,
-        'elec_meters': {
-            1: site_meter
-        },
+        'elec_meters': {},
         'appliances': [],
     }
-    # add all the submeters
+    # one site meter per phase
+    site_meters = site_meter_ids(dataset.phases, len(load_configs))
+    for (phase, site_meter_id) in enumerate(site_meters):
+        site_meter = {
+            'device_model': 'power_meter',
+            'submeter_of': 0,
+            'site_meter': True,
+            'data_location': f'/building1/elec/meter{site_meter_id}'
+        }
+        if dataset.phases > 1:
+            site_meter['phase'] = phase + 1
+        building_m['elec_meters'][site_meter_id] = site_meter
+    # add all the submeters, each is downstream of the site meter of its phase
     submeter_id = 2
     instance = 1
     for config in load_configs:
+        phase = 'ABC'.index(config.get('phase', 'A'))
         building_m['elec_meters'][submeter_id] = {
             'device_model': 'power_meter',
-            'submeter_of': 1,
+            'submeter_of': site_meters[phase],
             'data_location': f'/building1/elec/meter{submeter_id}'
         }
         building_m['appliances'].append({
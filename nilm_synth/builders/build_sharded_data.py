@@ -0,0 +1,210 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import click
+import numpy as np
+
+from nilm_synth.models.run import Run, ts_to_row
+from nilm_synth.models.run_table import RunTable
+from nilm_synth.models.segment_cache import SegmentReader, SegmentCache, SegmentKey, INDEX_FILE
+from nilm_synth.models.library_bundle import LibraryBundle
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.file_node import get_node
+from nilm_synth.seeds import SeedStreams
+from .baseline import BaselineStream
+from .build_streaming_data import WINDOW_ROWS
+from .noise import NoiseSource
+from .working_buffer import WorkingBuffer
+
+SHARDS_PER_WORKER = 4  # more shards than workers so a slow shard does not hold up the rest
+
+
+@dataclass
+class BaselineSource:
+    # settings a worker needs to read the baseline with its own node, the
+    # cache in [cache_dir] is read only in the workers
+    node: str
+    stream: str
+    fill: str = 'zero'
+    rate: Optional[float] = None
+    cache_dir: Optional[str] = None
+    cache_size: int = 1024 ** 3
+
+
+@dataclass
+class Shard:
+    """Rows [start_row, end_row) of a dataset rendered by a worker process.
+
+    Holds everything the worker needs, nodes and open files cannot be shared
+    with another process: the runs that overlap the rows, the library
+    segments they read and the settings for the baseline and noise."""
+    path: str  # the WorkingBuffer of the dataset
+    start_row: int
+    end_row: int
+    dataset_start_ts: int
+    dataset_end_ts: int
+    num_phases: int
+    runs: RunTable
+    segments: Dict[SegmentKey, np.ndarray]
+    seeds: SeedStreams
+    noise: float
+    baseline: Optional[BaselineSource]
+    window_rows: int = WINDOW_ROWS
+    # library bundle the worker maps instead of receiving [segments]
+    bundle: Optional[str] = None
+
+
+def submeter_dataset(meter_id: int) -> str:
+    return f'meter{meter_id}'
+
+
+def add_submeter_datasets(buffer: WorkingBuffer, meter_ids: List[int]):
+    # every submeter is kept until the export, the files are sparse so idle rows take no space
+    num_rows = len(buffer['data'])
+    for meter_id in meter_ids:
+        buffer.create_dataset(submeter_dataset(meter_id), shape=(num_rows, 8), dtype='f')
+
+
+def plan_shards(num_rows: int, workers: int) -> List[Tuple[int, int]]:
+    num_shards = max(1, min(workers * SHARDS_PER_WORKER, num_rows))
+    bounds = np.linspace(0, num_rows, num_shards + 1).round().astype(int)
+    return [(int(start), int(end)) for (start, end) in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+async def build_sharded_data(buffer: WorkingBuffer,
+                             runs: RunTable,
+                             reader: SegmentReader,
+                             dataset_start_ts,
+                             dataset_end_ts,
+                             seeds: SeedStreams,
+                             noise: float = 0,
+                             baseline: Optional[BaselineSource] = None,
+                             num_phases=1,
+                             workers: int = 1,
+                             window_rows=WINDOW_ROWS,
+                             bundle: Optional[str] = None,
+                             flow_control: Optional[FlowControl] = None):
+    """Render the aggregate ('data') and every submeter of a WorkingBuffer
+    with a pool of worker processes.
+
+    The dataset is split into time shards and each worker renders the runs
+    that overlap its shard, with the baseline and noise of the shard, into
+    its rows of the shared buffer. Runs are laid out in full and rendered
+    with render_window so a run that crosses a shard boundary is identical
+    to a serial build. The run statistics are computed here and set in
+    [runs]. With a library [bundle] each worker maps the bundle file
+    instead of being sent a copy of the segments of its runs. The bytes
+    and retries of the baseline reads in the workers are added to
+    [flow_control]."""
+    await reader.prefetch(runs.segments())
+    # rows [start, end) of every run, the pieces hold views of the prefetched segments
+    start_rows = np.zeros(len(runs), dtype=int)
+    end_rows = np.zeros(len(runs), dtype=int)
+    for i in range(len(runs)):
+        run = runs.run(i)
+        pieces = await run.layout(reader, dataset_start_ts)
+        run.compute_stats(pieces)
+        runs.set_stats(i, run)
+        (start_rows[i], end_rows[i]) = (pieces[0].offset, pieces[-1].end)
+    shards = []
+    for (start_row, end_row) in plan_shards(len(buffer['data']), workers):
+        shard_runs = runs.take(np.flatnonzero((start_rows < end_row) & (end_rows > start_row)))
+        segments = {}
+        if bundle is None:
+            segments = reader.held(shard_runs.segments())
+        shards.append(Shard(buffer.path, start_row, end_row, dataset_start_ts, dataset_end_ts,
+                            num_phases, shard_runs, segments, seeds, noise, baseline, window_rows,
+                            bundle))
+    # spawn starts clean processes, the event loop and open files of this one are not copied
+    loop = asyncio.get_running_loop()
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [loop.run_in_executor(executor, render_shard, shard) for shard in shards]
+        with click.progressbar(length=len(buffer['data'])) as bar:
+            for (shard, future) in zip(shards, futures):
+                (total_bytes, retries) = await future
+                if flow_control is not None:
+                    flow_control.total_bytes += total_bytes
+                    flow_control.retries += retries
+                bar.update(shard.end_row - shard.start_row)
+
+
+def render_shard(shard: Shard) -> Tuple[int, int]:
+    # entry point of a worker process, returns the bytes and retries of the baseline reads
+    return asyncio.run(_render_shard(shard))
+
+
+async def _render_shard(shard: Shard) -> Tuple[int, int]:
+    buffer = WorkingBuffer(shard.path, mode='r+')
+    runs = shard.runs
+    reader = SegmentReader(None)
+    reader.hold(shard.segments)
+    library_bundle = None
+    if shard.bundle is not None:
+        library_bundle = LibraryBundle(shard.bundle)
+        reader.hold(library_bundle.segments())
+    noise = None
+    if shard.noise != 0:
+        noise = NoiseSource(shard.seeds, shard.noise, len(buffer['data']),
+                            columns=shard.num_phases * 8, workers=1)
+    node = None
+    cache = None
+    baseline = None
+    flow_control = FlowControl()
+    if shard.baseline is not None:
+        flow_control = FlowControl(shard.baseline.rate)
+        node = get_node(shard.baseline.node)
+        # the parent fills the cache, workers only read it so they never write or
+        # evict files that another worker is reading
+        if shard.baseline.cache_dir is not None:
+            cache_dir = os.path.expanduser(shard.baseline.cache_dir)
+            if os.path.isfile(os.path.join(cache_dir, INDEX_FILE)):
+                cache = SegmentCache(cache_dir, shard.baseline.cache_size, read_only=True)
+        baseline = BaselineStream(node, shard.baseline.stream, shard.dataset_start_ts, shard.dataset_end_ts,
+                                  flow_control, cache, shard.baseline.fill,
+                                  shard.num_phases, start_row=shard.start_row)
+        await baseline.open()
+    order = runs.start_order()
+    next_run = 0
+    active_runs = []  # (run, pieces) of runs that overlap the current window
+    for window_start in range(shard.start_row, shard.end_row, shard.window_rows):
+        window_end = min(window_start + shard.window_rows, shard.end_row)
+        num_window_rows = window_end - window_start
+        while (next_run < len(order) and
+               ts_to_row(runs.start_ts[order[next_run]], shard.dataset_start_ts) < window_end):
+            run = runs.run(order[next_run])
+            active_runs.append((run, await run.layout(reader, shard.dataset_start_ts)))
+            next_run += 1
+        # the additions are made in the order of the raw file build (baseline, noise,
+        # then each submeter) so the aggregate is the same to the bit
+        aggregate = np.zeros((num_window_rows, shard.num_phases * 8), dtype='float32')
+        if baseline is not None:
+            aggregate += await baseline.read(num_window_rows)
+        if noise is not None:
+            aggregate += noise.rows(window_start, window_end)
+        submeters: Dict[int, np.ndarray] = {}
+        for (run, pieces) in active_runs:
+            if run.meter_id not in submeters:
+                submeters[run.meter_id] = np.zeros((num_window_rows, 8), dtype='float32')
+            Run.render_window(pieces, submeters[run.meter_id], window_start)
+        # drop runs that end in this window
+        active_runs = [(run, pieces) for (run, pieces) in active_runs
+                       if pieces[-1].end > window_end]
+        for meter_id in sorted(submeters):
+            phase = runs.phase(meter_id)
+            aggregate[:, phase * 8:(phase + 1) * 8] += submeters[meter_id]
+            buffer[submeter_dataset(meter_id)][window_start:window_end] = submeters[meter_id]
+        buffer['data'][window_start:window_end] = aggregate
+    buffer.close()
+    if library_bundle is not None:
+        library_bundle.close()
+    if noise is not None:
+        noise.close()
+    if baseline is not None:
+        await baseline.close()
+        await node.close()
+    if cache is not None:
+        cache.close()
+    return flow_control.total_bytes, flow_control.retries
@@ -0,0 +1,103 @@
+from typing import Dict, Optional
+import click
+import numpy as np
+
+from nilm_synth.models.run import Run, ts_to_row
+from nilm_synth.models.run_table import RunTable
+from nilm_synth.models.segment_cache import SegmentReader
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.profiler import Profiler
+from .build_hdf_data import SAMPLE_RATE, compute_timestamps
+from .baseline import BaselineStream
+from .build_data_stream import OutputPipe
+from .build_nilmtk_data import NilmtkWriter
+from .noise import NoiseSource
+
+WINDOW_ROWS = 60 * 60 * 10  # 10 minutes of line cycles
+AGGREGATE_METER = 1
+
+
+async def build_streaming_data(runs: RunTable,
+                               dataset_start_ts,
+                               dataset_end_ts,
+                               reader: SegmentReader,
+                               pipes: Dict[int, OutputPipe],
+                               nilmtk_writers: Dict[int, NilmtkWriter],
+                               baseline: Optional[BaselineStream] = None,
+                               noise: Optional[NoiseSource] = None,
+                               num_phases=1,
+                               window_rows=WINDOW_ROWS,
+                               flow_control: Optional[FlowControl] = None,
+                               profiler: Optional[Profiler] = None):
+    """Generate the dataset in fixed windows of time without a raw file.
+
+    Runs are swept in start order, only the runs active in the current window
+    are built and held in memory. Each finished window of aggregate (meter 1) and
+    submeter data is written to the Joule pipes and NILMTK tables of the
+    meters, both keyed by meter id. Each window is written to Joule as one
+    interval so a window that fails is written again. Submeters have the columns of one phase
+    and are added to the phase of their load in the aggregate, the NILMTK
+    writers that are not submeters (the site meter of each phase) are given
+    the aggregate."""
+    if flow_control is None:
+        flow_control = FlowControl()
+    if profiler is None:
+        profiler = Profiler()
+    num_rows = round((dataset_end_ts - dataset_start_ts) * SAMPLE_RATE * 1e-6)
+    submeter_ids = sorted(set(pipes) - {AGGREGATE_METER})
+    submeter_idx = {meter_id: idx for (idx, meter_id) in enumerate(submeter_ids)}
+    order = runs.start_order()
+    next_run = 0
+    active_runs = []  # (run, pieces) of runs that overlap the current window
+    bar_ctx = click.progressbar(length=num_rows)
+    bar = bar_ctx.__enter__()
+    for window_start in range(0, num_rows, window_rows):
+        window_end = min(window_start + window_rows, num_rows)
+        num_window_rows = window_end - window_start
+        with profiler.stage('render', num_window_rows):
+            # add runs that start in this window
+            while (next_run < len(order) and
+                   ts_to_row(runs.start_ts[order[next_run]], dataset_start_ts) < window_end):
+                run = runs.run(order[next_run])
+                pieces = await run.layout(reader, dataset_start_ts)
+                run.compute_stats(pieces)
+                runs.set_stats(order[next_run], run)
+                active_runs.append((run, pieces))
+                next_run += 1
+            submeters = np.zeros((len(submeter_ids), num_window_rows, 8),
+                                 dtype='float32')
+            for (run, pieces) in active_runs:
+                Run.render_window(pieces, submeters[submeter_idx[run.meter_id]], window_start)
+            # drop runs that end in this window
+            active_runs = [(run, pieces) for (run, pieces) in active_runs
+                           if pieces[-1].end > window_end]
+            aggregate = np.zeros((num_window_rows, num_phases * 8), dtype='float32')
+            for (meter_id, data) in zip(submeter_ids, submeters):
+                phase = runs.phase(meter_id)
+                aggregate[:, phase * 8:(phase + 1) * 8] += data
+        if baseline is not None:
+            with profiler.stage('baseline', num_window_rows):
+                aggregate += await baseline.read(num_window_rows)
+        if noise is not None:
+            with profiler.stage('noise', num_window_rows):
+                aggregate += noise.rows(window_start, window_end)
+        # send the window to the sinks
+        ts = compute_timestamps(dataset_start_ts, SAMPLE_RATE, window_start, window_end)
+        meters = [(AGGREGATE_METER, aggregate)] + list(zip(submeter_ids, submeters))
+        with profiler.stage('joule_upload', num_window_rows * len(meters)):
+            for (meter_id, data) in meters:
+                await pipes[meter_id].write_interval(ts, data, flow_control)
+        with profiler.stage('nilmtk_export', num_window_rows * len(nilmtk_writers)):
+            for (meter_id, writer) in nilmtk_writers.items():
+                if meter_id in submeter_idx:
+                    writer.write(ts, submeters[submeter_idx[meter_id]])
+                else:
+                    writer.write(ts, aggregate)
+        bar.update(window_end - window_start)
+    with profiler.stage('joule_upload'):
+        for meter_id in pipes:
+            await pipes[meter_id].close()
+    with profiler.stage('nilmtk_export'):
+        for writer in nilmtk_writers.values():
+            writer.close()
+    bar_ctx.__exit__(None, None, None)
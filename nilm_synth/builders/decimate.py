@@ -0,0 +1,53 @@
+import numpy as np
+
+SAMPLE_RATE = 60  # samples per second (one per line cycle)
+
+
+def decimate_power(timestamps: np.ndarray, active: np.ndarray, reactive: np.ndarray) -> np.ndarray:
+    """Average line cycle power samples into 1 second bins.
+
+    Samples are binned by their UNIX second, the result has one row per
+    non-empty bin: [timestamp (us), active, reactive, apparent]. Apparent
+    power is computed per sample before averaging."""
+    if len(timestamps) == 0:
+        return np.empty((0, 4))
+    values = np.column_stack((active, reactive, np.sqrt(active ** 2 + reactive ** 2))).astype('f8')
+    seconds = np.asarray(timestamps, dtype='i8') // 1_000_000
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(seconds)) + 1))
+    counts = np.diff(np.append(starts, len(seconds)))
+    if np.all(counts == SAMPLE_RATE):
+        # regular grid: every second is a full row of samples
+        means = values.reshape(-1, SAMPLE_RATE, 3).mean(axis=1)
+    else:
+        # ragged bins from gaps or partial seconds
+        means = np.add.reduceat(values, starts, axis=0) / counts[:, None]
+    return np.column_stack((seconds[starts] * 1e6, means))
+
+
+class PowerDecimator:
+    """Streaming version of decimate_power for data read in blocks.
+
+    The samples of the last second in a block are held until the next
+    block (or flush) so seconds that cross a block edge are not split."""
+
+    def __init__(self):
+        self._timestamps = np.empty(0, dtype='i8')
+        self._values = np.empty((0, 2))
+
+    def process(self, timestamps: np.ndarray, active: np.ndarray, reactive: np.ndarray) -> np.ndarray:
+        timestamps = np.concatenate((self._timestamps, np.asarray(timestamps, dtype='i8')))
+        values = np.concatenate((self._values, np.column_stack((active, reactive))))
+        if len(timestamps) == 0:
+            return np.empty((0, 4))
+        seconds = timestamps // 1_000_000
+        split = np.searchsorted(seconds, seconds[-1])
+        self._timestamps = timestamps[split:]
+        self._values = values[split:]
+        return decimate_power(timestamps[:split], values[:split, 0], values[:split, 1])
+
+    def flush(self) -> np.ndarray:
+        # decimate any held samples, call at the end of the data or of an interval
+        result = decimate_power(self._timestamps, self._values[:, 0], self._values[:, 1])
+        self._timestamps = np.empty(0, dtype='i8')
+        self._values = np.empty((0, 2))
+        return result
@@ -0,0 +1,56 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict
+import numpy as np
+
+from nilm_synth.seeds import SeedStreams, NOISE_BLOCK_ROWS
+
+NOISE_WORKERS = 4
+
+
+class NoiseSource:
+    """White noise for the rows of a dataset, added where the rows are written.
+
+    Noise is generated in NOISE_BLOCK_ROWS blocks, block b is always drawn
+    from noise stream b of the seed so it is reproducible however the rows
+    are requested. Blocks are generated on a thread pool, the blocks after
+    the last rows requested are generated ahead while the caller works."""
+
+    def __init__(self, seeds: SeedStreams, noise_power: float, num_rows: int, columns: int,
+                 workers: int = NOISE_WORKERS):
+        self.seeds = seeds
+        self.scale = np.sqrt(noise_power)
+        self.num_rows = num_rows
+        self.columns = columns
+        self.read_ahead = workers
+        self._executor = ThreadPoolExecutor(workers)
+        self._blocks: Dict[int, Future] = {}
+
+    def rows(self, start_row: int, end_row: int) -> np.ndarray:
+        first_block = start_row // NOISE_BLOCK_ROWS
+        last_block = max(end_row - 1, start_row) // NOISE_BLOCK_ROWS
+        # rows are requested in order, earlier blocks are not needed again
+        for block in [block for block in self._blocks if block < first_block]:
+            del self._blocks[block]
+        last_ahead = min(last_block + self.read_ahead, (self.num_rows - 1) // NOISE_BLOCK_ROWS)
+        for block in range(first_block, max(last_block, last_ahead) + 1):
+            if block not in self._blocks:
+                self._blocks[block] = self._executor.submit(self._generate, block)
+        noise = np.empty((end_row - start_row, self.columns))
+        for block in range(first_block, last_block + 1):
+            block_start = block * NOISE_BLOCK_ROWS
+            start = max(start_row, block_start)
+            end = min(end_row, block_start + NOISE_BLOCK_ROWS)
+            if start >= end:
+                continue
+            block_noise = self._blocks[block].result()
+            noise[start - start_row:end - start_row] = block_noise[start - block_start:end - block_start]
+        return noise
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._blocks = {}
+
+    def _generate(self, block: int) -> np.ndarray:
+        # the generator releases the GIL while it fills the block
+        rng = self.seeds.noise_block(block)
+        return rng.normal(scale=self.scale, size=(NOISE_BLOCK_ROWS, self.columns))
@@ -0,0 +1,118 @@
+from typing import Dict, Optional, Set, Iterable
+import numpy as np
+
+from .working_buffer import zero_rows
+from .noise import NoiseSource
+
+TILE_ROWS = 60 * 60 * 60  # 1 hour of line cycles
+
+
+class RenderBuffer:
+    """Accumulates data into an HDF5 (or WorkingBuffer) dataset through in-memory tiles.
+
+    Each tile is read from the dataset the first time it is touched and
+    written back once when it is flushed, so adding many small blocks
+    does not cost an HDF5 read-modify-write per block. With tile_rows=None
+    the entire dataset is held in a single tile.
+
+    When [zeroed] is set tiles start from zero instead of the dataset
+    contents, so the rendered data replaces whatever the tile held. Each
+    flushed tile is also added into the [aggregate] dataset if one is given,
+    at [aggregate_columns] (the phase of a submeter in a 3 phase aggregate).
+
+    With [aggregate_noise] the noise of each tile is added in the same write
+    to the aggregate, the noise of tiles this buffer does not write is added
+    on its own, all of it by the end of flush."""
+
+    def __init__(self, dataset, tile_rows: Optional[int] = TILE_ROWS,
+                 zeroed: bool = False, aggregate=None, aggregate_columns: slice = slice(None),
+                 aggregate_noise: Optional[NoiseSource] = None):
+        self.dataset = dataset
+        self.rows = dataset.shape[0]
+        self.columns = dataset.shape[1]
+        if tile_rows is None:
+            tile_rows = max(self.rows, 1)
+        self.tile_rows = tile_rows
+        self.zeroed = zeroed
+        self.aggregate = aggregate
+        self.aggregate_columns = aggregate_columns
+        self.aggregate_noise = aggregate_noise
+        # tiles before this one have their noise in the aggregate
+        self._noise_tile = 0
+        # tiles written to the dataset by this buffer
+        self.written_tiles: Set[int] = set()
+        self._tiles: Dict[int, np.ndarray] = {}
+
+    def __len__(self):
+        return self.rows
+
+    def add(self, offset: int, data: np.ndarray):
+        # clip the data to the dataset bounds
+        if offset < 0:
+            data = data[-offset:]
+            offset = 0
+        data = data[:max(self.rows - offset, 0)]
+        idx = 0
+        while idx < len(data):
+            tile_id = (offset + idx) // self.tile_rows
+            tile_start = tile_id * self.tile_rows
+            tile = self._tile(tile_id)
+            start = offset + idx - tile_start
+            count = min(len(data) - idx, len(tile) - start)
+            tile[start:start + count] += data[idx:idx + count]
+            idx += count
+
+    def flush_before(self, row: int):
+        # write out tiles that end at or before [row], they will not be touched again
+        for tile_id in sorted(self._tiles):
+            if (tile_id + 1) * self.tile_rows > row:
+                break
+            self._write(tile_id)
+
+    def flush(self):
+        for tile_id in sorted(self._tiles):
+            self._write(tile_id)
+        if self.aggregate_noise is not None:
+            self._add_noise(-(-self.rows // self.tile_rows))
+
+    def clear_tiles(self, tile_ids: Iterable[int]):
+        # zero tiles of the dataset, used to remove data left by a previous render
+        for tile_id in sorted(tile_ids):
+            start = tile_id * self.tile_rows
+            end = min(start + self.tile_rows, self.rows)
+            zero_rows(self.dataset, start, end)
+
+    def _tile(self, tile_id: int) -> np.ndarray:
+        if tile_id not in self._tiles:
+            start = tile_id * self.tile_rows
+            end = min(start + self.tile_rows, self.rows)
+            if self.zeroed:
+                self._tiles[tile_id] = np.zeros((end - start, self.columns), dtype=self.dataset.dtype)
+            else:
+                self._tiles[tile_id] = self.dataset[start:end]
+        return self._tiles[tile_id]
+
+    def _write(self, tile_id: int):
+        tile = self._tiles.pop(tile_id)
+        start = tile_id * self.tile_rows
+        end = start + len(tile)
+        self.dataset[start:end] = tile
+        if self.aggregate is not None and self.aggregate_noise is not None and tile_id >= self._noise_tile:
+            self._add_noise(tile_id)
+            # noise first, the same order of additions as a build with a baseline
+            block = self.aggregate[start:end]
+            block += self.aggregate_noise.rows(start, end)
+            block[:, self.aggregate_columns] += tile
+            self.aggregate[start:end] = block
+            self._noise_tile = tile_id + 1
+        elif self.aggregate is not None:
+            self.aggregate[start:end, self.aggregate_columns] += tile
+        self.written_tiles.add(tile_id)
+
+    def _add_noise(self, end_tile: int):
+        # add the noise of the tiles before [end_tile] that have none, in row order
+        for tile_id in range(self._noise_tile, end_tile):
+            start = tile_id * self.tile_rows
+            end = min(start + self.tile_rows, self.rows)
+            self.aggregate[start:end] += self.aggregate_noise.rows(start, end)
+        self._noise_tile = max(self._noise_tile, end_tile)
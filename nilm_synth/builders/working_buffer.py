@@ -0,0 +1,135 @@
+import ctypes
+import ctypes.util
+import json
+import os
+from typing import Dict, Tuple
+import numpy as np
+
+INDEX_FILE = 'index.json'
+# fallocate flags from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+
+class WorkingBuffer:
+    """Scratch space for building a dataset kept in memory mapped files.
+
+    A stand in for the h5py raw file: each dataset is a sparse file in the
+    [path] directory mapped with np.memmap, so the builders slice and add
+    into plain ndarray views and the OS page cache holds the working set.
+    Only the parts of the h5py File interface used by the builders are
+    provided, attrs are kept in memory. With [mode] r+ the datasets of an
+    existing buffer are mapped, so other processes can write into it."""
+
+    def __init__(self, path: str, mode: str = 'w'):
+        self.path = path
+        self.attrs: Dict[str, object] = {}
+        self._datasets: Dict[str, np.memmap] = {}
+        # shape and dtype of each dataset
+        self._index: Dict[str, Tuple[Tuple[int, ...], str]] = {}
+        if mode == 'w':
+            os.makedirs(path, exist_ok=True)
+        elif mode == 'r+':
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                self._index = {name: (tuple(shape), dtype) for (name, (shape, dtype)) in json.load(f).items()}
+            for (name, (shape, dtype)) in self._index.items():
+                self._datasets[name] = self._map(name, shape, dtype)
+        else:
+            raise ValueError("Working buffer mode must be w|r+")
+
+    def __contains__(self, name: str):
+        return name in self._datasets
+
+    def __getitem__(self, name: str) -> np.memmap:
+        return self._datasets[name]
+
+    def create_dataset(self, name: str, shape: Tuple[int, ...], dtype, fillvalue=0, **storage):
+        # chunks and compression are HDF5 storage settings, they do not apply here
+        if fillvalue != 0:
+            raise ValueError("Working buffer datasets are always zero filled")
+        file_path = os.path.join(self.path, name)
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        # a truncated file is sparse, it reads as zeros and takes no space until written
+        with open(file_path, 'wb') as f:
+            f.truncate(nbytes)
+        self._index[name] = (tuple(shape), np.dtype(dtype).str)
+        with open(os.path.join(self.path, INDEX_FILE), 'w') as f:
+            json.dump(self._index, f)
+        self._datasets[name] = self._map(name, shape, dtype)
+        return self._datasets[name]
+
+    @property
+    def disk_usage(self) -> int:
+        # bytes allocated on disk, holes are not counted
+        return sum(os.stat(os.path.join(self.path, name)).st_blocks * 512 for name in self._datasets)
+
+    def flush(self):
+        for dataset in self._datasets.values():
+            if isinstance(dataset, np.memmap):
+                dataset.flush()
+
+    def close(self):
+        self.flush()
+        self._datasets = {}
+
+    def _map(self, name: str, shape: Tuple[int, ...], dtype) -> np.ndarray:
+        if int(np.prod(shape)) == 0:
+            return np.zeros(shape, dtype=dtype)  # an empty file cannot be mapped
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode='r+', shape=shape)
+
+
+def zero_rows(dataset, start: int, end: int):
+    """Set rows [start, end) of [dataset] to zero.
+
+    For a WorkingBuffer dataset the pages inside the rows are released by
+    punching a hole in the file, only the partial pages at either end are
+    written. Other datasets are written with a block of zeros (h5py
+    broadcasts a scalar one row at a time)."""
+    if end <= start:
+        return
+    if _is_file_mapping(dataset) and _punch_hole(dataset, start, end):
+        return
+    dataset[start:end] = np.zeros((end - start,) + dataset.shape[1:], dtype=dataset.dtype)
+
+
+def _is_file_mapping(dataset) -> bool:
+    # a memmap of a whole file (not a view of one), as created by WorkingBuffer
+    return (isinstance(dataset, np.memmap) and dataset.filename is not None and dataset.offset == 0
+            and dataset.nbytes == os.path.getsize(dataset.filename))
+
+
+def _punch_hole(dataset: np.memmap, start: int, end: int) -> bool:
+    # returns False if the system or file system cannot punch holes
+    fallocate = _fallocate()
+    if fallocate is None:
+        return False
+    row_bytes = dataset.itemsize * int(np.prod(dataset.shape[1:]))
+    page = os.sysconf('SC_PAGE_SIZE')
+    # whole pages inside the rows
+    hole_start = -(-start * row_bytes // page) * page
+    hole_end = end * row_bytes // page * page
+    if hole_end <= hole_start:
+        return False
+    fd = os.open(dataset.filename, os.O_RDWR)
+    try:
+        result = fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                           ctypes.c_longlong(hole_start), ctypes.c_longlong(hole_end - hole_start))
+    finally:
+        os.close(fd)
+    if result != 0:
+        return False
+    # rows that start before or end after the hole
+    dataset[start:min(end, -(-hole_start // row_bytes))] = 0
+    dataset[max(start, hole_end // row_bytes):end] = 0
+    return True
+
+
+_libc_fallocate = None
+
+
+def _fallocate():
+    global _libc_fallocate
+    if _libc_fallocate is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _libc_fallocate = getattr(libc, 'fallocate', False)
+    return _libc_fallocate or None
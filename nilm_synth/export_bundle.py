@@ -0,0 +1,47 @@
+import asyncio
+import os
+import click
+from sqlalchemy import create_engine
+
+from nilm_synth.file_node import get_node
+from nilm_synth.models.catalog import read_library
+from nilm_synth.models.library_bundle import export_bundle
+from nilm_synth.models.library_types import metadata
+from nilm_synth.models.segment_cache import SegmentReader
+
+VERSION = 0.6
+
+
+async def main(library_database, library_node, output, force):
+    print(f"NILM-Synth Library Bundle Export v{VERSION}")
+    if not os.path.isfile(library_database):
+        raise click.ClickException("Library database [%s] does not exist" % library_database)
+    if os.path.isfile(output) and not force:
+        click.confirm("Bundle [%s] exists, overwrite?" % output, abort=True)
+    engine = create_engine('sqlite:///%s' % library_database)
+    metadata.create_all(engine)
+    conn = engine.connect()
+    (loads, exemplars) = read_library(conn)
+    conn.close()
+    print(f"exporting {len(loads)} loads and {len(exemplars)} exemplars")
+    node = get_node(library_node)
+    try:
+        num_segments = await export_bundle(output, loads, exemplars, SegmentReader(node))
+    finally:
+        await node.close()
+    print(f"\n{num_segments} segments written to {output} "
+          f"({os.path.getsize(output) / 1024 ** 2:.1f} MB)")
+
+
+@click.command()
+@click.option("-d", "--database", "library_database", help="library SQLite database", required=True)
+@click.option("-n", "--node", "library_node", default="",
+              help="library node name or file:///path (default node if omitted)")
+@click.option("-o", "--output", help="bundle file to write", required=True)
+@click.option("-y", "--yes", "force", help="overwrite an existing bundle without prompting", is_flag=True)
+def run_main(library_database, library_node, output, force):
+    asyncio.run(main(library_database, library_node, output, force))
+
+
+if __name__ == "__main__":
+    run_main()
@@ -5,7 +5,7 @@ from sqlalchemy import select
 import sqlalchemy
 import yaml
 import joule.api
-from typing import List, Optional
+from typing import Dict, List, Optional
 import numpy as np
 from dataclasses import asdict
 
@@ -15,6 +15,8 @@ import joule.errors
 
 from nilm_synth.parsers.parse_exemplars_config import parse_exemplar_extraction_config
 from nilm_synth.models.stream_chunk import StreamChunk
+from nilm_synth.profiler import Profiler
+from nilm_synth.flow_control import FlowControl
 from nilm_synth.models.library_types import (
     LibraryLoad, LibraryExemplar, library_load_table,
     library_exemplar_table, metadata)
@@ -28,8 +30,9 @@ from nilmidentify.models.transients.composite_transient import composite_transie
 
 VERSION = 0.6
 
-async def main(config_file):
+async def main(config_file, profile=False):
     print(f"NILM-Synth Organic Exemplar Extractor v{VERSION}")
+    profiler = Profiler()
 
     # Given a dataset and nilm_identify_load name find all isolated examples and
     # extract them into the specified nilm_identify_load library stream
@@ -44,6 +47,8 @@ async def main(config_file):
     engine = create_engine('sqlite:///%s' % extraction_config.library_database)
     metadata.create_all(engine)
     library_db = engine.connect()
+    # paces the node requests and backs off if a node is under pressure
+    flow_controls = {'source_node': FlowControl(), 'library_node': FlowControl()}
     conn_info = await source_node.db_connection_info()
     conn_info.port = extraction_config.source_node_database_port
     engine = sqlalchemy.create_engine(conn_info.to_dsn())
@@ -56,22 +61,28 @@ async def main(config_file):
             if load is None:
                 raise click.ClickException(f"Load {library_load.name} is not in {extraction_config.dataset}")
             library_load.nilm_identify_load = load
-            await asyncio.sleep(0.1)
-            stream_chunks = _find_isolated_runs(load, connection)
+            with profiler.stage('find_runs'):
+                stream_chunks = _find_isolated_runs(load, connection)
             print("")  # add a newline
             print(f"{len(stream_chunks)}/{len(load.events)} events isolated")
             source_stream = await source_node.data_stream_get(dataset.stream)
             print("Writing exemplars to library")
             exemplars = await _extract_exemplars(stream_chunks, library_load.stream, library_node, source_node,
-                                                 source_stream)
+                                                 source_stream, profiler, flow_controls)
             # save information into the library database
-            _save_load_to_library(library_db, library_load)
-            _save_exemplars_to_library(library_db, library_load.id, exemplars)
+            with profiler.stage('library_database', len(exemplars)):
+                _save_load_to_library(library_db, library_load)
+                _save_exemplars_to_library(library_db, library_load.id, exemplars)
             print("")  # add newline between loads
     # clean up the resources
     library_db.close()
     await source_node.close()
     await library_node.close()
+    if profile:
+        for (node, flow_control) in flow_controls.items():
+            profiler.count(f"{node}_retries", flow_control.retries)
+        profiler.write(extraction_config.library_database + '.profile.json')
+        print(f"profile: {extraction_config.library_database + '.profile.json'}")
 
 
 def _find_isolated_runs(load: Load, connection, tolerance=100):
@@ -159,24 +170,35 @@ def _get_single_phase_transient_ids(transient_id: int,
 
 
 async def _extract_exemplars(stream_chunks: List[StreamChunk], library_path: str, library_node: BaseNode,
-                             source_node: BaseNode, source_stream: DataStream) -> List[LibraryExemplar]:
+                             source_node: BaseNode, source_stream: DataStream,
+                             profiler: Optional[Profiler] = None,
+                             flow_controls: Optional[Dict[str, FlowControl]] = None) -> List[LibraryExemplar]:
+    if profiler is None:
+        profiler = Profiler()
+    if flow_controls is None:
+        flow_controls = {'source_node': FlowControl(), 'library_node': FlowControl()}
     info: DataStreamInfo = await _retrieve_library_stream_info(library_node, library_path, source_stream)
     if info.end is None:
         last_ts = 0
     else:
         last_ts = info.end + 60 * 1e6
-    library_pipe = await library_node.data_write(library_path + '/prep')
+    library_pipe = await flow_controls['library_node'].call(library_node.data_write, library_path + '/prep')
     exemplars: List[LibraryExemplar] = []
     data = None  # appease type checker
     with click.progressbar(stream_chunks) as bar:
         for chunk in bar:
             exemplar = LibraryExemplar(on_start=last_ts)
-            pipe = await source_node.data_read(source_stream, chunk.start_ts, chunk.end_ts)
+            pipe = await flow_controls['source_node'].call(source_node.data_read, source_stream,
+                                                           chunk.start_ts, chunk.end_ts)
             time_offset = None
             data_offset = None
             while not pipe.is_empty():
-                data = await pipe.read(flatten=True)
-                pipe.consume(len(data))
+                with profiler.stage('source_read') as stats:
+                    data = await pipe.read(flatten=True)
+                    await flow_controls['source_node'].throttle(data.nbytes)
+                    pipe.consume(len(data))
+                    stats.rows += len(data)
+                profiler.count('source_node_bytes', data.nbytes)
                 if time_offset is None:
                     time_offset = data[0, 0] - last_ts
                 if data_offset is None:
@@ -193,7 +215,9 @@ async def _extract_exemplars(stream_chunks: List[StreamChunk], library_path: str
                 else:
                     assert False, f"unknown phase {chunk.phase}"
 
-                await library_pipe.write(data[:, idx])
+                with profiler.stage('library_write', len(data)):
+                    await flow_controls['library_node'].throttle(data[:, idx].nbytes)
+                    await library_pipe.write(data[:, idx])
                 last_ts = data[-1, 0]
             await library_pipe.close_interval()
             exemplar.off_end = last_ts
@@ -252,5 +276,7 @@ def _save_exemplars_to_library(conn: sqlalchemy.engine.Connection,
 
 @click.command()
 @click.option("-c", "--config", help="YAML configuration file", required=True)
-def run_main(config):
-    asyncio.run(main(config))
+@click.option("--profile", help="write the time spent in each stage to [library_database].profile.json",
+              is_flag=True)
+def run_main(config, profile):
+    asyncio.run(main(config, profile))
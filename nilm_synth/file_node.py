@@ -0,0 +1,287 @@
+import json
+import os
+import shutil
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+import h5py
+import numpy as np
+import joule.api
+import joule.errors
+from joule.models.pipes import compute_dtype
+
+FILE_SCHEME = 'file://'
+CHUNK_ROWS = 10000  # HDF5 chunk size of the stream files
+READ_BLOCK_ROWS = 10000  # rows returned by each read of a data pipe
+
+
+def get_node(name: str):
+    # a file:// url is a local directory, anything else is a Joule node name
+    if name.startswith(FILE_SCHEME):
+        return FileNode(name[len(FILE_SCHEME):])
+    return joule.api.get_node(name)
+
+
+@dataclass
+class FileStream:
+    path: str
+    layout: str
+    elements: List[str]
+
+
+class FileNode:
+    """A Joule node stored in a local directory, used in place of a server.
+
+    Each data stream is an HDF5 file at the stream path under [root] (the
+    stream /a/b/c is root/a/b/c.h5) holding a timestamp and a data dataset
+    with rows sorted by timestamp. Event streams are JSON lines files next
+    to the data streams. Only the node methods used by nilm-synth are
+    provided, with the same arguments as a Joule node. Interval breaks are
+    kept as the timestamps of the last row of each interval, written when a
+    pipe closes an interval, and reported by the pipes that read across them."""
+
+    def __init__(self, root: str):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.name = FILE_SCHEME + self.root
+        self._files: Dict[str, h5py.File] = {}
+        # timestamps of each open stream, read once to locate intervals
+        self._timestamps: Dict[str, np.ndarray] = {}
+
+    async def data_stream_get(self, stream: Union[str, FileStream]) -> FileStream:
+        path = _stream_path(stream)
+        f = self._open(path)
+        return FileStream(path, f.attrs['layout'], json.loads(f.attrs['elements']))
+
+    async def data_stream_create(self, stream: joule.api.DataStream, folder: str) -> FileStream:
+        path = folder.rstrip('/') + '/' + stream.name
+        file_path = self._file_path(path)
+        if os.path.isfile(file_path):
+            raise joule.errors.ApiError("Stream [%s] already exists" % path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        layout = f"{stream.datatype.lower()}_{len(stream.elements)}"
+        with h5py.File(file_path, 'w') as f:
+            f.attrs['layout'] = layout
+            f.attrs['elements'] = json.dumps([element.name for element in stream.elements])
+            f.create_dataset('timestamp', shape=(0,), maxshape=(None,), dtype='i8', chunks=(CHUNK_ROWS,))
+            f.create_dataset('breaks', shape=(0,), maxshape=(None,), dtype='i8', chunks=(CHUNK_ROWS,))
+            f.create_dataset('data', shape=(0, len(stream.elements)), maxshape=(None, len(stream.elements)),
+                             dtype=compute_dtype(layout)['data'].base, chunks=(CHUNK_ROWS, len(stream.elements)))
+        return await self.data_stream_get(path)
+
+    async def data_read(self, stream: Union[str, FileStream], start_ts: Optional[int] = None,
+                        end_ts: Optional[int] = None) -> '_ReadPipe':
+        # rows in [start_ts, end_ts), the whole stream if both are omitted
+        path = _stream_path(stream)
+        f = self._open(path)
+        timestamps = self._stream_timestamps(path)
+        start = 0 if start_ts is None else int(np.searchsorted(timestamps, start_ts))
+        end = len(timestamps) if end_ts is None else int(np.searchsorted(timestamps, end_ts))
+        # the rows that end an interval
+        break_rows = np.searchsorted(timestamps, self._breaks(f))
+        return _ReadPipe(f, compute_dtype(f.attrs['layout']), start, end, break_rows)
+
+    async def data_stream_info(self, stream: Union[str, FileStream]) -> joule.api.DataStreamInfo:
+        path = _stream_path(stream)
+        f = self._open(path)
+        timestamps = self._stream_timestamps(path)
+        if len(timestamps) == 0:
+            return joule.api.DataStreamInfo(start=None, end=None, rows=0, total_time=0, bytes=0)
+        return joule.api.DataStreamInfo(start=int(timestamps[0]), end=int(timestamps[-1]), rows=len(timestamps),
+                                        total_time=int(timestamps[-1] - timestamps[0]),
+                                        bytes=len(timestamps) * compute_dtype(f.attrs['layout']).itemsize)
+
+    async def data_delete(self, stream: Union[str, FileStream], start_time: Optional[int] = None,
+                          end_time: Optional[int] = None):
+        # remove the rows in [start_time, end_time), the whole stream if both are omitted
+        path = _stream_path(stream)
+        f = self._open(path, write=True)
+        timestamps = self._stream_timestamps(path)
+        start = 0 if start_time is None else int(np.searchsorted(timestamps, start_time))
+        end = len(timestamps) if end_time is None else int(np.searchsorted(timestamps, end_time))
+        if start >= end:
+            return
+        # rows after the interval move up
+        num_rows = len(timestamps) - (end - start)
+        if end < len(timestamps):
+            f['timestamp'][start:num_rows] = f['timestamp'][end:]
+            f['data'][start:num_rows] = f['data'][end:]
+        f['timestamp'].resize((num_rows,))
+        f['data'].resize((num_rows, f['data'].shape[1]))
+        # the rows on either side of the removed rows are in different intervals
+        breaks = self._breaks(f)
+        breaks = breaks[(breaks < timestamps[start]) | (breaks > timestamps[end - 1])]
+        if start > 0:
+            breaks = np.union1d(breaks, timestamps[start - 1:start])
+        self._set_breaks(f, breaks)
+        self._timestamps[path] = np.delete(timestamps, np.s_[start:end])
+
+    async def data_write(self, stream: Union[str, FileStream], start_ts: Optional[int] = None,
+                         end_ts: Optional[int] = None) -> '_WritePipe':
+        # like a Joule node, rows already in [start_ts, end_ts) are removed
+        stream = await self.data_stream_get(stream)
+        if start_ts is not None or end_ts is not None:
+            await self.data_delete(stream, start_ts, end_ts)
+        return _WritePipe(self, stream.path, stream.layout)
+
+    async def event_stream_create(self, stream: joule.api.EventStream, folder: str) -> str:
+        path = folder.rstrip('/') + '/' + stream.name
+        os.makedirs(os.path.dirname(self._event_path(path)), exist_ok=True)
+        open(self._event_path(path), 'a').close()
+        return path
+
+    async def event_stream_write(self, stream: str, events: List[joule.api.Event]):
+        with open(self._event_path(stream), 'a') as f:
+            for event in events:
+                f.write(json.dumps({'start_time': int(event.start_time),
+                                    'end_time': int(event.end_time),
+                                    'content': event.content}) + '\n')
+
+    async def folder_get(self, path: str) -> str:
+        if not os.path.isdir(self._folder_path(path)):
+            raise joule.errors.ApiError("Folder [%s] does not exist" % path)
+        return path
+
+    async def folder_delete(self, path: str):
+        folder = self._folder_path(path)
+        for stream in [stream for stream in self._files if self._file_path(stream).startswith(folder + os.sep)]:
+            self._close(stream)
+        shutil.rmtree(folder)
+
+    async def close(self):
+        for path in list(self._files):
+            self._close(path)
+
+    def insert(self, path: str, sdata: np.ndarray):
+        # add rows to the stream in timestamp order, existing rows are not replaced
+        if len(sdata) == 0:
+            return
+        f = self._open(path, write=True)
+        timestamps = self._stream_timestamps(path)
+        (first, last) = (sdata['timestamp'][0], sdata['timestamp'][-1])
+        position = int(np.searchsorted(timestamps, first))
+        if position < len(timestamps) and timestamps[position] <= last:
+            raise joule.errors.ApiError("Stream [%s] already has data between %d and %d" % (path, first, last))
+        num_rows = len(timestamps)
+        f['timestamp'].resize((num_rows + len(sdata),))
+        f['data'].resize((num_rows + len(sdata), f['data'].shape[1]))
+        # rows after the new data move down, data is usually appended so nothing moves
+        if position < num_rows:
+            f['timestamp'][position + len(sdata):] = f['timestamp'][position:num_rows]
+            f['data'][position + len(sdata):] = f['data'][position:num_rows]
+        f['timestamp'][position:position + len(sdata)] = sdata['timestamp']
+        f['data'][position:position + len(sdata)] = sdata['data']
+        self._timestamps[path] = np.insert(timestamps, position, sdata['timestamp'])
+
+    def close_interval(self, path: str, ts: int):
+        # the row at [ts] is the last row of its interval
+        f = self._open(path, write=True)
+        self._set_breaks(f, np.union1d(self._breaks(f), [ts]))
+
+    def _breaks(self, f: h5py.File) -> np.ndarray:
+        # streams created before interval breaks were kept have none
+        if 'breaks' not in f:
+            return np.zeros(0, dtype='i8')
+        return f['breaks'][:]
+
+    def _set_breaks(self, f: h5py.File, breaks: np.ndarray):
+        if 'breaks' not in f:
+            f.create_dataset('breaks', shape=(0,), maxshape=(None,), dtype='i8', chunks=(CHUNK_ROWS,))
+        f['breaks'].resize((len(breaks),))
+        f['breaks'][:] = breaks
+
+    def _open(self, path: str, write: bool = False) -> h5py.File:
+        # streams are opened read only until they are written so several
+        # processes can read the same stream (HDF5 locks files open for writing)
+        if path in self._files and write and self._files[path].mode == 'r':
+            self._files.pop(path).close()
+        if path not in self._files:
+            file_path = self._file_path(path)
+            if not os.path.isfile(file_path):
+                raise joule.errors.ApiError("Stream [%s] does not exist" % path)
+            self._files[path] = h5py.File(file_path, 'a' if write else 'r')
+        return self._files[path]
+
+    def _stream_timestamps(self, path: str) -> np.ndarray:
+        if path not in self._timestamps:
+            self._timestamps[path] = self._open(path)['timestamp'][:]
+        return self._timestamps[path]
+
+    def _close(self, path: str):
+        self._files.pop(path).close()
+        self._timestamps.pop(path, None)
+
+    def _file_path(self, path: str) -> str:
+        return os.path.join(self.root, path.strip('/') + '.h5')
+
+    def _event_path(self, path: str) -> str:
+        return os.path.join(self.root, path.strip('/') + '.events.jsonl')
+
+    def _folder_path(self, path: str) -> str:
+        return os.path.join(self.root, path.strip('/'))
+
+
+def _stream_path(stream: Union[str, FileStream]) -> str:
+    if isinstance(stream, FileStream):
+        return stream.path
+    return stream
+
+
+class _ReadPipe:
+    def __init__(self, f: h5py.File, dtype: np.dtype, start: int, end: int, break_rows: np.ndarray):
+        self.f = f
+        self.dtype = dtype
+        self.start = start
+        self.end = end
+        self.break_rows = break_rows
+        # set if the last read ended at an interval break
+        self.end_of_interval = False
+
+    def is_empty(self):
+        return self.start >= self.end
+
+    async def read(self, flatten: bool = False) -> np.ndarray:
+        end = min(self.start + READ_BLOCK_ROWS, self.end)
+        # a read stops at the end of an interval
+        idx = int(np.searchsorted(self.break_rows, self.start))
+        self.end_of_interval = idx < len(self.break_rows) and self.break_rows[idx] < end
+        if self.end_of_interval:
+            end = int(self.break_rows[idx]) + 1
+        sdata = np.empty(end - self.start, dtype=self.dtype)
+        sdata['timestamp'] = self.f['timestamp'][self.start:end]
+        sdata['data'] = self.f['data'][self.start:end]
+        if flatten:
+            return np.c_[sdata['timestamp'][:, None], sdata['data']]
+        return sdata
+
+    def consume(self, num_rows: int):
+        self.start += num_rows
+
+    async def close(self):
+        pass
+
+
+class _WritePipe:
+    def __init__(self, node: FileNode, path: str, layout: str):
+        self.node = node
+        self.path = path
+        self.layout = layout
+        # timestamp of the last row written in the current interval
+        self._last_ts: Optional[int] = None
+
+    async def write(self, sdata: np.ndarray):
+        if sdata.dtype.names is None:
+            # flattened rows, the timestamp is the first column
+            flat = np.atleast_2d(sdata)
+            sdata = np.empty(len(flat), dtype=compute_dtype(self.layout))
+            sdata['timestamp'] = flat[:, 0]
+            sdata['data'] = flat[:, 1:]
+        self.node.insert(self.path, sdata)
+        if len(sdata) > 0:
+            self._last_ts = int(sdata['timestamp'][-1])
+
+    async def close_interval(self):
+        if self._last_ts is not None:
+            self.node.close_interval(self.path, self._last_ts)
+        self._last_ts = None
+
+    async def close(self):
+        await self.close_interval()
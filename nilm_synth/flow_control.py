@@ -0,0 +1,118 @@
+import asyncio
+import re
+import time
+from typing import Optional
+
+import aiohttp
+import joule.errors
+
+MAX_RETRIES = 5
+BACKOFF = 0.5  # seconds before the first retry, doubles after each failure
+MIN_RATE = 64 * 1024  # never throttle below 64KB/s
+PRESSURE_STATUS = {429, 502, 503, 504}  # too many requests, busy or overloaded gateway
+
+_API_STATUS = re.compile(r'^API Error \[(\d{3})\]|\[(\d{3})\]$')
+
+
+class FlowControl:
+    """Paces data transfers with a node.
+
+    With no [rate] (bytes per second) transfers run at full speed. When a
+    rate is set a token bucket (holding up to one second of data) keeps
+    the transfer below it. If the node signals pressure (a busy HTTP
+    status, timeouts, dropped connections) the request is retried with exponential
+    backoff and the rate is halved, it recovers gradually once requests
+    succeed again."""
+
+    def __init__(self, rate: Optional[float] = None,
+                 max_retries: int = MAX_RETRIES, backoff: float = BACKOFF):
+        self.rate = rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retries = 0
+        self.total_bytes = 0
+        self._limit = rate
+        self._tokens = 0.0
+        self._last_ts = time.monotonic()
+        self._start_ts = self._last_ts
+        self._observed_rate = 0.0
+
+    @property
+    def limit(self) -> Optional[float]:
+        return self._limit
+
+    async def throttle(self, nbytes: int):
+        # call before transferring [nbytes], waits if the transfer is over the limit
+        self.total_bytes += nbytes
+        await self.pace(nbytes)
+
+    async def pace(self, nbytes: int):
+        # wait like throttle but do not count the bytes, for transfers that are
+        # only counted once they succeed
+        now = time.monotonic()
+        if self._limit is None:
+            self._last_ts = now
+            return
+        self._tokens = min(self._limit, self._tokens + (now - self._last_ts) * self._limit)
+        self._last_ts = now
+        self._tokens -= nbytes
+        if self._tokens < 0:
+            await asyncio.sleep(-self._tokens / self._limit)
+
+    async def call(self, fn, *args, **kwargs):
+        # run a node request, retrying and slowing down if the node is under pressure
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                if not is_pressure(e) or attempt == self.max_retries:
+                    raise e
+                self.retries += 1
+                self._decrease()
+                await asyncio.sleep(delay)
+                delay *= 2
+            else:
+                self._increase()
+                return result
+
+    def _decrease(self):
+        if self._limit is None:
+            # start from the throughput seen so far
+            elapsed = max(time.monotonic() - self._start_ts, 1e-3)
+            self._observed_rate = max(MIN_RATE, self.total_bytes / elapsed)
+            self._limit = self._observed_rate
+        self._limit = max(MIN_RATE, self._limit / 2)
+        self._tokens = 0.0
+
+    def _increase(self):
+        if self._limit is None or self._limit == self.rate:
+            return
+        self._limit *= 1.25
+        if self.rate is not None:
+            self._limit = min(self._limit, self.rate)
+        elif self._limit > 4 * self._observed_rate:
+            # well above the throughput before the node was under pressure
+            self._limit = None
+
+
+def is_pressure(e: Exception) -> bool:
+    if isinstance(e, (asyncio.TimeoutError, ConnectionError, aiohttp.ClientConnectionError)):
+        return True
+    # joule reports a node it cannot reach as an ApiError raised from the aiohttp error
+    if isinstance(e, joule.errors.ApiError) and isinstance(e.__cause__, aiohttp.ClientConnectionError):
+        return True
+    return status_code(e) in PRESSURE_STATUS
+
+
+def status_code(e: Exception) -> Optional[int]:
+    # HTTP status of a failed request: aiohttp errors carry it, joule ApiErrors end
+    # with it ("message [503]") or start with it ("API Error [503]: ...")
+    status = getattr(e, 'status', None)
+    if isinstance(status, int):
+        return status
+    if isinstance(e, joule.errors.ApiError):
+        match = _API_STATUS.search(str(e))
+        if match is not None:
+            return int(match.group(1) or match.group(2))
+    return None
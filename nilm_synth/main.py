@@ -1,19 +1,14 @@
 #!/usr/bin/python3
-import functools
-
 import pandas as pd
-import sqlalchemy.engine
-from sqlalchemy import create_engine, select
+from sqlalchemy import create_engine
 import asyncio
 import joule.api
 import yaml
 import click
 import h5py
 import os
-import random
-from numpy import random
-from typing import Optional
-from joule.models.pipes import Pipe
+import time
+from typing import Optional, Union
 import joule.errors
 
 from nilm_synth.parsers.parse_loads import parse_loads
@@ -23,22 +18,29 @@ from nilm_synth.parsers.parse_resources import parse_resources
 from nilm_synth.builders import (
     initialize_hdf_data, add_baseline_hd5_data,
     build_nilmtk_metadata,
-    build_nilmtk_data, add_runs_hd5_data, add_noise_hd5_data)
-from nilm_synth.builders import build_output_pipe, write_stream_data
-from nilm_synth.models.library_types import (
-    LibraryLoad, library_load_table,
-    LibraryExemplar, library_exemplar_table)
+    build_nilmtk_data, add_runs_hd5_data, NoiseSource, site_meter_ids)
+from nilm_synth.builders import build_output_pipe, write_stream_data, OutputPipe, RenderBuffer, WorkingBuffer
+from nilm_synth.builders import build_streaming_data, BaselineStream, NilmtkWriter
+from nilm_synth.builders import build_sharded_data, add_submeter_datasets, submeter_dataset, BaselineSource
 from nilm_synth.models.library_types import metadata as library_metadata
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.library_bundle import LibraryBundle
+from nilm_synth.models.run_table import RunTable
+from nilm_synth.models.segment_cache import SegmentCache, SegmentReader
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.file_node import get_node
+from nilm_synth.seeds import SeedStreams
+from nilm_synth.profiler import Profiler
 
 VERSION = 0.6
 
-async def main(config, force):
+async def main(config, force, profile=False):
     print(f"NILM-Synth Power Dataset Simulator v{VERSION}")
+    profiler = Profiler()
     # === Run Parsers on Config File ===
     print("parsing specification file...", end="")
-    with open(config, 'r') as f:
+    with open(config, 'r') as f, profiler.stage('parse'):
         config = yaml.safe_load(f)
-        rng = random.default_rng()
         # 1.) Parse metadata section if it is present
         if 'metadata' in config:
             metadata = parse_metadata(config['metadata'])
@@ -48,26 +50,54 @@ async def main(config, force):
         if 'dataset' not in config:
             raise ValueError("Config file missing [dataset] section")
         dataset = parse_dataset(config['dataset'])
+        # all random values are drawn from streams of the dataset seed
+        seeds = SeedStreams(dataset.seed)
 
         # 3.) Parse the resources section
         if 'resources' not in config:
             raise ValueError("Config file missing [resources] section")
         resources = parse_resources(config['resources'])
-        engine = create_engine('sqlite:///%s' % resources.library_database)
-        library_metadata.create_all(engine)
-        conn = engine.connect()
-        wrapped_get_instantiated_load = functools.partial(get_instantiated_load, conn=conn)
-        wrapped_get_load_appliance_type = functools.partial(get_load_appliance_type, conn=conn)
+        # read the library once, exemplars are picked with the random stream of each load
+        bundle: Optional[LibraryBundle] = None
+        if resources.library_bundle != "":
+            bundle = LibraryBundle(resources.library_bundle)
+            with profiler.stage('catalog'):
+                catalog = bundle.catalog()
+        else:
+            engine = create_engine('sqlite:///%s' % resources.library_database)
+            library_metadata.create_all(engine)
+            conn = engine.connect()
+            with profiler.stage('catalog'):
+                catalog = ExemplarCatalog.from_connection(conn)
+            conn.close()
 
         # 3.) Parse the loads section
         if 'loads' not in config:
             raise ValueError("Config file missing [loads] section")
         runs = parse_loads(config['loads'], dataset.start_ts,
-                           dataset.end_ts, rng, wrapped_get_instantiated_load)
+                           dataset.end_ts, seeds, catalog, dataset.phases)
     # === Run Builders to Create Dataset ===
-    library_node = joule.api.get_node(resources.library_node)
-    output_node = joule.api.get_node(resources.output_node)
-    baseline_node = joule.api.get_node(resources.baseline_node)
+    # nodes may be Joule servers or local directories (file:///path)
+    # a library bundle holds every segment, the library node is not used
+    library_node = None
+    if bundle is None:
+        library_node = get_node(resources.library_node)
+    output_node = get_node(resources.output_node)
+    baseline_node = get_node(resources.baseline_node)
+    # exemplar segments are read through a local cache when one is configured
+    cache: Optional[SegmentCache] = None
+    baseline_cache: Optional[SegmentCache] = None
+    if resources.cache_dir != "":
+        cache = SegmentCache(resources.cache_dir, resources.cache_size)
+        # baseline windows are shared by every dataset built over the same stream
+        baseline_cache = SegmentCache(os.path.join(resources.cache_dir, 'baseline'), resources.cache_size)
+    # only throttle transfers with nodes that have a configured rate
+    flow_controls = {node: FlowControl(resources.flow_control.get(node))
+                     for node in ['library_node', 'baseline_node', 'output_node']}
+    library_reader = SegmentReader(library_node, cache, resources.prefetch_concurrency,
+                                   flow_controls['library_node'])
+    if bundle is not None:
+        library_reader.hold(bundle.segments())
 
     # if the output resources already exist confirm their removal
     if os.path.isfile(resources.output_file):
@@ -82,59 +112,128 @@ async def main(config, force):
     except joule.errors.ApiError:
         pass  # folder does not exist so nothing to remove
 
-    output_pipe: Optional[Pipe] = None
+    output_pipe: Optional[OutputPipe] = None
     nilmtk_hdf = pd.HDFStore(resources.output_file)
     build_nilmtk_metadata(dataset, metadata, config['loads'], nilmtk_hdf,
-                          wrapped_get_load_appliance_type)
+                          catalog.appliance_type)
 
-    f: Optional[h5py.File] = None
+    f: Optional[Union[h5py.File, WorkingBuffer]] = None
+    # noise is generated in the background and added where the aggregate is written
+    # (sharded builds generate the noise of each shard in its worker)
+    noise: Optional[NoiseSource] = None
+    if dataset.noise != 0 and resources.workers == 1:
+        num_rows = round((dataset.end_ts - dataset.start_ts) * 60 * 1e-6)
+        noise = NoiseSource(seeds, dataset.noise, num_rows, columns=dataset.phases * 8)
     print("[OK]")
+    print(f"  seed: {seeds.seed}")
     try:
-
-        # Create the HDF5 data file
-        print("---running main simulation---")
-        f = h5py.File(resources.output_file + '.raw', 'w')
-        initialize_hdf_data(f, dataset.start_ts, dataset.end_ts)
-        await add_baseline_hd5_data(f,
-                                    dataset.baseline_stream,
-                                    baseline_node,
-                                    dataset.start_ts,
-                                    dataset.end_ts)
-        add_noise_hd5_data(f, dataset.noise)
-        await add_runs_hd5_data(runs, dataset.start_ts,
-                                dataset.end_ts, wrapped_get_instantiated_load,
-                                library_node, hdf_group=f['data'])
-        output_pipe = await build_output_pipe(resources.output_stream + "/main",
-                                              dataset.start_ts,
-                                              dataset.end_ts, output_node)
-        print("  exporting data")
-        await write_stream_data(f, output_pipe)
-        await output_pipe.close()
-        build_nilmtk_data(nilmtk_hdf, _nilmtk_hdf_group(1), f, dataset.timezone)
-        # add individual nilm_identify_load streams
-        meter_id = 2
-        for config in config['loads']:
-            print("\n---running submeter simulation---")
-            f['data'][:] = 0
-            load_path = resources.output_stream + "/" + config['name']
-            submeter_runs = [r for r in runs if r.meter_id == meter_id]
-            await add_runs_hd5_data(submeter_runs, dataset.start_ts,
-                                    dataset.end_ts, wrapped_get_instantiated_load,
-                                    library_node, hdf_group=f['data'])
-            print("  exporting data")
-            build_nilmtk_data(nilmtk_hdf, _nilmtk_hdf_group(meter_id), f, dataset.timezone)
-            output_pipe = await build_output_pipe(load_path,
-                                                  dataset.start_ts,
-                                                  dataset.end_ts, output_node)
-            await write_stream_data(f, output_pipe)
-            await output_pipe.close()
-            events = [r.to_event() for r in submeter_runs]
-            event_stream = joule.api.EventStream(config['name'] + ' Events')
-            #print(f"adding {config['name']} to {resources.output_stream}")
-            event_stream = await output_node.event_stream_create(event_stream,
-                                                                 resources.output_stream)
-            await output_node.event_stream_write(event_stream, events)
-            meter_id += 1
+        build_start = time.monotonic()
+        # fetch every segment in the run plan before rendering
+        print("  fetching exemplars")
+        with profiler.stage('exemplar_fetch'):
+            await library_reader.prefetch(runs.segments())
+        if resources.streaming:
+            print("---running streaming simulation---")
+            await _run_streaming(runs, config['loads'], dataset, resources, library_reader,
+                                 output_node, baseline_node, nilmtk_hdf, flow_controls, noise,
+                                 baseline_cache, profiler)
+        else:
+            # Create the HDF5 data file (or memory mapped working buffer)
+            print("---running main simulation---")
+            f = _open_raw(resources)
+            initialize_hdf_data(f, dataset.start_ts, dataset.end_ts, num_phases=dataset.phases,
+                                materialize_timestamps=resources.materialize_timestamps,
+                                chunk_rows=resources.raw_chunk_rows,
+                                compression=_raw_compression(resources))
+            if resources.workers > 1:
+                await _run_sharded(runs, config['loads'], dataset, resources, library_reader,
+                                   output_node, baseline_node, nilmtk_hdf, flow_controls, f, seeds,
+                                   baseline_cache, profiler)
+            else:
+                # with no baseline the noise is added in the aggregate writes of the first submeter
+                render_noise = None
+                if dataset.baseline_stream is None and len(config['loads']) > 0:
+                    render_noise = noise
+                await add_baseline_hd5_data(f,
+                                            dataset.baseline_stream,
+                                            baseline_node,
+                                            dataset.start_ts,
+                                            dataset.end_ts,
+                                            flow_controls['baseline_node'],
+                                            noise if render_noise is None else None,
+                                            baseline_cache, dataset.baseline_fill, profiler)
+                # render each submeter once, its tiles are added into the phase of its load
+                # in the aggregate as they are written
+                meter_id = 2
+                stale_tiles = set()
+                for load_config in config['loads']:
+                    print("\n---running submeter simulation---")
+                    load_path = resources.output_stream + "/" + load_config['name']
+                    submeter_runs = runs.for_meter(meter_id)
+                    phase = runs.phase(meter_id)
+                    buffer = RenderBuffer(f['submeter'], zeroed=True, aggregate=f['data'],
+                                          aggregate_columns=slice(phase * 8, (phase + 1) * 8),
+                                          aggregate_noise=render_noise if meter_id == 2 else None)
+                    num_rows = len(f['submeter'])
+                    with profiler.stage('render', num_rows):
+                        await add_runs_hd5_data(submeter_runs, dataset.start_ts,
+                                                dataset.end_ts, library_reader, hdf_group=buffer)
+                        # remove data left by the previous submeter in tiles this one did not write
+                        buffer.clear_tiles(stale_tiles - buffer.written_tiles)
+                        stale_tiles = buffer.written_tiles
+                    print("  exporting data")
+                    with profiler.stage('nilmtk_export', num_rows):
+                        build_nilmtk_data(nilmtk_hdf, [_nilmtk_hdf_group(meter_id)], f, dataset.timezone,
+                                          dataset='submeter')
+                    with profiler.stage('joule_upload', num_rows):
+                        output_pipe = await build_output_pipe(load_path,
+                                                              dataset.start_ts,
+                                                              dataset.end_ts, output_node,
+                                                              flow_control=flow_controls['output_node'])
+                        await write_stream_data(f, output_pipe, dataset='submeter',
+                                                flow_control=flow_controls['output_node'])
+                        await output_pipe.close()
+                    with profiler.stage('events', len(submeter_runs)):
+                        await _write_events(output_node, resources.output_stream,
+                                            load_config['name'], submeter_runs)
+                    meter_id += 1
+            print("\n---exporting aggregate---")
+            num_rows = len(f['data'])
+            with profiler.stage('joule_upload', num_rows):
+                output_pipe = await build_output_pipe(resources.output_stream + "/main",
+                                                      dataset.start_ts,
+                                                      dataset.end_ts, output_node, dataset.phases,
+                                                      flow_control=flow_controls['output_node'])
+                await write_stream_data(f, output_pipe, flow_control=flow_controls['output_node'])
+                await output_pipe.close()
+            # every phase is exported from one read of the aggregate
+            site_meters = site_meter_ids(dataset.phases, len(config['loads']))
+            with profiler.stage('nilmtk_export', num_rows * len(site_meters)):
+                build_nilmtk_data(nilmtk_hdf, [_nilmtk_hdf_group(meter_id) for meter_id in site_meters],
+                                  f, dataset.timezone)
+            f.flush()
+            if resources.raw_backend == 'memmap':
+                print(f"\nraw buffer: {f.disk_usage / 1024 ** 2:.1f} MB on disk (memmap)")
+            else:
+                print(f"\nraw file: {os.path.getsize(resources.output_file + '.raw') / 1024 ** 2:.1f} MB "
+                      f"({resources.raw_chunk_rows} row chunks, {resources.raw_compression} compression)")
+        library_reader.release()
+        print(f"\nbuilt in {time.monotonic() - build_start:.1f}s")
+        if cache is not None:
+            print(f"\nexemplar cache: {cache.hits} hits, {cache.misses} misses, "
+                  f"{cache.evictions} evictions ({cache.size / 1024 ** 2:.1f} MB)")
+        if profile:
+            for (node, flow_control) in flow_controls.items():
+                profiler.count(f"{node}_bytes", flow_control.total_bytes)
+                profiler.count(f"{node}_retries", flow_control.retries)
+            for (name, segment_cache) in [('exemplar_cache', cache), ('baseline_cache', baseline_cache)]:
+                if segment_cache is not None:
+                    profiler.count(f"{name}_hits", segment_cache.hits)
+                    profiler.count(f"{name}_misses", segment_cache.misses)
+                    profiler.count(f"{name}_hit_rate", segment_cache.hit_rate)
+            profiler.count('runs', len(runs))
+            profiler.write(resources.output_file + '.profile.json')
+            print(f"profile: {resources.output_file + '.profile.json'}")
 
         # Use the HDF5 data file to create the Joule stream
         # with h5py.File(resources.output_file, 'r') as f:
@@ -145,7 +244,14 @@ async def main(config, force):
         else:
             raise e
     finally:
-        await library_node.close()
+        if library_node is not None:
+            await library_node.close()
+        if bundle is not None:
+            bundle.close()
+        if cache is not None:
+            cache.close()
+        if baseline_cache is not None:
+            baseline_cache.close()
         if output_pipe is not None:
             await output_pipe.close()
         await output_node.close()
@@ -153,52 +259,128 @@ async def main(config, force):
         nilmtk_hdf.close()
         if f is not None:
             f.close()
+        if noise is not None:
+            noise.close()
         nilmtk_hdf.close()
 
 
-def get_instantiated_load(load_id: int, conn: sqlalchemy.engine.Engine) -> LibraryLoad:
-    t = library_load_table
-    query = select([t]).where(t.c.id == load_id)
-    row = conn.execute(query).fetchone()
-    load = LibraryLoad(**row)
-    # pick a random exemplar
-    t = library_exemplar_table
-    query = select([t]).where(t.c.load_id == load_id)
-    rows = conn.execute(query).fetchall()
-    if len(rows) > 1:
-        row = rows[random.randint(0, len(rows) - 1)]
-    else:
-        row = rows[0]
-    load.exemplar = LibraryExemplar(**row)
-    return load
+async def _run_streaming(runs: RunTable, load_configs, dataset, resources, library_reader: SegmentReader,
+                         output_node, baseline_node, nilmtk_hdf: pd.HDFStore, flow_controls,
+                         noise: Optional[NoiseSource], baseline_cache: Optional[SegmentCache],
+                         profiler: Profiler):
+    # open a Joule pipe for the aggregate and every submeter, and a NILMTK table
+    # for the site meter of every phase and every submeter
+    pipes = {1: await build_output_pipe(resources.output_stream + "/main",
+                                        dataset.start_ts, dataset.end_ts, output_node, dataset.phases,
+                                        flow_control=flow_controls['output_node'])}
+    nilmtk_writers = {meter_id: NilmtkWriter(nilmtk_hdf, _nilmtk_hdf_group(meter_id), dataset.timezone, phase)
+                      for (phase, meter_id) in enumerate(site_meter_ids(dataset.phases, len(load_configs)))}
+    for (meter_id, load_config) in enumerate(load_configs, start=2):
+        pipes[meter_id] = await build_output_pipe(resources.output_stream + "/" + load_config['name'],
+                                                  dataset.start_ts, dataset.end_ts, output_node,
+                                                  flow_control=flow_controls['output_node'])
+        nilmtk_writers[meter_id] = NilmtkWriter(nilmtk_hdf, _nilmtk_hdf_group(meter_id), dataset.timezone)
+    baseline = None
+    if dataset.baseline_stream is not None:
+        baseline = BaselineStream(baseline_node, dataset.baseline_stream, dataset.start_ts,
+                                  dataset.end_ts, flow_controls['baseline_node'],
+                                  baseline_cache, dataset.baseline_fill, dataset.phases)
+        await baseline.open()
+    await build_streaming_data(runs, dataset.start_ts, dataset.end_ts, library_reader,
+                               pipes, nilmtk_writers, baseline, noise, dataset.phases,
+                               flow_control=flow_controls['output_node'], profiler=profiler)
+    if baseline is not None:
+        await baseline.close()
+    for (meter_id, load_config) in enumerate(load_configs, start=2):
+        submeter_runs = runs.for_meter(meter_id)
+        with profiler.stage('events', len(submeter_runs)):
+            await _write_events(output_node, resources.output_stream, load_config['name'],
+                                submeter_runs)
 
 
-def get_load_appliance_type(load_id: int, conn: sqlalchemy.engine.Engine) -> str:
-    t = library_load_table
-    query = select([t.c.appliance_type]).where(t.c.id == load_id)
-    row = conn.execute(query).fetchone()
-    return row[0]
+async def _run_sharded(runs: RunTable, load_configs, dataset, resources, library_reader: SegmentReader,
+                       output_node, baseline_node, nilmtk_hdf: pd.HDFStore, flow_controls,
+                       f: WorkingBuffer, seeds: SeedStreams, baseline_cache: Optional[SegmentCache],
+                       profiler: Profiler):
+    # every submeter is kept in the working buffer, worker processes render time
+    # shards of the aggregate and submeters into it, then each one is exported in order
+    meter_ids = list(range(2, len(load_configs) + 2))
+    add_submeter_datasets(f, meter_ids)
+    baseline = None
+    if dataset.baseline_stream is not None:
+        baseline_cache_dir = None
+        if resources.cache_dir != "":
+            baseline_cache_dir = os.path.join(resources.cache_dir, 'baseline')
+        baseline = BaselineSource(resources.baseline_node, dataset.baseline_stream, dataset.baseline_fill,
+                                  resources.flow_control.get('baseline_node'), baseline_cache_dir,
+                                  resources.cache_size)
+        if baseline_cache is not None:
+            # workers read the cache but do not write it, fetch the windows they need once
+            print("  fetching baseline")
+            stream = BaselineStream(baseline_node, dataset.baseline_stream, dataset.start_ts, dataset.end_ts,
+                                    flow_controls['baseline_node'], baseline_cache, dataset.baseline_fill,
+                                    dataset.phases)
+            await stream.open()
+            with profiler.stage('baseline', len(f['data'])):
+                await stream.fill_cache(len(f['data']))
+            await stream.close()
+    print(f"  rendering with {resources.workers} workers")
+    with profiler.stage('render', len(f['data'])):
+        await build_sharded_data(f, runs, library_reader, dataset.start_ts, dataset.end_ts, seeds,
+                                 dataset.noise, baseline, dataset.phases, resources.workers,
+                                 bundle=resources.library_bundle or None,
+                                 flow_control=flow_controls['baseline_node'])
+    for (meter_id, load_config) in zip(meter_ids, load_configs):
+        print("\n---exporting submeter %s---" % load_config['name'])
+        submeter_runs = runs.for_meter(meter_id)
+        num_rows = len(f['data'])
+        with profiler.stage('nilmtk_export', num_rows):
+            build_nilmtk_data(nilmtk_hdf, [_nilmtk_hdf_group(meter_id)], f, dataset.timezone,
+                              dataset=submeter_dataset(meter_id))
+        with profiler.stage('joule_upload', num_rows):
+            output_pipe = await build_output_pipe(resources.output_stream + "/" + load_config['name'],
+                                                  dataset.start_ts, dataset.end_ts, output_node,
+                                                  flow_control=flow_controls['output_node'])
+            await write_stream_data(f, output_pipe, dataset=submeter_dataset(meter_id),
+                                    flow_control=flow_controls['output_node'])
+            await output_pipe.close()
+        with profiler.stage('events', len(submeter_runs)):
+            await _write_events(output_node, resources.output_stream, load_config['name'],
+                                submeter_runs)
 
 
-def _nilmtk_hdf_group(meter_id: int):
-    return f'/building1/elec/meter{meter_id}'
+async def _write_events(output_node, output_stream: str, load_name: str, runs: RunTable):
+    events = runs.to_events()
+    event_stream = joule.api.EventStream(load_name + ' Events')
+    event_stream = await output_node.event_stream_create(event_stream, output_stream)
+    await output_node.event_stream_write(event_stream, events)
+
+
+def _open_raw(resources) -> Union[h5py.File, WorkingBuffer]:
+    if resources.raw_backend == 'memmap':
+        return WorkingBuffer(resources.output_file + '.raw.d')
+    return h5py.File(resources.output_file + '.raw', 'w')
+
 
+def _raw_compression(resources) -> Optional[str]:
+    if resources.raw_compression == 'none':
+        return None
+    return resources.raw_compression
 
-def _zero_dataset(data):
-    BLOCK_SIZE = 10000
-    start_idx = 0
-    end_idx = BLOCK_SIZE
-    while end_idx < len(data):
-        data[start_idx:end_idx] = 0
+
+def _nilmtk_hdf_group(meter_id: int):
+    return f'/building1/elec/meter{meter_id}'
 
 
 @click.command()
 @click.option("-c", "--config", help="YAML configuration file", required=True)
 @click.option("-y", "--yes", "force",
               help="remove existing outputs without prompting", is_flag=True)
-def run_main(config, force):
+@click.option("--profile", help="write the time spent in each stage to [output_file].profile.json",
+              is_flag=True)
+def run_main(config, force, profile):
     # try:
-    asyncio.run(main(config, force))
+    asyncio.run(main(config, force, profile))
 
 
 # except ValueError as e:
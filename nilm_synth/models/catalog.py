@@ -0,0 +1,112 @@
+from typing import Dict, List, Tuple
+import numpy as np
+import sqlalchemy.engine
+from sqlalchemy import select
+
+from nilm_synth.models.library_types import (
+    LibraryLoad, library_load_table,
+    LibraryExemplar, library_exemplar_table)
+
+# exemplar segment bounds stored by the catalog, in column order
+EXEMPLAR_BOUNDS = ['on_start', 'on_end', 'ss_start', 'ss_end', 'off_start', 'off_end']
+
+
+class ExemplarCatalog:
+    """The loads and exemplars of the library database held in memory.
+
+    Both tables are read once, exemplar bounds are kept in a single int64
+    array sorted by load so the exemplars of a load are a contiguous range
+    of rows, exemplars are referred to by row when runs are planned. Each
+    call to instantiate returns a new LibraryLoad with an exemplar picked by
+    the caller's random generator."""
+
+    def __init__(self, loads: List[LibraryLoad], exemplars: List[LibraryExemplar]):
+        self._loads: Dict[int, LibraryLoad] = {load.id: load for load in loads}
+        exemplars = sorted(exemplars, key=lambda ex: (ex.load_id, ex.id))
+        self._ids = np.array([ex.id for ex in exemplars], dtype='i8')
+        # missing steady state bounds are -1, they are flagged by _has_steady_state
+        self._bounds = np.array([[-1 if getattr(ex, bound) is None else getattr(ex, bound)
+                                  for bound in EXEMPLAR_BOUNDS] for ex in exemplars],
+                                dtype='i8').reshape((-1, len(EXEMPLAR_BOUNDS)))
+        self._has_steady_state = np.array([ex.has_steady_state for ex in exemplars], dtype=bool)
+        self._load_ids = np.array([ex.load_id for ex in exemplars], dtype='i8')
+        # rows [start, end) of the exemplars that belong to each load
+        unique_ids, starts, counts = np.unique(self._load_ids, return_index=True, return_counts=True)
+        self._ranges = {int(load_id): (int(start), int(start + count))
+                        for (load_id, start, count) in zip(unique_ids, starts, counts)}
+
+    @classmethod
+    def from_connection(cls, conn: sqlalchemy.engine.Connection) -> 'ExemplarCatalog':
+        return cls(*read_library(conn))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def appliance_type(self, load_id: int) -> str:
+        return self._load(load_id).appliance_type
+
+    def num_exemplars(self, load_id: int) -> int:
+        (start, end) = self._ranges.get(load_id, (0, 0))
+        return end - start
+
+    def stream(self, load_id: int) -> str:
+        return self._load(load_id).stream
+
+    def rows(self, load_id: int, steady_state: bool = False) -> np.ndarray:
+        # catalog rows of every exemplar of the load, only those with a steady state if [steady_state]
+        self._load(load_id)
+        if load_id not in self._ranges:
+            raise ValueError("Load [%d] has no exemplars in the library" % load_id)
+        rows = np.arange(*self._ranges[load_id])
+        if steady_state:
+            rows = rows[self._has_steady_state[rows]]
+            if len(rows) == 0:
+                raise ValueError("Cannot specify duration for load with no steady state")
+        return rows
+
+    def sample(self, load_id: int, count: int, rng: np.random.Generator,
+               steady_state: bool = False) -> np.ndarray:
+        # catalog rows of [count] exemplars of the load picked at random
+        rows = self.rows(load_id, steady_state)
+        return rows[rng.integers(len(rows), size=count)]
+
+    def bounds(self, rows: np.ndarray) -> np.ndarray:
+        # segment bounds of the exemplars at [rows], columns are EXEMPLAR_BOUNDS
+        return self._bounds[rows]
+
+    def has_steady_state(self, rows: np.ndarray) -> np.ndarray:
+        return self._has_steady_state[rows]
+
+    def instantiate(self, load_id: int, rng: np.random.Generator) -> LibraryLoad:
+        # copy the load and give it a random exemplar
+        return self.instantiate_row(int(self.sample(load_id, 1, rng)[0]))
+
+    def instantiate_row(self, row: int) -> LibraryLoad:
+        # copy the load of the exemplar at [row] and set its exemplar
+        library_load = self._load(int(self._load_ids[row]))
+        load = LibraryLoad(library_load.stream, library_load.appliance_type, library_load.name,
+                           library_load.description, library_load.image, library_load.id)
+        load.exemplar = self._exemplar(row, library_load.id)
+        return load
+
+    def _load(self, load_id: int) -> LibraryLoad:
+        if load_id not in self._loads:
+            raise ValueError("Load [%d] is not in the library" % load_id)
+        return self._loads[load_id]
+
+    def _exemplar(self, row: int, load_id: int) -> LibraryExemplar:
+        bounds = {bound: int(value) for (bound, value) in zip(EXEMPLAR_BOUNDS, self._bounds[row])}
+        if not self._has_steady_state[row]:
+            bounds['ss_start'] = None
+            bounds['ss_end'] = None
+        return LibraryExemplar(**bounds, load_id=load_id, id=int(self._ids[row]))
+
+
+def read_library(conn: sqlalchemy.engine.Connection) -> Tuple[List[LibraryLoad], List[LibraryExemplar]]:
+    # every load and exemplar of the library database
+    loads = [LibraryLoad(**row) for row in conn.execute(select([library_load_table])).fetchall()]
+    # the exemplar deltas are not needed to build runs
+    t = library_exemplar_table
+    columns = [t.c.id, t.c.load_id] + [t.c[bound] for bound in EXEMPLAR_BOUNDS]
+    exemplars = [LibraryExemplar(**row) for row in conn.execute(select(columns)).fetchall()]
+    return loads, exemplars
@@ -0,0 +1,158 @@
+import asyncio
+import json
+import os
+import struct
+from typing import Dict, List, Tuple
+import click
+import numpy as np
+
+from nilm_synth.models.catalog import ExemplarCatalog, EXEMPLAR_BOUNDS
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+from nilm_synth.models.run import Run
+from nilm_synth.models.segment_cache import SegmentKey, SegmentReader
+
+MAGIC = b'NSBUNDLE'
+VERSION = 1
+# magic, version, byte offset and length of the JSON index
+HEADER = struct.Struct('<8sIQQ')
+DATA_OFFSET = 64  # segments start after the header
+ALIGNMENT = 64  # every segment starts on a cache line
+LOAD_FIELDS = ['stream', 'appliance_type', 'name', 'description', 'image', 'id']
+EXPORT_BATCH = 64  # segments requested from the library node at a time
+
+
+class LibraryBundle:
+    """A library exported to a single file: the loads and exemplars of the
+    database and every segment the exemplars reference.
+
+    Segments are float32 arrays stored back to back after a fixed header,
+    the JSON index at the end of the file holds the loads, the exemplars
+    and the offset and shape of each segment. The file is memory mapped
+    read only, a segment is a view of the mapping so processes that open
+    the same bundle share its pages. The bundle can take the place of a
+    SegmentReader when runs are laid out (see read)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError("[%s] is not a library bundle" % path)
+            (magic, version, index_offset, index_length) = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError("[%s] is not a library bundle" % path)
+            if version != VERSION:
+                raise ValueError("Library bundle [%s] is version %d, expected %d" % (path, version, VERSION))
+            f.seek(index_offset)
+            index = json.loads(f.read(index_length))
+        self.loads = [LibraryLoad(**load) for load in index['loads']]
+        self.exemplars = [LibraryExemplar(**exemplar) for exemplar in index['exemplars']]
+        # offset (in float32 values from the start of the data) and shape of each segment
+        self._index: Dict[SegmentKey, Tuple[int, Tuple[int, int]]] = {
+            (stream, start_ts, end_ts): (offset, (rows, columns))
+            for (stream, start_ts, end_ts, offset, rows, columns) in index['segments']}
+        num_values = (index_offset - DATA_OFFSET) // 4
+        if num_values == 0:
+            self._data = np.zeros(0, dtype='<f4')  # an empty file cannot be mapped
+        else:
+            self._data = np.memmap(path, dtype='<f4', mode='r', offset=DATA_OFFSET, shape=(num_values,))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key: SegmentKey):
+        return key in self._index
+
+    def catalog(self) -> ExemplarCatalog:
+        return ExemplarCatalog(self.loads, self.exemplars)
+
+    def segment(self, stream: str, start_ts: int, end_ts: int) -> np.ndarray:
+        key = (stream, int(start_ts), int(end_ts))
+        if key not in self._index:
+            raise ValueError("No segment of [%s] between %d and %d in the library bundle" % key)
+        (offset, (rows, columns)) = self._index[key]
+        return self._data[offset:offset + rows * columns].reshape((rows, columns))
+
+    def segments(self) -> Dict[SegmentKey, np.ndarray]:
+        # every segment of the bundle, to hold in a SegmentReader
+        return {key: self.segment(*key) for key in self._index}
+
+    async def read(self, stream: str, start_ts: int, end_ts: int) -> np.ndarray:
+        # same interface as SegmentReader.read, segments are never fetched
+        return self.segment(stream, start_ts, end_ts)
+
+    def close(self):
+        self._data = np.zeros(0, dtype='<f4')
+
+
+class BundleWriter:
+    """Writes a LibraryBundle one segment at a time.
+
+    The file is written to [path].tmp and moved into place by close, so a
+    failed export never leaves a partial bundle."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp_path = path + '.tmp'
+        self._file = open(self._tmp_path, 'wb')
+        # the header is written by close once the index offset is known
+        self._file.write(bytes(DATA_OFFSET))
+        self._segments: List[list] = []
+
+    def add_segment(self, stream: str, start_ts: int, end_ts: int, data: np.ndarray):
+        data = np.ascontiguousarray(data, dtype='<f4')
+        if data.ndim == 1:
+            data = data.reshape((-1, 1))
+        self._pad()
+        offset = (self._file.tell() - DATA_OFFSET) // 4
+        self._file.write(data.tobytes())
+        self._segments.append([stream, int(start_ts), int(end_ts), offset, data.shape[0], data.shape[1]])
+
+    def close(self, loads: List[LibraryLoad], exemplars: List[LibraryExemplar]):
+        self._pad()
+        index = json.dumps({
+            'loads': [{field: getattr(load, field) for field in LOAD_FIELDS} for load in loads],
+            'exemplars': [dict({bound: getattr(exemplar, bound) for bound in EXEMPLAR_BOUNDS},
+                               load_id=exemplar.load_id, id=exemplar.id) for exemplar in exemplars],
+            'segments': self._segments}).encode()
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.seek(0)
+        self._file.write(HEADER.pack(MAGIC, VERSION, index_offset, len(index)))
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+
+    def abort(self):
+        self._file.close()
+        os.remove(self._tmp_path)
+
+    def _pad(self):
+        position = self._file.tell()
+        self._file.write(bytes(-position % ALIGNMENT))
+
+
+async def export_bundle(path: str, loads: List[LibraryLoad], exemplars: List[LibraryExemplar],
+                        reader: SegmentReader) -> int:
+    """Write the loads, exemplars and every segment they reference to a
+    bundle at [path], segments are read through [reader] in batches of
+    EXPORT_BATCH. Returns the number of segments."""
+    catalog = ExemplarCatalog(loads, exemplars)
+    keys = set()
+    for row in range(len(catalog)):
+        load = catalog.instantiate_row(row)
+        keys.update(Run.segments_of(load, load.exemplar.has_steady_state))
+    keys = sorted(keys)
+    writer = BundleWriter(path)
+    try:
+        with click.progressbar(length=len(keys)) as bar:
+            for start in range(0, len(keys), EXPORT_BATCH):
+                batch = keys[start:start + EXPORT_BATCH]
+                # requests in a batch run concurrently, segments are written in order
+                for (key, data) in zip(batch, await asyncio.gather(*[reader.read(*key) for key in batch])):
+                    writer.add_segment(*key, data)
+                bar.update(len(batch))
+    except BaseException:
+        writer.abort()
+        raise
+    writer.close(loads, exemplars)
+    return len(keys)
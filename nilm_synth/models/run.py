@@ -1,12 +1,29 @@
 from dataclasses import dataclass
 import numpy as np
 import sys
-import asyncio
-from typing import Optional, TYPE_CHECKING
+from typing import Optional, List, Tuple, TYPE_CHECKING
 import joule.api
 
 if TYPE_CHECKING:
     from nilm_synth.models.library_types import LibraryLoad
+    from nilm_synth.models.segment_cache import SegmentReader
+    from nilm_synth.builders.render_buffer import RenderBuffer
+
+# upper bound on the rows of repeated steady state data held in memory
+MAX_TILED_ROWS = 60 * 60 * 60
+
+
+@dataclass
+class RunPiece:
+    # [data] repeated [repeats] times starting at dataset row [offset]
+    offset: int
+    data: np.ndarray
+    repeats: int = 1
+    padding: bool = False
+
+    @property
+    def end(self):
+        return self.offset + len(self.data) * self.repeats
 
 
 @dataclass
@@ -33,71 +50,114 @@ class Run:
     def __str__(self):
         return f"{self.start_ts},{self.instantiated_load.name},{self.scale_factor},{self.time_padding},{self.steady_state_blocks}"
 
-    async def execute(self, node, data_array, dataset_start_ts):
-        self._reset_stats()
+    async def execute(self, reader: 'SegmentReader', data_array: 'RenderBuffer', dataset_start_ts):
         if self.instantiated_load is None:
             raise Exception("Must set instantiated_load before calling execute")
-        ex = self.instantiated_load.exemplar
-        delay = self.start_ts - dataset_start_ts
-        idx = round(delay / ((1 / 60) * 1e6))
         # add the nilm_identify_load data to the array
         print("\t%s:" % self.name, end="")
         sys.stdout.flush()
-        idx, last_value = await self._add_data(ex.on_start, ex.on_end, node, data_array, offset=idx)
-        # apply time padding
-        pad_width = round(self.time_padding / ((1 / 60) * 1e6))
-        data_array[idx:(idx + pad_width), :] += last_value
-        idx += pad_width
-        for _ in range(self.steady_state_blocks):
-            idx, last_row = await self._add_data(ex.ss_start, ex.ss_end, node, data_array, offset=idx)
-        await self._add_data(ex.off_start, ex.off_end, node, data_array, offset=idx)
+        pieces = await self.layout(reader, dataset_start_ts)
+        self.compute_stats(pieces)
+        for piece in pieces:
+            self._add_piece(piece, data_array)
+            print(".", end="")
+            sys.stdout.flush()
         print("[done]")
+
+    async def layout(self, reader: 'SegmentReader', dataset_start_ts) -> List['RunPiece']:
+        # the on, padding, steady state and off parts of the run in dataset rows
+        ex = self.instantiated_load.exemplar
+        idx = ts_to_row(self.start_ts, dataset_start_ts)
+        on_data = await reader.read(self._library_stream, ex.on_start, ex.on_end) * self.scale_factor
+        pieces = [RunPiece(idx, on_data)]
+        idx += len(on_data)
+        # time padding holds the last value of the on segment
+        pad_width = round(self.time_padding / ((1 / 60) * 1e6))
+        if pad_width > 0:
+            last_value = np.mean(on_data[-10:, :])
+            pieces.append(RunPiece(idx, np.full((1, on_data.shape[1]), last_value),
+                                   repeats=pad_width, padding=True))
+            idx += pad_width
+        # the steady state segment is read once and repeated for every block
+        if self.steady_state_blocks > 0:
+            ss_data = await reader.read(self._library_stream, ex.ss_start, ex.ss_end) * self.scale_factor
+            pieces.append(RunPiece(idx, ss_data, repeats=self.steady_state_blocks))
+            idx += len(ss_data) * self.steady_state_blocks
+        off_data = await reader.read(self._library_stream, ex.off_start, ex.off_end) * self.scale_factor
+        pieces.append(RunPiece(idx, off_data))
+        return pieces
+
+    def compute_stats(self, pieces: List['RunPiece']):
+        # repeated data is identical so the statistics scale with the repeat count,
+        # time padding is not included
+        pieces = [piece for piece in pieces if not piece.padding]
+        self.power_acc = sum(piece.repeats * np.sum(piece.data[:, 0]) for piece in pieces)
+        self.total_samples = sum(piece.repeats * len(piece.data) for piece in pieces)
+        self.max_power = max(np.max(piece.data[:, 0]) for piece in pieces)
         self.avg_power = self.power_acc / self.total_samples
         self.energy = self.power_acc * (1 / 60)
 
-    def _reset_stats(self):
-        self.power_acc = 0
-        self.total_samples = 0
-        self.max_power = 0
+    @staticmethod
+    def render_window(pieces: List['RunPiece'], window: np.ndarray, window_start: int):
+        # add the part of the run in rows [window_start, window_start + len(window)) to the window
+        window_end = window_start + len(window)
+        for piece in pieces:
+            start = max(piece.offset, window_start)
+            end = min(piece.end, window_end)
+            if start >= end:
+                continue
+            rows = np.arange(start - piece.offset, end - piece.offset) % len(piece.data)
+            window[start - window_start:end - window_start] += piece.data[rows]
 
-    async def _add_data(self, start, end, node, output_array, offset):
-        assert start is not None
-        assert end is not None
+    @staticmethod
+    def _add_piece(piece: 'RunPiece', output_array: 'RenderBuffer'):
+        if piece.repeats == 1:
+            output_array.add(piece.offset, piece.data)
+            return
+        # add repeated data in groups to bound the memory used
+        repeats_per_add = max(1, MAX_TILED_ROWS // len(piece.data))
+        tiled_data = np.tile(piece.data, (min(repeats_per_add, piece.repeats), 1))
+        offset = piece.offset
+        remaining = piece.repeats
+        while remaining > 0:
+            count = min(repeats_per_add, remaining)
+            output_array.add(offset, tiled_data[:count * len(piece.data)])
+            offset += count * len(piece.data)
+            remaining -= count
 
-        pipe = await node.data_read(self.instantiated_load.stream + "/prep", start, end)
-        total_rows = 0
-        last_value = None
-        while not pipe.is_empty():
-            sdata = await pipe.read()
-            if len(sdata) == 0:
-                continue
-            await asyncio.sleep(0.1)
-            data = sdata['data'] * self.scale_factor
-            pipe.consume(len(sdata))
-            total_rows += len(data)
-            try:
-
-                output_array[offset:(offset + len(data)), :] += data
-                self.power_acc += np.sum(data[:, 0])
-                self.max_power = max(self.max_power, np.max(data[:, 0]))
-            except ValueError as e:
-                print(e)
-                breakpoint()
-                print("oh no :)")
-            self.total_samples += len(data)
-            offset += len(data)
-            print(".", end="")
-            sys.stdout.flush()
-            last_value = np.mean(data[-10:, :])
+    def segments(self) -> List[Tuple[str, int, int]]:
+        # library segments read by execute as (stream, start, end)
+        return Run.segments_of(self.instantiated_load, self.steady_state_blocks > 0)
+
+    @staticmethod
+    def segments_of(instantiated_load: 'LibraryLoad', steady_state: bool) -> List[Tuple[str, int, int]]:
+        stream = instantiated_load.stream + "/prep"
+        ex = instantiated_load.exemplar
+        segments = [(stream, ex.on_start, ex.on_end)]
+        if steady_state:
+            segments.append((stream, ex.ss_start, ex.ss_end))
+        segments.append((stream, ex.off_start, ex.off_end))
+        return segments
 
-        return offset, last_value
+    @property
+    def _library_stream(self):
+        return self.instantiated_load.stream + "/prep"
 
     def to_event(self):
-        return joule.api.Event(self.start_ts, self.end_ts, content={
-            'max power (W)': float(self.max_power),
-            'average power (W)': float(self.avg_power),
-            'energy (J)': float(self.energy)
-        })
+        return power_event(self.start_ts, self.end_ts, self.max_power, self.avg_power, self.energy)
+
+
+def power_event(start_ts, end_ts, max_power, avg_power, energy) -> joule.api.Event:
+    return joule.api.Event(int(start_ts), int(end_ts), content={
+        'max power (W)': float(max_power),
+        'average power (W)': float(avg_power),
+        'energy (J)': float(energy)
+    })
+
+
+def ts_to_row(ts: int, dataset_start_ts: int) -> int:
+    # one row per line cycle (60Hz), timestamps are UNIX us
+    return round((ts - dataset_start_ts) / ((1 / 60) * 1e6))
 
 
 def from_json(json_val: dict) -> Run:
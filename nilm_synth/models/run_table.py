@@ -0,0 +1,101 @@
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import numpy as np
+import joule.api
+
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.run import Run, power_event
+from nilm_synth.models.segment_cache import SegmentKey
+
+# per run columns, in constructor order
+COLUMNS = ['start_ts', 'end_ts', 'exemplar', 'meter_id', 'scale_factor',
+           'time_padding', 'steady_state_blocks']
+DTYPES = ['i8', 'i8', 'i8', 'i4', 'f8', 'i8', 'i8']
+
+
+@dataclass
+class RunTable:
+    """The run plan of a dataset stored as NumPy columns, one row per run.
+
+    Exemplars are referred to by their catalog row. A Run is only built for
+    a row when it is rendered (see run), the statistics it computes are
+    stored back into the table with set_stats."""
+    catalog: ExemplarCatalog
+    start_ts: np.ndarray
+    end_ts: np.ndarray
+    exemplar: np.ndarray
+    meter_id: np.ndarray
+    scale_factor: np.ndarray
+    time_padding: np.ndarray
+    steady_state_blocks: np.ndarray
+    # load name by meter id
+    names: Dict[int, Optional[str]] = field(default_factory=dict)
+    # phase of the load by meter id, 0 is phase A
+    phases: Dict[int, int] = field(default_factory=dict)
+
+    def __post_init__(self):
+        for (column, dtype) in zip(COLUMNS, DTYPES):
+            setattr(self, column, np.asarray(getattr(self, column), dtype=dtype))
+        # statistics, set when the run is rendered
+        self.max_power = np.zeros(len(self))
+        self.avg_power = np.zeros(len(self))
+        self.energy = np.zeros(len(self))
+
+    def __len__(self):
+        return len(self.start_ts)
+
+    @classmethod
+    def concatenate(cls, catalog: ExemplarCatalog, tables: List['RunTable']) -> 'RunTable':
+        names = {}
+        phases = {}
+        for table in tables:
+            names.update(table.names)
+            phases.update(table.phases)
+        if len(tables) == 0:
+            return cls(catalog, *[[] for _ in COLUMNS], names=names, phases=phases)
+        return cls(catalog, *[np.concatenate([getattr(table, column) for table in tables])
+                              for column in COLUMNS], names=names, phases=phases)
+
+    def take(self, indices: np.ndarray) -> 'RunTable':
+        # a new table with the runs at [indices], statistics are copied
+        table = RunTable(self.catalog, *[getattr(self, column)[indices] for column in COLUMNS],
+                         names=dict(self.names), phases=dict(self.phases))
+        table.max_power = self.max_power[indices]
+        table.avg_power = self.avg_power[indices]
+        table.energy = self.energy[indices]
+        return table
+
+    def for_meter(self, meter_id: int) -> 'RunTable':
+        return self.take(np.flatnonzero(self.meter_id == meter_id))
+
+    def phase(self, meter_id: int) -> int:
+        return self.phases.get(meter_id, 0)
+
+    def start_order(self) -> np.ndarray:
+        return np.argsort(self.start_ts, kind='stable')
+
+    def run(self, i: int) -> Run:
+        meter_id = int(self.meter_id[i])
+        return Run(self.names.get(meter_id), int(self.start_ts[i]), int(self.end_ts[i]),
+                   self.catalog.instantiate_row(int(self.exemplar[i])), meter_id,
+                   float(self.scale_factor[i]), int(self.time_padding[i]),
+                   int(self.steady_state_blocks[i]))
+
+    def set_stats(self, i: int, run: Run):
+        self.max_power[i] = run.max_power
+        self.avg_power[i] = run.avg_power
+        self.energy[i] = run.energy
+
+    def segments(self) -> List[SegmentKey]:
+        # library segments read when rendering the runs, each one is listed once
+        # runs with the same exemplar read the same segments, key them by exemplar
+        # row and whether the steady state is used
+        keys = np.unique(self.exemplar * 2 + (self.steady_state_blocks > 0))
+        segments = set()
+        for key in keys:
+            segments.update(Run.segments_of(self.catalog.instantiate_row(int(key // 2)), key % 2 == 1))
+        return sorted(segments)
+
+    def to_events(self) -> List[joule.api.Event]:
+        return [power_event(*values) for values in
+                zip(self.start_ts, self.end_ts, self.max_power, self.avg_power, self.energy)]
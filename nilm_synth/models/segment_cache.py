@@ -0,0 +1,233 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import time
+import zlib
+from typing import Optional, Dict, Iterable, Tuple
+
+import numpy as np
+
+from nilm_synth.flow_control import FlowControl
+
+INDEX_FILE = 'index.sqlite'
+MAX_CONCURRENCY = 8  # simultaneous requests to the library node
+
+SegmentKey = Tuple[str, int, int]  # (stream, start, end)
+
+
+class SegmentCache:
+    """On-disk LRU cache of library segments keyed by (stream, start, end).
+
+    Segments are stored as uncompressed .npy files so they can be memory
+    mapped, the index (size, checksum, last use) is kept in a SQLite
+    database in the same directory.
+
+    A [read_only] cache never writes to the directory: misses are not
+    stored, nothing is evicted and use times are not updated, so several
+    processes can read a cache that one process fills. The index must exist."""
+
+    def __init__(self, path: str, max_bytes: int, read_only: bool = False):
+        self.path = os.path.expanduser(path)
+        self.max_bytes = max_bytes
+        self.read_only = read_only
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # keys whose file checksum matched, later hits only check the header
+        self._verified = set()
+        if read_only:
+            self._db = sqlite3.connect('file:%s?mode=ro' % os.path.join(self.path, INDEX_FILE), uri=True)
+            return
+        os.makedirs(self.path, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(self.path, INDEX_FILE))
+        self._db.execute("""CREATE TABLE IF NOT EXISTS segments (
+                                key TEXT PRIMARY KEY,
+                                stream TEXT NOT NULL,
+                                start_ts INTEGER NOT NULL,
+                                end_ts INTEGER NOT NULL,
+                                nbytes INTEGER NOT NULL,
+                                shape TEXT NOT NULL,
+                                dtype TEXT NOT NULL,
+                                crc32 INTEGER NOT NULL,
+                                last_used REAL NOT NULL)""")
+        self._db.commit()
+
+    @property
+    def size(self) -> int:
+        row = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM segments").fetchone()
+        return row[0]
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        if total == 0:
+            return 0.0
+        return self.hits / total
+
+    def get(self, stream: str, start_ts: int, end_ts: int) -> Optional[np.ndarray]:
+        key = _segment_key(stream, start_ts, end_ts)
+        row = self._db.execute("SELECT shape, dtype, crc32 FROM segments WHERE key=?",
+                               (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        try:
+            data = np.load(self._file(key), mmap_mode='r')
+            if str(data.shape) != row[0] or str(data.dtype) != row[1]:
+                raise ValueError("segment does not match the index")
+            # reading the whole file defeats the memory map, check it once per process
+            if key not in self._verified:
+                if zlib.crc32(data) != row[2]:
+                    raise ValueError("segment does not match the index")
+                self._verified.add(key)
+        except (OSError, ValueError):
+            # missing or corrupt file, drop it and fetch the segment again
+            if not self.read_only:
+                self._remove(key)
+            self.misses += 1
+            return None
+        if not self.read_only:
+            self._db.execute("UPDATE segments SET last_used=? WHERE key=?", (time.time(), key))
+            self._db.commit()
+        self.hits += 1
+        return data
+
+    def put(self, stream: str, start_ts: int, end_ts: int, data: np.ndarray):
+        if self.read_only:
+            return
+        data = np.ascontiguousarray(data)
+        if data.nbytes > self.max_bytes:
+            return  # segment can never fit in the cache
+        key = _segment_key(stream, start_ts, end_ts)
+        # write to a temporary file first so a crash never leaves a partial segment,
+        # the name is unique to the process so concurrent writers do not collide
+        tmp_file = '%s.%d.tmp' % (self._file(key), os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp_file, self._file(key))
+        self._db.execute("INSERT OR REPLACE INTO segments VALUES (?,?,?,?,?,?,?,?,?)",
+                         (key, stream, int(start_ts), int(end_ts), data.nbytes, str(data.shape),
+                          str(data.dtype), zlib.crc32(data), time.time()))
+        self._db.commit()
+        self._evict(keep=key)
+
+    def close(self):
+        self._db.close()
+
+    def _evict(self, keep: str):
+        total = self.size
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, nbytes FROM segments WHERE key!=? "
+                                "ORDER BY last_used ASC", (keep,)).fetchall()
+        for key, nbytes in rows:
+            if total <= self.max_bytes:
+                break
+            self._remove(key)
+            self.evictions += 1
+            total -= nbytes
+
+    def _remove(self, key: str):
+        self._verified.discard(key)
+        self._db.execute("DELETE FROM segments WHERE key=?", (key,))
+        self._db.commit()
+        try:
+            os.remove(self._file(key))
+        except FileNotFoundError:
+            pass
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, key + '.npy')
+
+
+class SegmentReader:
+    """Reads segments from a Joule node, checking the cache (if any) first.
+
+    Segments loaded by prefetch are kept in memory until release is called.
+    Concurrent reads of the same segment share a single request and at most
+    [max_concurrency] requests are sent to the node at a time."""
+
+    def __init__(self, node, cache: Optional[SegmentCache] = None,
+                 max_concurrency: int = MAX_CONCURRENCY,
+                 flow_control: Optional[FlowControl] = None):
+        self.node = node
+        self.cache = cache
+        self.max_concurrency = max_concurrency
+        if flow_control is None:
+            flow_control = FlowControl()
+        self.flow_control = flow_control
+        self._segments: Dict[SegmentKey, np.ndarray] = {}
+        self._in_flight: Dict[SegmentKey, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def read(self, stream: str, start_ts: int, end_ts: int) -> np.ndarray:
+        key = (stream, int(start_ts), int(end_ts))
+        if key in self._segments:
+            return self._segments[key]
+        # merge this request with an identical one that is already running
+        if key not in self._in_flight:
+            self._in_flight[key] = asyncio.ensure_future(self._load(key))
+        task = self._in_flight[key]
+        try:
+            return await task
+        finally:
+            self._in_flight.pop(key, None)
+
+    async def prefetch(self, segments: Iterable[SegmentKey]):
+        # load the segments concurrently and keep them in memory for rendering
+        keys = {(stream, int(start_ts), int(end_ts)) for (stream, start_ts, end_ts) in segments}
+        keys = [key for key in keys if key not in self._segments]
+        data = await asyncio.gather(*[self.read(*key) for key in keys])
+        self._segments.update(zip(keys, data))
+
+    def release(self):
+        self._segments = {}
+
+    def held(self, keys: Iterable[SegmentKey]) -> Dict[SegmentKey, np.ndarray]:
+        # segments in memory (loaded by prefetch) for [keys], to pass to another reader
+        return {key: np.asarray(self._segments[key]) for key in keys}
+
+    def hold(self, segments: Dict[SegmentKey, np.ndarray]):
+        # keep segments read elsewhere in memory as if they were prefetched
+        self._segments.update(segments)
+
+    async def _load(self, key: SegmentKey) -> np.ndarray:
+        if self.cache is not None:
+            data = self.cache.get(*key)
+            if data is not None:
+                return data
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        async with self._semaphore:
+            data = await self.flow_control.call(self._fetch, *key)
+        if self.cache is not None:
+            self.cache.put(*key, data)
+        return data
+
+    async def _fetch(self, stream: str, start_ts: int, end_ts: int) -> np.ndarray:
+        pipe = await self.node.data_read(stream, start_ts, end_ts)
+        blocks = []
+        nbytes = 0
+        try:
+            while not pipe.is_empty():
+                sdata = await pipe.read()
+                if len(sdata) == 0:
+                    continue
+                await self.flow_control.pace(sdata.nbytes)
+                nbytes += sdata.nbytes
+                # copy the data out of the pipe buffer before consuming it
+                blocks.append(np.array(sdata['data']))
+                pipe.consume(len(sdata))
+        finally:
+            # a failed read is retried with a new pipe
+            await pipe.close()
+        # only reads that complete are counted
+        self.flow_control.total_bytes += nbytes
+        if len(blocks) == 0:
+            raise ValueError("No data in [%s] between %d and %d" % (stream, start_ts, end_ts))
+        return np.vstack(blocks)
+
+
+def _segment_key(stream: str, start_ts: int, end_ts: int) -> str:
+    return hashlib.sha1(f"{stream}:{int(start_ts)}:{int(end_ts)}".encode()).hexdigest()
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import Optional
 from joule.utilities import human_to_timestamp
 
 
@@ -9,6 +10,9 @@ class Dataset:
     timezone: str
     baseline_stream: str
     noise: float
+    seed: Optional[int] = None
+    baseline_fill: str = 'zero'
+    phases: int = 1
 
 
 def parse_dataset(config):
@@ -34,6 +38,12 @@ def parse_dataset(config):
         baseline_stream = config['baseline']
     else:
         baseline_stream = None
+    # Baseline gap fill setting
+    baseline_fill = 'zero'
+    if 'baseline_fill' in config:
+        baseline_fill = config['baseline_fill']
+        if baseline_fill not in ['zero', 'hold', 'interpolate']:
+            raise Exception("Dataset:baseline_fill must be zero|hold|interpolate")
     # Noise setting
     if 'noise' in config:
         # must end with a w
@@ -53,6 +63,20 @@ def parse_dataset(config):
     else:
         timezone = 'UTC'
 
+    # Phases setting, loads are assigned to a phase of a 3 phase dataset
+    phases = 1
+    if 'phases' in config:
+        phases = config['phases']
+        if phases not in [1, 3]:
+            raise Exception("Dataset:phases must be 1 or 3")
+
+    # Seed setting, datasets with the same seed are identical
+    seed = None
+    if 'seed' in config:
+        seed = config['seed']
+        if type(seed) is not int or seed < 0:
+            raise Exception("Dataset:seed must be a non-negative integer")
+
     return Dataset(start_ts, end_ts, timezone,
                    baseline_stream,
-                   noise)
+                   noise, seed, baseline_fill, phases)
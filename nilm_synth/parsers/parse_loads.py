@@ -1,18 +1,18 @@
-import functools
-from typing import List, Callable
+from typing import Optional, Tuple
 
+import numpy as np
 import numpy.random
-from joule.utilities import timestamp_to_human
-from numpy.random import default_rng
-from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
-from nilm_synth.models.run import Run
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.run_table import RunTable
+from nilm_synth.seeds import SeedStreams
 
 
 def parse_loads(loads_config,
                 dataset_start_ts,
                 dataset_end_ts,
-                rng: numpy.random.Generator,
-                get_instantiated_load: Callable[[int], LibraryLoad]) -> List[Run]:
+                seeds: SeedStreams,
+                catalog: ExemplarCatalog,
+                num_phases: int = 1) -> RunTable:
     runs = []
     meter_id = 2  # aggregate power is on meter1
     for config in loads_config:
@@ -25,8 +25,7 @@ def parse_loads(loads_config,
             raise ValueError("Load missing [load_id]")
         if type(config['load_id']) is not int:
             raise ValueError("Load [load_id] must be an integer")
-        wrapped_get_instantiated_load = functools.partial(get_instantiated_load,
-                                                          load_id=config['load_id'])
+        load_id = config['load_id']
         # Scale Factor setting
         scale_factor = 1.0
         if 'scale_factor' in config:
@@ -36,6 +35,14 @@ def parse_loads(loads_config,
             if config['scale_factor'] <= 0:
                 raise ValueError("Load [scale_factor] must be positive")
             scale_factor = config['scale_factor']
+        # Phase setting
+        phase = 'A'
+        if 'phase' in config:
+            phase = config['phase']
+            if phase not in ['A', 'B', 'C']:
+                raise ValueError("Load [phase] must be A|B|C")
+            if num_phases == 1 and phase != 'A':
+                raise ValueError("Load [phase] must be A in a single phase dataset")
         # Flex settings
         flex_on_pct = 0.05
         flex_off_pct = 0.10
@@ -59,190 +66,175 @@ def parse_loads(loads_config,
             raise ValueError("Load [runs] missing")
         if type('runs') is not str:
             raise ValueError("Load [runs] invalid syntax")
+        # every load has its own random stream
+        rng = seeds.load(meter_id)
         run_type = config['runs'].split(' ')[0]
         run_config = ' '.join(config['runs'].split(' ')[1:])
         if run_type == 'random':
-            runs += _compute_random_runs(run_config, name,
-                                         wrapped_get_instantiated_load, meter_id,
-                                         scale_factor, flex_on_pct,
-                                         flex_power_pct,
-                                         dataset_start_ts, dataset_end_ts,
-                                         rng)
+            runs.append(_compute_random_runs(run_config, name,
+                                             catalog, load_id, meter_id,
+                                             scale_factor, flex_on_pct,
+                                             flex_power_pct,
+                                             dataset_start_ts, dataset_end_ts,
+                                             rng))
         elif run_type == 'periodic':
             flex_off_pct = flex_on_pct  # TODO, add this as a configuration attribute
-            runs += _compute_periodic_runs(run_config, name,
-                                           wrapped_get_instantiated_load, meter_id,
-                                           scale_factor, flex_on_pct, flex_off_pct,
-                                           flex_power_pct,
-                                           dataset_start_ts, dataset_end_ts,
-                                           rng)
+            runs.append(_compute_periodic_runs(run_config, name,
+                                               catalog, load_id, meter_id,
+                                               scale_factor, flex_on_pct, flex_off_pct,
+                                               flex_power_pct,
+                                               dataset_start_ts, dataset_end_ts,
+                                               rng))
         elif run_type == 'fixed':
-            runs += _compute_fixed_runs(run_config, name,
-                                        wrapped_get_instantiated_load, meter_id,
-                                        scale_factor, flex_on_pct,
-                                        flex_power_pct, dataset_start_ts, dataset_end_ts,
-                                        rng)
+            runs.append(_compute_fixed_runs(run_config, name,
+                                            catalog, load_id, meter_id,
+                                            scale_factor, flex_on_pct,
+                                            flex_power_pct, dataset_start_ts, dataset_end_ts,
+                                            rng))
         else:
             raise ValueError("Load [runs] unsupported type, must be fixed|periodic|random")
+        runs[-1].phases[meter_id] = 'ABC'.index(phase)
         meter_id += 1
-    return runs
+    return RunTable.concatenate(catalog, runs)
 
 
-def _compute_random_runs(run_config, name, get_instantiated_load: Callable[[], LibraryLoad],
-                         meter_id,
+def _compute_random_runs(run_config, name, catalog: ExemplarCatalog, load_id, meter_id,
                          scale_factor, flex_on_pct, flex_power,
                          dataset_start_ts, dataset_end_ts,
-                         rng: numpy.random.Generator) -> List[Run]:
+                         rng: numpy.random.Generator) -> RunTable:
     values = run_config.split(':')
     count = int(values[0])
     target_duration = None
     if len(values) == 2:
         target_duration = _parse_time_str(values[1])
-    runs = []
-    for _ in range(count):
-        num_steady_state_blocks = 0
-        # get a new load instance with an exemplar for every run
-        instantiated_load = get_instantiated_load()
-        ex = instantiated_load.exemplar
-        duration = ex.base_duration
-
-        if target_duration is not None and not ex.has_steady_state:
-            raise ValueError("Cannot specify duration for load with no steady state")
-        if target_duration is not None:
-            num_steady_state_blocks = _compute_num_steady_state_blocks(target_duration, ex)
-        # compute the full duration
-        if num_steady_state_blocks > 0:
-            duration += num_steady_state_blocks * ex.steady_state_duration
-
-        # generate a time flex std dev so that 95% of results are within the flex
-        flex_on_time = flex_on_pct * duration
-        time_padding = round(abs(rng.standard_normal(1)[0] * flex_on_time / 2))
-        # generate a start time that does not conflict with other runs
-        # and allows the exemplar to stop before the end of the dataset
-        full_duration = duration + time_padding
-        if full_duration > dataset_end_ts - dataset_start_ts:
-            full_duration = duration  # remove time padding
-            if full_duration > dataset_end_ts - dataset_start_ts:
-                raise ValueError("Load duration is too long for dataset")
-        start_ts = _find_valid_start_ts(full_duration, runs, dataset_start_ts, dataset_end_ts)
+    # pick a new exemplar for every run, a duration is reached by repeating the steady
+    # state so only exemplars that have one are used
+    exemplars = catalog.sample(load_id, count, rng, steady_state=target_duration is not None)
+    (duration, num_steady_state_blocks) = _compute_durations(catalog, exemplars, target_duration)
+    time_padding = _compute_time_padding(duration, flex_on_pct, rng)
+    # make sure every run can stop before the end of the dataset
+    dataset_duration = dataset_end_ts - dataset_start_ts
+    if np.any(duration > dataset_duration):
+        raise ValueError("Load duration is too long for dataset")
+    time_padding[duration + time_padding > dataset_duration] = 0  # remove time padding
+    full_duration = duration + time_padding
+    start_ts = _place_random_runs(full_duration, dataset_start_ts, dataset_end_ts, rng, name)
+    scale_factors = _compute_scale_factors(count, scale_factor, flex_power, rng)
+    return RunTable(catalog, start_ts, start_ts + full_duration, exemplars,
+                    np.full(count, meter_id), scale_factors, time_padding,
+                    num_steady_state_blocks, names={meter_id: name})
 
-        # generate a scale_factor flex
-        flex_scale_factor = (rng.standard_normal(1)[0] * flex_power / 2 + 1) * scale_factor
-        runs.append(Run(name, start_ts, start_ts + duration + time_padding, instantiated_load,
-                        meter_id, flex_scale_factor, time_padding, num_steady_state_blocks))
-    return runs
 
-
-def _compute_periodic_runs(run_config, name,
-                           get_instantiated_load: Callable[[], LibraryLoad], meter_id,
+def _compute_periodic_runs(run_config, name, catalog: ExemplarCatalog, load_id, meter_id,
                            scale_factor, flex_on_pct, flex_off_pct, flex_power,
                            dataset_start_ts, dataset_end_ts,
-                           rng: numpy.random.Generator) -> List[Run]:
+                           rng: numpy.random.Generator) -> RunTable:
     values = run_config.split(':')
     period = _parse_time_str(values[0])
     target_duration = None
     if len(values) == 2:
         target_duration = _parse_time_str(values[1])
-    runs = []
-    current_ts = dataset_start_ts
-    while current_ts < dataset_end_ts:
-        num_steady_state_blocks = 0
-        # get a new load instance with an exemplar for every run
-        instantiated_load = get_instantiated_load()
-        ex = instantiated_load.exemplar
-        duration = ex.base_duration
+    flex_off_time = round(flex_off_pct * period)
+    # a duration is reached by repeating the steady state, only exemplars that have one are used
+    steady_state = target_duration is not None
+    # every run takes at least its duration and a period, plan enough runs to fill the dataset
+    (min_duration, _) = _compute_durations(catalog, catalog.rows(load_id, steady_state), target_duration)
+    count = (dataset_end_ts - dataset_start_ts) // max(np.min(min_duration) + period + flex_off_time, 1) + 1
+    exemplars = catalog.sample(load_id, count, rng, steady_state)
+    (duration, num_steady_state_blocks) = _compute_durations(catalog, exemplars, target_duration)
+    time_padding = _compute_time_padding(duration, flex_on_pct, rng)
+    full_duration = duration + time_padding
+    # generate a time flex std dev so that 95% of results are within the flex
+    wait_time = np.round(np.abs(rng.standard_normal(count) * flex_off_time / 2)).astype('i8') + period
+    # each run starts [flex_off_time] after the previous run ended and waited
+    elapsed = np.cumsum(flex_off_time + full_duration + wait_time) - full_duration - wait_time
+    start_ts = dataset_start_ts + elapsed
+    end_ts = start_ts + full_duration
+    # keep the runs that stop before the end of the dataset
+    count = int(np.searchsorted(end_ts, dataset_end_ts, side='left'))
+    scale_factors = _compute_scale_factors(count, scale_factor, flex_power, rng)
+    return RunTable(catalog, start_ts[:count], end_ts[:count], exemplars[:count],
+                    np.full(count, meter_id), scale_factors, time_padding[:count],
+                    num_steady_state_blocks[:count], names={meter_id: name})
 
-        if target_duration is not None and not ex.has_steady_state:
-            raise ValueError("Cannot specify duration for nilm_identify_load with no steady state")
-        if target_duration is not None:
-            num_steady_state_blocks = _compute_num_steady_state_blocks(target_duration, ex)
-        # compute the full duration
-        if num_steady_state_blocks > 0:
-            duration += num_steady_state_blocks * ex.steady_state_duration
 
-        # generate a time flex std dev so that 95% of results are within the flex
-        flex_on_time = flex_on_pct * duration
-        time_padding = round(abs(rng.standard_normal(1)[0] * flex_on_time / 2))
-        # generate a start time that does not conflict with other runs
-        # and allows the exemplar to stop before the end of the dataset
-        full_duration = duration + time_padding
-
-        flex_off_time = flex_off_pct * period
-        wait_time = round(abs(rng.standard_normal(1)[0] * flex_off_time / 2)) + period
-
-        start_ts = current_ts + flex_off_time
-        end_ts = start_ts + full_duration
-        # make sure the run can stop before the end of the dataset
-        if end_ts >= dataset_end_ts:
-            break
-        current_ts = end_ts + wait_time
-        # generate a scale_factor flex
-        flex_scale_factor = (rng.standard_normal(1)[0] * flex_power / 2 + 1) * scale_factor
-        runs.append(Run(name, start_ts, end_ts, instantiated_load,
-                        meter_id, flex_scale_factor, time_padding, num_steady_state_blocks))
-    return runs
-
-
-def _compute_fixed_runs(runs_config, name,
-                        get_instantiated_load: Callable[[], LibraryLoad], meter_id,
+def _compute_fixed_runs(runs_config, name, catalog: ExemplarCatalog, load_id, meter_id,
                         scale_factor, flex_on_pct, flex_power, dataset_start_ts, dataset_end_ts,
-                        rng: numpy.random.Generator) -> List[Run]:
-    runs = []
+                        rng: numpy.random.Generator) -> RunTable:
+    start_ts = []
+    target_duration = []
     for run_config in runs_config.split(','):
-
         values = run_config.split(':')
-        start_ts = _parse_time_str(values[0]) + dataset_start_ts
-        target_duration = None
-        if len(values) == 2:
-            target_duration = _parse_time_str(values[1])
-        num_steady_state_blocks = 0
-        # get a new load instance with an exemplar for every run
-        instantiated_load = get_instantiated_load()
-        ex = instantiated_load.exemplar
-        duration = ex.base_duration
+        start_ts.append(_parse_time_str(values[0]) + dataset_start_ts)
+        target_duration.append(_parse_time_str(values[1]) if len(values) == 2 else None)
+    count = len(start_ts)
+    start_ts = np.array(start_ts, dtype='i8')
+    # a duration is reached by repeating the steady state, only exemplars that have one
+    # are used for runs with a duration
+    has_duration = np.array([target is not None for target in target_duration])
+    for target in set(target_duration) - {None}:
+        # fail on every exemplar that cannot reach the duration, not only the ones drawn
+        _compute_durations(catalog, catalog.rows(load_id, steady_state=True), target)
+    exemplars = np.empty(count, dtype='i8')
+    exemplars[~has_duration] = catalog.sample(load_id, int(np.sum(~has_duration)), rng)
+    exemplars[has_duration] = catalog.sample(load_id, int(np.sum(has_duration)), rng, steady_state=True)
+    # runs without a duration use the exemplar as recorded
+    duration = np.empty(count, dtype='i8')
+    num_steady_state_blocks = np.empty(count, dtype='i8')
+    for target in set(target_duration):
+        idx = np.array([value == target for value in target_duration])
+        (duration[idx], num_steady_state_blocks[idx]) = _compute_durations(catalog, exemplars[idx], target)
+    time_padding = _compute_time_padding(duration, flex_on_pct, rng)
+    end_ts = start_ts + duration + time_padding
+    # make sure the runs can stop before the end of the dataset
+    if np.any(end_ts >= dataset_end_ts):
+        raise ValueError("Fixed load run time extends passed the end of the dataset")
+    scale_factors = _compute_scale_factors(count, scale_factor, flex_power, rng)
+    return RunTable(catalog, start_ts, end_ts, exemplars,
+                    np.full(count, meter_id), scale_factors, time_padding,
+                    num_steady_state_blocks, names={meter_id: name})
 
-        if target_duration is not None and not ex.has_steady_state:
-            raise ValueError("Cannot specify duration for nilm_identify_load with no steady state")
-        if target_duration is not None:
-            num_steady_state_blocks = _compute_num_steady_state_blocks(target_duration, ex)
-        # compute the full duration
-        if num_steady_state_blocks > 0:
-            duration += num_steady_state_blocks * ex.steady_state_duration
 
-        # generate a time flex std dev so that 95% of results are within the flex
-        flex_on_time = flex_on_pct * duration
-        time_padding = round(abs(rng.standard_normal(1)[0] * flex_on_time / 2))
-        # generate a start time that does not conflict with other runs
-        # and allows the exemplar to stop before the end of the dataset
-        full_duration = duration + time_padding
-        end_ts = start_ts + full_duration
-        # make sure the run can stop before the end of the dataset
-        if end_ts >= dataset_end_ts:
-            raise ValueError("Fixed load run time extends passed the end of the dataset")
-        # generate a scale_factor flex
-        flex_scale_factor = (rng.standard_normal(1)[0] * flex_power / 2 + 1) * scale_factor
-        runs.append(Run(name, start_ts, end_ts, instantiated_load,
-                        meter_id, flex_scale_factor, time_padding, num_steady_state_blocks))
-    return runs
+def _compute_durations(catalog: ExemplarCatalog, exemplars: np.ndarray,
+                       target_duration: Optional[int]) -> Tuple[np.ndarray, np.ndarray]:
+    # run durations and steady state blocks, runs are stretched to the target duration
+    # with an integer number of steady state blocks
+    bounds = catalog.bounds(exemplars)
+    (on_start, on_end, ss_start, ss_end, off_start, off_end) = bounds.T
+    duration = (on_end - on_start) + (off_end - off_start)
+    num_steady_state_blocks = np.zeros(len(exemplars), dtype='i8')
+    if target_duration is None:
+        return duration, num_steady_state_blocks
+    if not np.all(catalog.has_steady_state(exemplars)):
+        raise ValueError("Cannot specify duration for load with no steady state")
+    steady_state_duration = ss_end - ss_start
+    num_steady_state_blocks = np.round((target_duration - duration) / steady_state_duration).astype('i8')
+    if np.any(num_steady_state_blocks < 0):
+        raise ValueError("Load duration is too short")
+    return duration + num_steady_state_blocks * steady_state_duration, num_steady_state_blocks
 
 
-def _find_valid_start_ts(duration, other_runs, dataset_start_ts, dataset_end_ts):
-    MAX_TRIES = 30
-    rng = default_rng()
+def _compute_time_padding(duration: np.ndarray, flex_on_pct, rng: numpy.random.Generator) -> np.ndarray:
+    # generate a time flex std dev so that 95% of results are within the flex
+    flex_on_time = flex_on_pct * duration
+    return np.round(np.abs(rng.standard_normal(len(duration)) * flex_on_time / 2)).astype('i8')
 
-    for _ in range(MAX_TRIES):
-        start_ts = round(rng.uniform(dataset_start_ts, dataset_end_ts - duration, 1)[0])
-        end_ts = start_ts + duration
-        conflict = False
-        for run in other_runs:
-            if ((run.start_ts < start_ts < run.end_ts) or
-                    (run.start_ts < end_ts < run.end_ts)):
-                conflict = True
-                break
-        if not conflict:
-            break
-    else:
-        raise ValueError("Could fit requested number of random runs for nilm_identify_load in dataset")
+
+def _compute_scale_factors(count, scale_factor, flex_power, rng: numpy.random.Generator) -> np.ndarray:
+    return (rng.standard_normal(count) * flex_power / 2 + 1) * scale_factor
+
+
+def _place_random_runs(durations: np.ndarray, dataset_start_ts, dataset_end_ts,
+                       rng: numpy.random.Generator, name) -> np.ndarray:
+    # runs of a load cannot overlap: lay them out in a random order and split the
+    # unused time between them at uniformly distributed points
+    unused_time = (dataset_end_ts - dataset_start_ts) - int(np.sum(durations))
+    if unused_time < 0:
+        raise ValueError("Could not fit requested number of random runs for [%s] in dataset" % name)
+    order = rng.permutation(len(durations))
+    gaps = np.sort(rng.integers(0, unused_time + 1, size=len(durations)))
+    start_ts = np.empty(len(durations), dtype='i8')
+    start_ts[order] = dataset_start_ts + gaps + np.cumsum(durations[order]) - durations[order]
     return start_ts
 
 
@@ -282,17 +274,3 @@ def _get_percentage(str_value: str):
         raise ValueError("flex values must be percentages such as 35%")
 
     return pct_val / 100.0
-
-
-def _compute_num_steady_state_blocks(target_duration: int, exemplar: LibraryExemplar):
-    # make sure the nilm_identify_load has a steady state
-    if not exemplar.has_steady_state:
-        raise ValueError("[%s] does not have a steady state, duration cannot be changed" % exemplar.name)
-    # convert argument to microseconds
-    target_steady_state_duration = target_duration - exemplar.base_duration
-    # use an integer number of steady state blocks
-    num_steady_state_blocks = round(target_steady_state_duration /
-                                    exemplar.steady_state_duration)
-    if num_steady_state_blocks < 0:
-        raise ValueError("Load duration is too short")
-    return num_steady_state_blocks
@@ -1,15 +1,75 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
 class Resources:
-    library_database: str
     output_stream: str
     output_file: str
+    # the library is read from the database and library node, or from a bundle file
+    library_database: str = ""
+    library_bundle: str = ""
     baseline_node: str = ""
     library_node: str = ""
     output_node: str = ""
+    cache_dir: str = ""  # no exemplar cache by default
+    cache_size: int = 1024 ** 3
+    prefetch_concurrency: int = 8  # simultaneous library node requests
+    # maximum transfer rate (bytes per second) for each node, unlimited if omitted
+    flow_control: dict = field(default_factory=dict)
+    # store the time axis in the raw file instead of computing it
+    materialize_timestamps: bool = False
+    # write windows of data straight to the outputs instead of building a raw file
+    streaming: bool = False
+    # working space for the raw data, an HDF5 file or memory mapped files
+    raw_backend: str = "hdf5"  # hdf5|memmap
+    # processes rendering time shards of the dataset in parallel (needs the memmap backend)
+    workers: int = 1
+    # storage layout of the raw file data sets
+    raw_chunk_rows: int = 10000
+    raw_compression: str = "none"  # none|lzf|gzip
 
 
 def parse_resources(config):
-    return Resources(**config)
+    resources = Resources(**config)
+    if resources.library_database == "" and resources.library_bundle == "":
+        raise ValueError("Resources: specify a library_database or a library_bundle")
+    if type(resources.cache_size) is str:
+        resources.cache_size = _parse_size(resources.cache_size, 'cache_size')
+    if type(resources.cache_size) is not int or resources.cache_size <= 0:
+        raise ValueError("Resources:cache_size must be a positive size (eg 500MB)")
+    if type(resources.prefetch_concurrency) is not int or resources.prefetch_concurrency < 1:
+        raise ValueError("Resources:prefetch_concurrency must be a positive integer")
+    if type(resources.raw_chunk_rows) is not int or resources.raw_chunk_rows <= 0:
+        raise ValueError("Resources:raw_chunk_rows must be a positive integer")
+    if resources.raw_backend not in ['hdf5', 'memmap']:
+        raise ValueError("Resources:raw_backend must be hdf5|memmap")
+    if type(resources.workers) is not int or resources.workers < 1:
+        raise ValueError("Resources:workers must be a positive integer")
+    if resources.workers > 1 and (resources.streaming or resources.raw_backend != 'memmap'):
+        # the workers write into the shared memory mapped working files
+        raise ValueError("Resources:workers above 1 require raw_backend memmap and no streaming")
+    if resources.raw_compression not in ['none', 'lzf', 'gzip']:
+        raise ValueError("Resources:raw_compression must be none|lzf|gzip")
+    for node, rate in resources.flow_control.items():
+        if node not in ['library_node', 'baseline_node', 'output_node']:
+            raise ValueError("Resources:flow_control [%s] must be library_node|baseline_node|output_node" % node)
+        if type(rate) is str:
+            # transfer rates are specified per second (eg 20MB/s)
+            rate = _parse_size(rate.split('/')[0], 'flow_control')
+        if type(rate) is not int or rate <= 0:
+            raise ValueError("Resources:flow_control [%s] must be a positive rate (eg 20MB/s)" % node)
+        resources.flow_control[node] = rate
+    return resources
+
+
+def _parse_size(size_str: str, setting: str):
+    # supported units: B, KB, MB, GB (powers of 1024)
+    units = {'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3, 'B': 1}
+    size_str = size_str.strip().upper()
+    for unit, multiplier in units.items():
+        if size_str.endswith(unit):
+            try:
+                return int(float(size_str[:-len(unit)]) * multiplier)
+            except ValueError:
+                break
+    raise ValueError("Resources:%s [%s] must be a size such as 500MB" % (setting, size_str))
@@ -0,0 +1,73 @@
+import contextlib
+import json
+import resource
+import sys
+import time
+from dataclasses import dataclass, asdict
+from typing import Dict
+
+
+@dataclass
+class StageStats:
+    seconds: float = 0.0
+    calls: int = 0
+    rows: int = 0
+
+    @property
+    def rows_per_second(self) -> float:
+        if self.seconds == 0:
+            return 0.0
+        return self.rows / self.seconds
+
+
+class Profiler:
+    """Wall clock time spent in each stage of a build.
+
+    A stage may be entered many times (once per block or submeter), its time,
+    calls and rows add up. Counters hold other totals such as bytes
+    transferred and cache hits. The report is written as JSON so runs can be
+    compared, a stage entered inside another is also counted in the outer
+    stage."""
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, float] = {}
+        self._start = time.monotonic()
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rows: int = 0):
+        stats = self.stages.setdefault(name, StageStats())
+        start = time.perf_counter()
+        try:
+            # rows may also be added to the returned stats when they are only known at the end
+            yield stats
+        finally:
+            stats.seconds += time.perf_counter() - start
+            stats.calls += 1
+            stats.rows += rows
+
+    def count(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def report(self) -> dict:
+        return {
+            'total_seconds': time.monotonic() - self._start,
+            'peak_rss_bytes': peak_rss(),
+            'stages': {name: dict(asdict(stats), rows_per_second=stats.rows_per_second)
+                       for (name, stats) in self.stages.items()},
+            'counters': dict(self.counters),
+        }
+
+    def write(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def peak_rss() -> int:
+    # maximum resident set size in bytes of the process or of any child process
+    # it waited for (the workers of a sharded build)
+    max_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return max_rss  # already in bytes
+    return max_rss * 1024
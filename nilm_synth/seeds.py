@@ -0,0 +1,36 @@
+from typing import Optional
+import numpy as np
+
+NOISE_BLOCK_ROWS = 60 * 60 * 10  # noise is generated in fixed 10 minute blocks
+
+# first spawn key of each kind of stream
+LOAD_STREAMS = 0
+NOISE_STREAMS = 1
+WORKER_STREAMS = 2
+
+
+class SeedStreams:
+    """Independent random generators derived from the dataset seed.
+
+    Each generator is keyed by its kind and index (the meter of a load, the
+    block of noise, the id of a worker) through the SeedSequence spawn key,
+    so it does not depend on how many other generators were created or in
+    which order. Data generated serially or split across processes is the
+    same for a given seed. With no seed, fresh entropy is drawn, use [seed]
+    to reproduce the dataset."""
+
+    def __init__(self, seed: Optional[int] = None):
+        self.seed = np.random.SeedSequence(seed).entropy
+
+    def load(self, meter_id: int) -> np.random.Generator:
+        return self._generator(LOAD_STREAMS, meter_id)
+
+    def noise_block(self, block: int) -> np.random.Generator:
+        return self._generator(NOISE_STREAMS, block)
+
+    def worker(self, worker_id: int) -> np.random.Generator:
+        return self._generator(WORKER_STREAMS, worker_id)
+
+    def _generator(self, *spawn_key) -> np.random.Generator:
+        return np.random.default_rng(np.random.SeedSequence(self.seed, spawn_key=spawn_key))
+
@@ -0,0 +1,286 @@
+import asyncio
+import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import Deque, Dict, List, Optional, Tuple
+import click
+import joule.api
+import joule.errors
+import numpy as np
+from sqlalchemy import create_engine
+
+from nilm_synth.file_node import FileNode, FileStream, get_node
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.models.catalog import ExemplarCatalog, read_library
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar, metadata
+from nilm_synth.models.run import Run
+
+VERSION = 0.6
+MANIFEST_FILE = 'manifest.json'
+MANIFEST_SAVE_SECONDS = 5  # completed intervals are recorded at least this often
+MAX_CONCURRENCY = 8  # simultaneous downloads from the library node
+
+Interval = Tuple[int, int]  # [start, end) in UNIX us
+
+
+@dataclass
+class SyncStats:
+    streams: int = 0
+    intervals: int = 0  # intervals downloaded
+    rows: int = 0
+    bytes: int = 0
+    skipped: int = 0  # intervals with no data on the library node
+    reset_streams: int = 0  # streams rewritten on the library node, downloaded again
+
+
+class SyncManifest:
+    """What a library mirror holds: the extent of each library stream when it
+    was last synced and the intervals copied from it.
+
+    Kept as JSON in the mirror directory, it is written atomically so an
+    interrupted sync resumes from the last save."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.streams: Dict[str, dict] = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                self.streams = json.load(f)['streams']
+
+    def extent(self, stream: str) -> Optional[dict]:
+        return self.streams.get(stream, {}).get('extent')
+
+    def intervals(self, stream: str) -> List[Interval]:
+        return [tuple(interval) for interval in self.streams.get(stream, {}).get('intervals', [])]
+
+    def set_extent(self, stream: str, extent: dict):
+        self.streams.setdefault(stream, {'intervals': []})['extent'] = extent
+
+    def reset(self, stream: str):
+        self.streams[stream] = {'intervals': []}
+
+    def add_interval(self, stream: str, interval: Interval):
+        entry = self.streams.setdefault(stream, {'intervals': []})
+        entry['intervals'] = [list(i) for i in merge_intervals(self.intervals(stream) + [interval])]
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'streams': self.streams}, f)
+        os.replace(tmp_path, self.path)
+
+
+async def sync_library(loads: List[LibraryLoad], exemplars: List[LibraryExemplar],
+                       node, mirror: FileNode, max_concurrency: int = MAX_CONCURRENCY,
+                       flow_control: Optional[FlowControl] = None) -> SyncStats:
+    """Copy the exemplar intervals of the library from [node] to [mirror].
+
+    The extent of each library stream (data_stream_info) is compared with
+    the manifest of the mirror. If the stream only grew, intervals that are
+    already mirrored are kept and only new ones are downloaded. If it was
+    rewritten (its start moved or it lost rows) the mirrored copy is
+    dropped and downloaded again. Only the extent is compared, a rewrite
+    that keeps the start and does not lose rows or shorten the stream is
+    not detected, remove the mirror to download it again. Intervals with
+    no data before the end of the stream are recorded as mirrored. Intervals are downloaded concurrently and
+    written to each mirror stream in time order, they are recorded in the
+    manifest once written and the rows of an interval are replaced when it
+    is written so an interrupted sync can be run again."""
+    if flow_control is None:
+        flow_control = FlowControl()
+    stats = SyncStats()
+    manifest = SyncManifest(os.path.join(mirror.root, MANIFEST_FILE))
+    wanted = library_intervals(loads, exemplars)
+    downloads: List[Tuple[str, Interval]] = []
+    for (stream, intervals) in sorted(wanted.items()):
+        info = await flow_control.call(node.data_stream_info, stream)
+        extent = {'start': info.start, 'end': info.end, 'rows': info.rows}
+        try:
+            await mirror.data_stream_get(stream)
+        except joule.errors.ApiError:
+            await _create_mirror_stream(node, mirror, stream, flow_control)
+            manifest.reset(stream)  # nothing is mirrored, the stream is new or was removed
+        if _was_rewritten(manifest.extent(stream), extent):
+            await mirror.data_delete(stream)
+            manifest.reset(stream)
+            stats.reset_streams += 1
+        manifest.set_extent(stream, extent)
+        missing = subtract_intervals(intervals, manifest.intervals(stream))
+        downloads += [(stream, interval) for interval in missing]
+        stats.streams += 1
+    manifest.save()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    last_save = time.monotonic()
+    # intervals complete in any order but are written in time order for each stream,
+    # so rows are appended to the mirror instead of moving the rows after them
+    queues: Dict[str, Deque[Interval]] = {}
+    for (stream, interval) in downloads:
+        queues.setdefault(stream, deque()).append(interval)
+    locks = {stream: asyncio.Lock() for stream in queues}
+    completed: Dict[Tuple[str, Interval], np.ndarray] = {}
+
+    async def download(stream: str, interval: Interval):
+        async with semaphore:
+            completed[(stream, interval)] = await flow_control.call(_read_interval, node, stream,
+                                                                    interval, flow_control)
+        async with locks[stream]:
+            queue = queues[stream]
+            while len(queue) > 0 and (stream, queue[0]) in completed:
+                await write(stream, queue[0], completed.pop((stream, queue[0])))
+                queue.popleft()
+
+    async def write(stream: str, interval: Interval, sdata: np.ndarray):
+        nonlocal last_save
+        if len(sdata) == 0:
+            stats.skipped += 1
+            # streams are only appended to, so an interval before the end of the stream
+            # stays empty, one after it is downloaded again by the next sync
+            if not _before_end(manifest.extent(stream), interval):
+                return
+        else:
+            # remove rows left by an interrupted sync before writing the interval
+            await mirror.data_delete(stream, *interval)
+            mirror.insert(stream, sdata)
+            stats.intervals += 1
+            stats.rows += len(sdata)
+            stats.bytes += sdata.nbytes
+        manifest.add_interval(stream, interval)
+        if time.monotonic() - last_save > MANIFEST_SAVE_SECONDS:
+            manifest.save()
+            last_save = time.monotonic()
+
+    tasks = [asyncio.ensure_future(download(*item)) for item in downloads]
+    try:
+        with click.progressbar(length=len(downloads)) as bar:
+            for task in asyncio.as_completed(tasks):
+                await task
+                bar.update(1)
+    finally:
+        # if a download failed the others are stopped, the next sync picks them up
+        for task in tasks:
+            task.cancel()
+        manifest.save()
+    return stats
+
+
+def library_intervals(loads: List[LibraryLoad], exemplars: List[LibraryExemplar]) -> Dict[str, List[Interval]]:
+    # the intervals of each library stream read when rendering the exemplars
+    catalog = ExemplarCatalog(loads, exemplars)
+    intervals: Dict[str, List[Interval]] = {}
+    for row in range(len(catalog)):
+        load = catalog.instantiate_row(row)
+        for (stream, start_ts, end_ts) in Run.segments_of(load, load.exemplar.has_steady_state):
+            intervals.setdefault(stream, []).append((start_ts, end_ts))
+    return {stream: merge_intervals(stream_intervals) for (stream, stream_intervals) in intervals.items()}
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    # sorted intervals with overlapping and adjacent ones joined
+    merged: List[Interval] = []
+    for (start, end) in sorted(intervals):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def subtract_intervals(intervals: List[Interval], removed: List[Interval]) -> List[Interval]:
+    # the parts of [intervals] not covered by [removed], both are merged
+    result = []
+    for (start, end) in intervals:
+        for (removed_start, removed_end) in removed:
+            if removed_end <= start or removed_start >= end:
+                continue
+            if removed_start > start:
+                result.append((start, removed_start))
+            start = max(start, removed_end)
+            if start >= end:
+                break
+        if start < end:
+            result.append((start, end))
+    return result
+
+
+def _was_rewritten(previous: Optional[dict], extent: dict) -> bool:
+    # library streams are only appended to, anything else means the mirrored rows may be stale.
+    # Only the extent is compared, rows replaced in place are not detected
+    if previous is None or previous['rows'] == 0:
+        return False
+    return (extent['rows'] < previous['rows'] or extent['start'] != previous['start'] or
+            extent['end'] < previous['end'])
+
+
+def _before_end(extent: Optional[dict], interval: Interval) -> bool:
+    # the stream has data at or after the end of [interval]
+    return extent is not None and extent['end'] is not None and interval[1] <= extent['end']
+
+
+async def _create_mirror_stream(node, mirror: FileNode, stream: str, flow_control: FlowControl):
+    source = await flow_control.call(node.data_stream_get, stream)
+    (datatype, _) = source.layout.rsplit('_', 1)
+    if isinstance(source, FileStream):
+        elements = [joule.api.Element(name=name, units='') for name in source.elements]
+    else:
+        elements = source.elements
+    (folder, _, name) = stream.rpartition('/')
+    await mirror.data_stream_create(joule.api.DataStream(name, datatype=datatype, elements=elements), folder)
+
+
+async def _read_interval(node, stream: str, interval: Interval, flow_control: FlowControl) -> np.ndarray:
+    # the timestamps and data of the stream in [interval]
+    pipe = await node.data_read(stream, *interval)
+    blocks = []
+    while not pipe.is_empty():
+        sdata = await pipe.read()
+        if len(sdata) == 0:
+            continue
+        await flow_control.throttle(sdata.nbytes)
+        # copy the data out of the pipe buffer before consuming it
+        blocks.append(np.array(sdata))
+        pipe.consume(len(sdata))
+    await pipe.close()
+    if len(blocks) == 0:
+        return np.zeros(0)
+    return np.concatenate(blocks)
+
+
+async def main(library_database, library_node, mirror_path, max_concurrency):
+    print(f"NILM-Synth Library Sync v{VERSION}")
+    if not os.path.isfile(library_database):
+        raise click.ClickException("Library database [%s] does not exist" % library_database)
+    engine = create_engine('sqlite:///%s' % library_database)
+    metadata.create_all(engine)
+    conn = engine.connect()
+    (loads, exemplars) = read_library(conn)
+    conn.close()
+    print(f"syncing {len(loads)} loads and {len(exemplars)} exemplars to {mirror_path}")
+    os.makedirs(mirror_path, exist_ok=True)
+    node = get_node(library_node)
+    mirror = FileNode(mirror_path)
+    try:
+        stats = await sync_library(loads, exemplars, node, mirror, max_concurrency)
+    finally:
+        await node.close()
+        await mirror.close()
+    print(f"\n{stats.streams} streams: {stats.intervals} intervals downloaded "
+          f"({stats.rows} rows, {stats.bytes / 1024 ** 2:.1f} MB), {stats.skipped} with no data, "
+          f"{stats.reset_streams} streams downloaded again")
+    print(f"use library_node: {mirror.name}")
+
+
+@click.command()
+@click.option("-d", "--database", "library_database", help="library SQLite database", required=True)
+@click.option("-n", "--node", "library_node", default="",
+              help="library node name (default node if omitted)")
+@click.option("-m", "--mirror", "mirror_path", help="local mirror directory", required=True)
+@click.option("-j", "--concurrency", "max_concurrency", default=MAX_CONCURRENCY,
+              help="simultaneous downloads")
+def run_main(library_database, library_node, mirror_path, max_concurrency):
+    asyncio.run(main(library_database, library_node, mirror_path, max_concurrency))
+
+
+if __name__ == "__main__":
+    run_main()
@@ -30,13 +30,15 @@ setup(
     install_requires=['joule'],
     test_suite='tests',
     namespace_packages=[],
-    packages=find_packages(exclude=["tests","tests.*"]),
+    packages=find_packages(exclude=["tests", "tests.*", "benchmarks", "benchmarks.*"]),
     include_package_data=True,
 
     entry_points={
         'console_scripts': [
             'nilm-synth = nilm_synth.main:run_main',
             'nilm-exemplars = nilm_synth.extract_exemplars:run_main',
+            'nilm-synth-bundle = nilm_synth.export_bundle:run_main',
+            'nilm-synth-sync = nilm_synth.sync_library:run_main',
             'nilm-synth-build-docs = nilm_synth.build_docs:main'
         ]
     },
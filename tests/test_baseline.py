@@ -0,0 +1,115 @@
+import unittest
+import tempfile
+import asyncio
+import numpy as np
+
+from nilm_synth.builders.baseline import BaselineStream, align_samples, WINDOW_US
+from nilm_synth.models.segment_cache import SegmentCache
+
+LINE_CYCLE = 1e6 / 60
+
+
+class TestBaseline(unittest.TestCase):
+
+    def test_aligns_samples_by_timestamp(self):
+        grid_ts = (np.arange(10) * LINE_CYCLE).astype('i8')
+        # jittered samples for rows 0-3 and 7-9, rows 4-6 are a gap
+        rows = np.array([0, 1, 2, 3, 7, 8, 9])
+        timestamps = grid_ts[rows] + 1000
+        data = np.column_stack([rows * 10.0] * 8)
+        result = align_samples(timestamps, data, grid_ts, 'zero')
+        np.testing.assert_array_equal(result[rows, 0], rows * 10)
+        np.testing.assert_array_equal(result[4:7], 0)
+        result = align_samples(timestamps, data, grid_ts, 'hold')
+        np.testing.assert_array_equal(result[4:7, 0], 30)
+        result = align_samples(timestamps, data, grid_ts, 'interpolate')
+        # the samples are 1000us late so the interpolated values are slightly low
+        np.testing.assert_allclose(result[4:7, 0], [40, 50, 60], atol=1)
+        # rows past the last sample are not interpolated
+        result = align_samples(timestamps, data, grid_ts + int(LINE_CYCLE * 5), 'interpolate')
+        np.testing.assert_array_equal(result[5:], 0)
+
+    def test_uses_the_last_of_duplicate_samples(self):
+        grid_ts = (np.arange(6) * LINE_CYCLE).astype('i8')
+        # rows 1-4 are a gap with a repeated sample on each side
+        timestamps = grid_ts[[0, 0, 5, 5]]
+        data = np.column_stack([[10.0, 20.0, 60.0, 70.0]] * 8)
+        with np.errstate(divide='raise', invalid='raise'):
+            result = align_samples(timestamps, data, grid_ts, 'interpolate')
+        np.testing.assert_allclose(result[:, 0], [20, 30, 40, 50, 60, 70], atol=0.01)
+        result = align_samples(timestamps, data, grid_ts, 'hold')
+        np.testing.assert_array_equal(result[:, 0], [20, 20, 20, 20, 20, 70])
+
+    def test_reads_through_the_cache(self):
+        start_ts = 100 * WINDOW_US - int(10 * LINE_CYCLE)
+        # three phase stream with a sample per line cycle, phase B is 1W
+        timestamps = (start_ts + np.arange(40) * LINE_CYCLE).astype('i8')
+        data = np.zeros((40, 24), dtype='float32')
+        data[:, 8:16] = 1
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = SegmentCache(cache_dir, 1024 ** 2)
+            for expected_reads in [3 + 1, 0]:
+                node = _StreamNode(timestamps, data)
+                baseline = BaselineStream(node, "/house1:B", start_ts, start_ts + WINDOW_US,
+                                          cache=cache, fill='zero')
+
+                async def run():
+                    await baseline.open()
+                    # the rows cross a window boundary
+                    blocks = [await baseline.read(15), await baseline.read(35)]
+                    await baseline.close()
+                    return np.vstack(blocks)
+
+                result = asyncio.run(run())
+                self.assertEqual(node.reads, expected_reads)
+                np.testing.assert_array_equal(result[:40], 1)
+                np.testing.assert_array_equal(result[40:], 0)
+            cache.close()
+
+    def test_reads_every_phase_of_a_3_phase_dataset(self):
+        start_ts = 100 * WINDOW_US
+        timestamps = (start_ts + np.arange(40) * LINE_CYCLE).astype('i8')
+        data = np.repeat([1, 2, 3], 8)[None, :] * np.ones((40, 1), dtype='float32')
+        baseline = BaselineStream(_StreamNode(timestamps, data), "/house1", start_ts,
+                                  start_ts + WINDOW_US, num_phases=3)
+        result = asyncio.run(baseline.read(40))
+        np.testing.assert_array_equal(result, data)
+        with self.assertRaises(ValueError):
+            BaselineStream(_StreamNode(timestamps, data), "/house1:B", start_ts,
+                           start_ts + WINDOW_US, num_phases=3)
+
+
+class _StreamNode:
+    # minimal stand in for the data_stream_get and data_read methods of a joule node
+    name = 'node'
+
+    def __init__(self, timestamps, data):
+        self.sdata = np.empty(len(data), dtype=[('timestamp', '<i8'), ('data', '<f4', (24,))])
+        self.sdata['timestamp'] = timestamps
+        self.sdata['data'] = data
+        self.reads = 0
+
+    async def data_stream_get(self, path):
+        return path
+
+    async def data_read(self, path, start, end):
+        self.reads += 1
+        sdata = self.sdata[(self.sdata['timestamp'] >= start) & (self.sdata['timestamp'] < end)]
+        return _Pipe(sdata)
+
+
+class _Pipe:
+    def __init__(self, sdata):
+        self.sdata = sdata
+
+    def is_empty(self):
+        return len(self.sdata) == 0
+
+    async def read(self):
+        return self.sdata
+
+    def consume(self, num_rows):
+        self.sdata = self.sdata[num_rows:]
+
+    async def close(self):
+        pass
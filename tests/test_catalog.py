@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+from sqlalchemy import create_engine
+
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.library_types import (
+    LibraryLoad, library_load_table,
+    LibraryExemplar, library_exemplar_table, metadata)
+
+
+class TestExemplarCatalog(unittest.TestCase):
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        metadata.create_all(engine)
+        self.conn = engine.connect()
+        for (load_id, name) in [(1, 'Fridge'), (2, 'Space Heater')]:
+            self.conn.execute(library_load_table.insert().values(
+                id=load_id, stream=f'/Library/{name}', name=name, description='',
+                image='', appliance_type=name.lower()))
+        # the fridge has a steady state, the space heater exemplars do not
+        self.conn.execute(library_exemplar_table.insert().values(
+            id=1, load_id=1, on_start=0, on_end=10, ss_start=10, ss_end=30, off_start=30, off_end=40))
+        for ex_id in range(2, 5):
+            self.conn.execute(library_exemplar_table.insert().values(
+                id=ex_id, load_id=2, on_start=100 * ex_id, on_end=100 * ex_id + 5,
+                off_start=100 * ex_id + 5, off_end=100 * ex_id + 9))
+
+    def tearDown(self):
+        self.conn.close()
+
+    def test_instantiates_loads(self):
+        catalog = ExemplarCatalog.from_connection(self.conn)
+        self.assertEqual(len(catalog), 4)
+        self.assertEqual(catalog.appliance_type(2), 'space heater')
+        rng = np.random.default_rng(seed=1)
+        load = catalog.instantiate(1, rng)
+        self.assertIsInstance(load, LibraryLoad)
+        self.assertEqual(load.stream, '/Library/Fridge')
+        self.assertEqual(load.exemplar, LibraryExemplar(0, 10, 10, 30, 30, 40, load_id=1, id=1))
+        self.assertTrue(load.exemplar.has_steady_state)
+        # every run gets its own load instance
+        self.assertIsNot(catalog.instantiate(1, rng), load)
+        with self.assertRaises(ValueError):
+            catalog.instantiate(3, rng)
+
+    def test_samples_every_exemplar(self):
+        catalog = ExemplarCatalog.from_connection(self.conn)
+        self.assertEqual(catalog.num_exemplars(2), 3)
+        rng = np.random.default_rng(seed=2)
+        exemplars = [catalog.instantiate(2, rng).exemplar for _ in range(100)]
+        self.assertEqual({ex.id for ex in exemplars}, {2, 3, 4})
+        self.assertFalse(any(ex.has_steady_state for ex in exemplars))
+        # the same seed picks the same exemplars
+        rng = np.random.default_rng(seed=2)
+        self.assertEqual([catalog.instantiate(2, rng).exemplar.id for _ in range(100)],
+                         [ex.id for ex in exemplars])
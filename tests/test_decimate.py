@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+import pandas as pd
+
+from nilm_synth.builders.decimate import decimate_power, PowerDecimator
+
+
+class TestDecimate(unittest.TestCase):
+
+    def setUp(self):
+        num_samples = 60 * 100 + 17
+        start_ts = 1625137200123456  # not aligned to a second
+        self.timestamps = (start_ts + np.arange(num_samples) * (1e6 / 60)).astype('i8')
+        self.active = np.random.rand(num_samples).astype('float32')
+        self.reactive = np.random.rand(num_samples).astype('float32')
+
+    def test_matches_pandas_resample(self):
+        result = decimate_power(self.timestamps, self.active, self.reactive)
+        np.testing.assert_allclose(result, self._resample(self.timestamps, self.active, self.reactive))
+
+    def test_streams_ragged_blocks(self):
+        decimator = PowerDecimator()
+        results = []
+        for idx in range(0, len(self.timestamps), 997):
+            block = np.s_[idx:idx + 997]
+            results.append(decimator.process(self.timestamps[block], self.active[block],
+                                             self.reactive[block]))
+        results.append(decimator.flush())
+        np.testing.assert_allclose(np.vstack(results),
+                                   decimate_power(self.timestamps, self.active, self.reactive))
+
+    def test_skips_empty_seconds_in_gaps(self):
+        keep = np.r_[:500, 1000:len(self.timestamps)]
+        result = decimate_power(self.timestamps[keep], self.active[keep], self.reactive[keep])
+        expected = self._resample(self.timestamps[keep], self.active[keep], self.reactive[keep])
+        np.testing.assert_allclose(result, expected)
+
+    @staticmethod
+    def _resample(timestamps, active, reactive):
+        active = active.astype('f8')
+        reactive = reactive.astype('f8')
+        df = pd.DataFrame({'active': active, 'reactive': reactive,
+                           'apparent': np.sqrt(active ** 2 + reactive ** 2)},
+                          index=pd.to_datetime(timestamps, unit='us', utc=True))
+        df = df.resample('1s').mean().dropna()
+        seconds = df.index.values.astype('datetime64[us]').astype('i8')
+        return np.column_stack((seconds, df.to_numpy()))
@@ -0,0 +1,85 @@
+import unittest
+import tempfile
+import asyncio
+import numpy as np
+import joule.api
+import joule.errors
+
+from nilm_synth.file_node import FileNode, get_node
+from nilm_synth.models.segment_cache import SegmentReader
+
+
+class TestFileNode(unittest.TestCase):
+
+    def test_reads_and_writes_streams(self):
+        with tempfile.TemporaryDirectory() as root:
+            node = get_node('file://' + root)
+            self.assertIsInstance(node, FileNode)
+
+            async def run():
+                with self.assertRaises(joule.errors.ApiError):
+                    await node.data_stream_get('/library/load/prep')
+                stream = joule.api.DataStream('prep', datatype='float32',
+                                              elements=[joule.api.Element(f'E{i}', 'W') for i in range(8)])
+                stream = await node.data_stream_create(stream, '/library/load')
+                # intervals may be written out of order
+                for (start, end) in [(100, 200), (0, 100)]:
+                    sdata = np.empty(end - start, dtype=[('timestamp', '<i8'), ('data', '<f4', (8,))])
+                    sdata['timestamp'] = np.arange(start, end)
+                    sdata['data'] = np.arange(start, end)[:, None]
+                    pipe = await node.data_write(stream, start, end)
+                    await pipe.write(sdata)
+                    await pipe.close()
+                with self.assertRaises(joule.errors.ApiError):
+                    await pipe.write(sdata)
+                data = await SegmentReader(node).read('/library/load/prep', 50, 150)
+                await node.close()
+                return data
+
+            data = asyncio.run(run())
+            np.testing.assert_array_equal(data[:, 0], np.arange(50, 150))
+            # streams persist in the directory
+            node = FileNode(root)
+            self.assertEqual(asyncio.run(node.data_stream_get('/library/load/prep')).layout, 'float32_8')
+            asyncio.run(node.folder_delete('/library'))
+            with self.assertRaises(joule.errors.ApiError):
+                asyncio.run(node.folder_get('/library'))
+
+    def test_keeps_interval_breaks(self):
+        with tempfile.TemporaryDirectory() as root:
+            node = FileNode(root)
+
+            async def run():
+                stream = joule.api.DataStream('power', datatype='float32',
+                                              elements=[joule.api.Element(f'E{i}', 'W') for i in range(3)])
+                stream = await node.data_stream_create(stream, '/house')
+                pipe = await node.data_write(stream)
+                # flattened rows in two intervals
+                await pipe.write(np.column_stack([np.arange(0, 10), np.ones((10, 3))]))
+                await pipe.close_interval()
+                await pipe.write(np.column_stack([np.arange(20, 30), np.ones((10, 3))]))
+                await pipe.close()
+                pipe = await node.data_read(stream)
+                reads = []
+                while not pipe.is_empty():
+                    data = await pipe.read(flatten=True)
+                    reads.append((data[:, 0], pipe.end_of_interval))
+                    pipe.consume(len(data))
+                # writing over a range removes the rows there first
+                pipe = await node.data_write(stream, 5, 25)
+                await pipe.write(np.column_stack([np.arange(5, 8), np.zeros((3, 3))]))
+                await pipe.close()
+                pipe = await node.data_read(stream, 0, 100)
+                data = await pipe.read()
+                reads.append((data['timestamp'], pipe.end_of_interval))
+                await node.close()
+                return reads
+
+            reads = asyncio.run(run())
+            np.testing.assert_array_equal(reads[0][0], np.arange(0, 10))
+            self.assertTrue(reads[0][1])
+            np.testing.assert_array_equal(reads[1][0], np.arange(20, 30))
+            self.assertTrue(reads[1][1])
+            # removing rows ends the interval before them
+            np.testing.assert_array_equal(reads[2][0], [0, 1, 2, 3, 4])
+            self.assertTrue(reads[2][1])
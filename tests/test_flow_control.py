@@ -0,0 +1,146 @@
+import unittest
+import asyncio
+from unittest import mock
+
+import numpy as np
+
+import joule.errors
+
+from nilm_synth.flow_control import FlowControl, is_pressure
+from nilm_synth.builders.build_data_stream import OutputPipe
+
+
+class TestFlowControl(unittest.TestCase):
+
+    def setUp(self):
+        # a fake clock that advances when the flow control sleeps
+        self.now = 0.0
+        self.sleeps = []
+
+        async def sleep(seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+        patches = [mock.patch('nilm_synth.flow_control.time.monotonic', lambda: self.now),
+                   mock.patch('nilm_synth.flow_control.asyncio.sleep', sleep)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_token_bucket_refills(self):
+        flow_control = FlowControl(rate=1000)
+
+        async def run():
+            # the bucket starts empty, each transfer waits for its tokens
+            await flow_control.throttle(500)
+            await flow_control.throttle(500)
+            self.assertEqual(self.sleeps, [0.5, 0.5])
+            # idle time refills the bucket up to one second of data
+            self.now += 2
+            await flow_control.throttle(1000)
+            self.assertEqual(self.sleeps, [0.5, 0.5])
+            await flow_control.throttle(100)
+            self.assertEqual(self.sleeps, [0.5, 0.5, 0.1])
+
+        asyncio.run(run())
+        self.assertEqual(flow_control.total_bytes, 2100)
+
+    def test_no_rate_runs_at_full_speed(self):
+        flow_control = FlowControl()
+        asyncio.run(flow_control.throttle(10 * 1024 ** 2))
+        self.assertEqual(self.sleeps, [])
+        self.assertIsNone(flow_control.limit)
+
+    def test_backs_off_under_pressure(self):
+        flow_control = FlowControl(rate=1024 ** 2, backoff=0.5)
+        failures = [ConnectionError("connection reset"), asyncio.TimeoutError()]
+
+        async def request():
+            if failures:
+                raise failures.pop(0)
+            return 'done'
+
+        self.assertEqual(asyncio.run(flow_control.call(request)), 'done')
+        # the delay doubles after each failure and the rate is halved
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+        self.assertEqual(flow_control.retries, 2)
+        self.assertLess(flow_control.limit, 1024 ** 2)
+
+    def test_raises_other_errors(self):
+        flow_control = FlowControl(max_retries=2)
+
+        async def invalid():
+            raise ValueError("invalid request")
+
+        async def busy():
+            raise ConnectionError("connection reset")
+
+        with self.assertRaises(ValueError):
+            asyncio.run(flow_control.call(invalid))
+        self.assertEqual(flow_control.retries, 0)
+        # pressure that does not clear is raised after max_retries
+        with self.assertRaises(ConnectionError):
+            asyncio.run(flow_control.call(busy))
+        self.assertEqual(flow_control.retries, 2)
+
+    def test_detects_pressure_from_status(self):
+        self.assertTrue(is_pressure(joule.errors.ApiError("node is busy [503]")))
+        self.assertTrue(is_pressure(joule.errors.ApiError("API Error [429]: too many requests")))
+        self.assertTrue(is_pressure(asyncio.TimeoutError()))
+        # a status or word elsewhere in the message is not pressure
+        self.assertFalse(is_pressure(joule.errors.ApiError("stream /busy/503 does not exist [404]")))
+        self.assertFalse(is_pressure(joule.errors.ApiError("invalid request")))
+        self.assertFalse(is_pressure(ValueError("503")))
+
+    def test_rewrites_interval_through_new_pipe(self):
+        node = _BusyNode(failures=2)
+        pipe = OutputPipe(node, _Stream(), 0, 100, FlowControl(backoff=0.001))
+        ts = np.arange(30)
+        asyncio.run(pipe.write_interval(ts, np.ones((30, 8)), block_size=10))
+        # the failed pipes are abandoned, their rows removed when the interval is reopened
+        self.assertEqual(pipe.flow_control.retries, 2)
+        self.assertEqual(node.opened, 3)
+        np.testing.assert_array_equal(node.rows, ts)
+        # other errors are not retried
+        node = _BusyNode(failures=1, error=ValueError("bad data"))
+        pipe = OutputPipe(node, _Stream(), 0, 100, FlowControl(backoff=0.001))
+        with self.assertRaises(ValueError):
+            asyncio.run(pipe.write_interval(ts, np.ones((30, 8)), block_size=10))
+        self.assertEqual(node.opened, 1)
+
+
+class _Stream:
+    layout = 'float32_8'
+
+
+class _BusyNode:
+    # output node whose pipes fail [failures] times on their second write
+    def __init__(self, failures: int, error: Exception = ConnectionError("connection reset")):
+        self.failures = failures
+        self.error = error
+        self.rows = np.zeros(0, dtype='i8')
+        self.opened = 0
+
+    async def data_write(self, stream, start, end):
+        # like a joule node, opening a pipe removes the rows in [start, end)
+        self.opened += 1
+        self.rows = self.rows[(self.rows < start) | (self.rows >= end)]
+        return _BusyPipe(self)
+
+
+class _BusyPipe:
+    layout = 'float32_8'
+
+    def __init__(self, node: _BusyNode):
+        self.node = node
+        self.writes = 0
+
+    async def write(self, sdata):
+        self.writes += 1
+        if self.writes == 2 and self.node.failures > 0:
+            self.node.failures -= 1
+            raise self.node.error
+        self.node.rows = np.sort(np.concatenate((self.node.rows, sdata['timestamp'])))
+
+    async def close(self):
+        pass
@@ -0,0 +1,75 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import numpy as np
+
+from nilm_synth.models.library_bundle import LibraryBundle, BundleWriter, export_bundle, ALIGNMENT, DATA_OFFSET
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+from nilm_synth.models.segment_cache import SegmentReader
+from nilm_synth.models.run import Run
+
+
+class TestLibraryBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = [LibraryLoad('/Library/Fridge', 'fridge', 'Fridge', '', '', id=1),
+                      LibraryLoad('/Library/Space Heater', 'heater', 'Space Heater', '', '', id=2)]
+        # the fridge has a steady state, the space heater does not
+        self.exemplars = [LibraryExemplar(0, 1000000, 1000000, 2000000, 2000000, 3000000, load_id=1, id=1),
+                          LibraryExemplar(0, 500000, None, None, 500000, 1500000, load_id=2, id=2)]
+        rng = np.random.default_rng(seed=3)
+        # library segments held in memory, one row per line cycle
+        self.segments = {('/Library/Fridge/prep', 0, 1000000): rng.uniform(0, 100, (60, 8)),
+                         ('/Library/Fridge/prep', 1000000, 2000000): rng.uniform(0, 100, (60, 8)),
+                         ('/Library/Fridge/prep', 2000000, 3000000): rng.uniform(0, 100, (61, 8)),
+                         ('/Library/Space Heater/prep', 0, 500000): rng.uniform(0, 100, (30, 8)),
+                         ('/Library/Space Heater/prep', 500000, 1500000): rng.uniform(0, 100, (60, 8))}
+
+    def test_exports_and_maps_library(self):
+        with tempfile.TemporaryDirectory() as path:
+            bundle_path = os.path.join(path, 'library.bundle')
+            reader = SegmentReader(None)
+            reader.hold(self.segments)
+            num_segments = asyncio.run(export_bundle(bundle_path, self.loads, self.exemplars, reader))
+            self.assertEqual(num_segments, 5)
+            self.assertFalse(os.path.exists(bundle_path + '.tmp'))
+            bundle = LibraryBundle(bundle_path)
+            self.assertEqual(len(bundle), 5)
+            self.assertEqual(bundle.loads, self.loads)
+            self.assertEqual(bundle.exemplars, self.exemplars)
+            for (key, data) in self.segments.items():
+                segment = bundle.segment(*key)
+                # segments are read only float32 views of the file
+                self.assertIsInstance(segment, np.memmap)
+                self.assertFalse(segment.flags.writeable)
+                np.testing.assert_array_equal(segment, data.astype('float32'))
+            with self.assertRaises(ValueError):
+                bundle.segment('/Library/Fridge/prep', 0, 1)
+            # runs are laid out from the bundle
+            catalog = bundle.catalog()
+            load = catalog.instantiate(1, np.random.default_rng(seed=1))
+            run = Run('Fridge', 0, 3000000, load, 2, 2.0, 0, 2)
+            pieces = asyncio.run(run.layout(bundle, 0))
+            self.assertEqual(pieces[-1].end, 60 + 2 * 60 + 61)
+            np.testing.assert_array_equal(pieces[0].data,
+                                          2.0 * self.segments[('/Library/Fridge/prep', 0, 1000000)].astype('float32'))
+            bundle.close()
+
+    def test_aligns_segments(self):
+        with tempfile.TemporaryDirectory() as path:
+            bundle_path = os.path.join(path, 'library.bundle')
+            writer = BundleWriter(bundle_path)
+            writer.add_segment('/a', 0, 1, np.ones((3, 8)))
+            writer.add_segment('/a', 1, 2, np.arange(5, dtype='float32'))
+            writer.close([], [])
+            bundle = LibraryBundle(bundle_path)
+            self.assertEqual(bundle.segment('/a', 1, 2).shape, (5, 1))
+            self.assertEqual(bundle._index[('/a', 1, 2)][0] * 4 % ALIGNMENT, 0)
+            self.assertEqual(len(bundle.catalog()), 0)
+            bundle.close()
+            # a file that is not a bundle is rejected
+            with open(bundle_path, 'wb') as f:
+                f.write(bytes(DATA_OFFSET))
+            with self.assertRaises(ValueError):
+                LibraryBundle(bundle_path)
@@ -0,0 +1,25 @@
+import unittest
+import numpy as np
+
+from nilm_synth.builders.noise import NoiseSource
+from nilm_synth.seeds import SeedStreams, NOISE_BLOCK_ROWS
+
+
+class TestNoiseSource(unittest.TestCase):
+
+    def test_noise_does_not_depend_on_the_split(self):
+        num_rows = 3 * NOISE_BLOCK_ROWS + 1234
+        source = NoiseSource(SeedStreams(7), 4.0, num_rows, 8)
+        expected = source.rows(0, num_rows)
+        source.close()
+        self.assertEqual(expected.shape, (num_rows, 8))
+        self.assertAlmostEqual(float(np.std(expected)), 2.0, places=2)
+        # block b is always drawn from noise stream b
+        np.testing.assert_array_equal(expected[NOISE_BLOCK_ROWS:NOISE_BLOCK_ROWS + 10],
+                                      SeedStreams(7).noise_block(1).normal(scale=2.0, size=(10, 8)))
+        for (split, workers) in [(1000, 1), (10000, 4), (NOISE_BLOCK_ROWS, 2), (50001, 8)]:
+            source = NoiseSource(SeedStreams(7), 4.0, num_rows, 8, workers)
+            noise = np.vstack([source.rows(start, min(start + split, num_rows))
+                               for start in range(0, num_rows, split)])
+            source.close()
+            np.testing.assert_array_equal(noise, expected)
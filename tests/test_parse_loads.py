@@ -1,17 +1,22 @@
 import unittest
 import yaml
+import numpy as np
 from nilm_synth.parsers.parse_loads import parse_loads
-from nilm_synth.models import LibraryLoad
-from numpy import random
-import json
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+from nilm_synth.seeds import SeedStreams
 from joule.utilities import human_to_timestamp
-from dataclasses import asdict
 
 
 class TestParseLoads(unittest.TestCase):
 
     def setUp(self):
-        pass
+        # Space Heater from Load Library Dataset
+        load = LibraryLoad("/Load Library/Residential/Space Heater", "heater",
+                           "Space Heater", "", "", id=2)
+        exemplar = LibraryExemplar(4832000, 18594000, 20260000, 22826000, 41453000, 43452000,
+                                   load_id=2, id=1)
+        self.catalog = ExemplarCatalog([load], [exemplar])
 
     def test_parses_single_random_load(self):
         config = yaml.safe_load("""
@@ -24,23 +29,111 @@ class TestParseLoads(unittest.TestCase):
                 scale_factor: 2.0
                 runs: random 3:20s
           """)
-        # Space Heater from Load Library Dataset
-        load_data = LibraryLoad(2, "/Load Library/Residential/Space Heater",
-                                4832000, 18594000, 20260000, 22826000, 41453000, 43452000)
+        dataset_start_ts = human_to_timestamp("7:00 July 1 2021")
+        dataset_end_ts = human_to_timestamp("7:15 July 1 2021")
+        runs = parse_loads(config['loads'],
+                           dataset_start_ts=dataset_start_ts,
+                           dataset_end_ts=dataset_end_ts,
+                           catalog=self.catalog,
+                           seeds=SeedStreams(1))
+        self.assertEqual(len(runs), 5)
+        self.assertEqual(runs.names, {2: 'Space Heater', 3: 'Big Long Space Heater'})
+        self.assertEqual(list(runs.meter_id), [2, 2, 3, 3, 3])
+        # 20s runs need 2 blocks of steady state
+        np.testing.assert_array_equal(runs.steady_state_blocks, [0, 0, 2, 2, 2])
+        for meter_id in [2, 3]:
+            meter_runs = runs.for_meter(meter_id)
+            order = meter_runs.start_order()
+            # runs of a load do not overlap and stay within the dataset
+            self.assertTrue(np.all(meter_runs.end_ts[order][:-1] <= meter_runs.start_ts[order][1:]))
+            self.assertGreaterEqual(np.min(meter_runs.start_ts), dataset_start_ts)
+            self.assertLessEqual(np.max(meter_runs.end_ts), dataset_end_ts)
+        # the same seed gives the same plan
+        same_runs = parse_loads(config['loads'], dataset_start_ts, dataset_end_ts,
+                                SeedStreams(1), self.catalog)
+        np.testing.assert_array_equal(same_runs.start_ts, runs.start_ts)
+        np.testing.assert_array_equal(same_runs.scale_factor, runs.scale_factor)
+        run = runs.run(4)
+        self.assertEqual(run.name, 'Big Long Space Heater')
+        self.assertEqual(run.instantiated_load.exemplar.on_start, 4832000)
 
-        def stub(load_id: int) -> LibraryLoad:
-            self.assertEqual(load_id, 2)
-            return load_data
+    def test_random_runs_fill_the_dataset(self):
+        # 100 runs of 15.8s (with no flex) fit in 1600s, placement must not fail
+        config = yaml.safe_load("""
+            loads:
+              - load_id: 2
+                flex: none
+                runs: random 100
+          """)
+        runs = parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=1600 * int(1e6),
+                           catalog=self.catalog, seeds=SeedStreams(2))
+        order = runs.start_order()
+        self.assertTrue(np.all(runs.end_ts[order][:-1] <= runs.start_ts[order][1:]))
+        with self.assertRaises(ValueError):
+            parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=1500 * int(1e6),
+                        catalog=self.catalog, seeds=SeedStreams(2))
 
-        rng = random.default_rng(seed=1)
+    def test_durations_use_exemplars_with_a_steady_state(self):
+        load = LibraryLoad("/Library/Heater", "heater", "Heater", "", "", id=3)
+        exemplars = [LibraryExemplar(0, 1000000, None, None, 1000000, 2000000, load_id=3, id=1),
+                     LibraryExemplar(0, 1000000, 1000000, 2000000, 2000000, 3000000, load_id=3, id=2)]
+        catalog = ExemplarCatalog([load], exemplars)
+        config = yaml.safe_load("""
+            loads:
+              - load_id: 3
+                runs: periodic 10s:5s
+              - load_id: 3
+                runs: random 20:5s
+          """)
+        runs = parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=600 * int(1e6),
+                           catalog=catalog, seeds=SeedStreams(4))
+        self.assertGreater(len(runs.for_meter(2)), 10)
+        self.assertTrue(all(runs.run(i).instantiated_load.exemplar.id == 2 for i in range(len(runs))))
+        # without any steady state the duration cannot be reached
+        with self.assertRaises(ValueError):
+            parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=600 * int(1e6),
+                        catalog=ExemplarCatalog([load], exemplars[:1]), seeds=SeedStreams(4))
 
-        runs = parse_loads(config['loads'],
-                           dataset_start_ts=human_to_timestamp("7:00 July 1 2021"),
-                           dataset_end_ts=human_to_timestamp("7:15 July 1 2021"),
-                           get_instantiated_load=stub,
-                           rng=rng)
-        self.assertEqual(len(runs), 5)
-        run_json = [asdict(r) for r in runs]
+    def test_fixed_durations_use_exemplars_with_a_steady_state(self):
+        load = LibraryLoad("/Library/Heater", "heater", "Heater", "", "", id=3)
+        exemplars = [LibraryExemplar(0, 1000000, None, None, 1000000, 2000000, load_id=3, id=1),
+                     LibraryExemplar(0, 1000000, 1000000, 2000000, 2000000, 3000000, load_id=3, id=2)]
+        catalog = ExemplarCatalog([load], exemplars)
+        config = yaml.safe_load("""
+            loads:
+              - load_id: 3
+                flex: none
+                runs: fixed 0s:5s, 10s:6s, 20s:5s, 30s:5s, 40s:5s, 50s:5s, 60s:5s, 70s:5s, 80s
+          """)
+        runs = parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=600 * int(1e6),
+                           catalog=catalog, seeds=SeedStreams(4))
+        self.assertTrue(all(runs.run(i).instantiated_load.exemplar.id == 2 for i in range(8)))
+        self.assertEqual(list(runs.end_ts[:2] - runs.start_ts[:2]), [5 * int(1e6), 6 * int(1e6)])
+        # without any steady state the duration cannot be reached
+        with self.assertRaises(ValueError):
+            parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=600 * int(1e6),
+                        catalog=ExemplarCatalog([load], exemplars[:1]), seeds=SeedStreams(4))
+        # a duration shorter than an exemplar fails whichever exemplars are drawn
+        config['loads'][0]['runs'] = 'fixed 0s:1s'
+        with self.assertRaises(ValueError):
+            parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=600 * int(1e6),
+                        catalog=catalog, seeds=SeedStreams(4))
 
-        with open('test_runs.json', 'w') as f:
-            f.write(json.dumps(run_json, indent=4, sort_keys=True))
+    def test_assigns_loads_to_phases(self):
+        config = yaml.safe_load("""
+            loads:
+              - load_id: 2
+                runs: random 2
+              - load_id: 2
+                phase: C
+                runs: random 2
+          """)
+        runs = parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=1600 * int(1e6),
+                           catalog=self.catalog, seeds=SeedStreams(2), num_phases=3)
+        self.assertEqual(runs.phase(2), 0)
+        self.assertEqual(runs.phase(3), 2)
+        self.assertEqual(runs.for_meter(3).phase(3), 2)
+        # phases B and C only exist in a 3 phase dataset
+        with self.assertRaises(ValueError):
+            parse_loads(config['loads'], dataset_start_ts=0, dataset_end_ts=1600 * int(1e6),
+                        catalog=self.catalog, seeds=SeedStreams(2))
@@ -0,0 +1,28 @@
+import unittest
+import os
+import json
+import tempfile
+
+from nilm_synth.profiler import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+
+    def test_accumulates_stages_and_counters(self):
+        profiler = Profiler()
+        for _ in range(3):
+            with profiler.stage('render', rows=100):
+                pass
+        with profiler.stage('source_read') as stats:
+            stats.rows += 50
+        profiler.count('library_node_bytes', 1000)
+        profiler.count('library_node_bytes', 24)
+        with tempfile.TemporaryDirectory() as path:
+            profiler.write(os.path.join(path, 'profile.json'))
+            with open(os.path.join(path, 'profile.json')) as f:
+                report = json.load(f)
+        self.assertEqual(report['stages']['render']['calls'], 3)
+        self.assertEqual(report['stages']['render']['rows'], 300)
+        self.assertEqual(report['stages']['source_read']['rows'], 50)
+        self.assertEqual(report['counters']['library_node_bytes'], 1024)
+        self.assertGreater(report['peak_rss_bytes'], 0)
@@ -0,0 +1,106 @@
+import unittest
+import numpy as np
+
+from nilm_synth.builders.render_buffer import RenderBuffer
+from nilm_synth.builders.noise import NoiseSource
+from nilm_synth.seeds import SeedStreams
+
+
+class TestRenderBuffer(unittest.TestCase):
+
+    def test_accumulates_across_tiles(self):
+        dataset = _CountingDataset(np.ones((100, 8), dtype='float32'))
+        buffer = RenderBuffer(dataset, tile_rows=30)
+        buffer.add(25, np.ones((10, 8)))
+        buffer.add(28, np.ones((40, 8)))
+        buffer.flush()
+        expected = np.ones((100, 8), dtype='float32')
+        expected[25:35] += 1
+        expected[28:68] += 1
+        np.testing.assert_array_equal(dataset.data, expected)
+        # tiles 0, 1 and 2 are each read and written once
+        self.assertEqual(dataset.reads, 3)
+        self.assertEqual(dataset.writes, 3)
+
+    def test_clips_data_to_dataset_bounds(self):
+        dataset = _CountingDataset(np.zeros((50, 8), dtype='float32'))
+        buffer = RenderBuffer(dataset, tile_rows=None)
+        buffer.add(45, np.ones((10, 8)))
+        buffer.add(-5, np.ones((10, 8)))
+        buffer.flush()
+        self.assertEqual(np.sum(dataset.data[:, 0]), 10)
+        self.assertEqual(dataset.writes, 1)
+
+    def test_replaces_submeter_and_accumulates_aggregate(self):
+        aggregate = _CountingDataset(np.ones((60, 8), dtype='float32'))
+        submeter = _CountingDataset(np.zeros((60, 8), dtype='float32'))
+        # first submeter fills rows in tiles 0 and 2
+        buffer = RenderBuffer(submeter, tile_rows=20, zeroed=True, aggregate=aggregate)
+        buffer.add(5, np.ones((5, 8)))
+        buffer.add(45, np.ones((5, 8)))
+        buffer.flush()
+        stale_tiles = buffer.written_tiles
+        # second submeter only writes tile 0
+        buffer = RenderBuffer(submeter, tile_rows=20, zeroed=True, aggregate=aggregate)
+        buffer.add(0, 2 * np.ones((5, 8)))
+        buffer.flush()
+        buffer.clear_tiles(stale_tiles - buffer.written_tiles)
+        expected_submeter = np.zeros((60, 8), dtype='float32')
+        expected_submeter[0:5] = 2
+        np.testing.assert_array_equal(submeter.data, expected_submeter)
+        self.assertEqual(np.sum(aggregate.data[:, 0]), 60 + 5 + 5 + 10)
+        # zeroed tiles are never read from the submeter dataset
+        self.assertEqual(submeter.reads, 0)
+
+    def test_adds_submeter_to_its_phase_of_the_aggregate(self):
+        aggregate = _CountingDataset(np.zeros((60, 24), dtype='float32'))
+        submeter = _CountingDataset(np.zeros((60, 8), dtype='float32'))
+        buffer = RenderBuffer(submeter, tile_rows=20, zeroed=True, aggregate=aggregate,
+                              aggregate_columns=np.s_[8:16])
+        buffer.add(10, np.ones((20, 8)))
+        buffer.flush()
+        self.assertEqual(np.sum(aggregate.data[:, 8:16]), 20 * 8)
+        self.assertEqual(np.sum(aggregate.data), 20 * 8)
+
+    def test_flushes_completed_tiles(self):
+        dataset = _CountingDataset(np.zeros((100, 8), dtype='float32'))
+        buffer = RenderBuffer(dataset, tile_rows=10)
+        buffer.add(0, np.ones((25, 8)))
+        buffer.flush_before(20)
+        self.assertEqual(dataset.writes, 2)
+        buffer.flush()
+        self.assertEqual(dataset.writes, 3)
+
+    def test_adds_noise_in_the_aggregate_writes(self):
+        aggregate = _CountingDataset(np.zeros((60, 8), dtype='float32'))
+        submeter = _CountingDataset(np.zeros((60, 8), dtype='float32'))
+        noise = NoiseSource(SeedStreams(3), 1.0, 60, 8)
+        # only tile 1 is written by the submeter
+        buffer = RenderBuffer(submeter, tile_rows=20, zeroed=True, aggregate=aggregate,
+                              aggregate_noise=noise)
+        buffer.add(25, np.ones((5, 8)))
+        buffer.flush()
+        expected = noise.rows(0, 60).astype('float32')
+        expected[25:30] += 1
+        noise.close()
+        np.testing.assert_array_equal(aggregate.data, expected)
+        # every tile of the aggregate is written once
+        self.assertEqual(aggregate.writes, 3)
+
+
+class _CountingDataset:
+    # wraps an array and counts slice reads and writes like an h5py dataset
+    def __init__(self, data):
+        self.data = data
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.reads = 0
+        self.writes = 0
+
+    def __getitem__(self, item):
+        self.reads += 1
+        return np.array(self.data[item])
+
+    def __setitem__(self, item, value):
+        self.writes += 1
+        self.data[item] = value
@@ -0,0 +1,26 @@
+import unittest
+import numpy as np
+
+from nilm_synth.seeds import SeedStreams
+
+
+class TestSeedStreams(unittest.TestCase):
+
+    def test_streams_are_reproducible(self):
+        seeds = SeedStreams(42)
+        # streams do not depend on the order they are created in
+        noise = seeds.noise_block(3).random(10)
+        load = seeds.load(2).random(10)
+        other = SeedStreams(42)
+        np.testing.assert_array_equal(other.load(2).random(10), load)
+        np.testing.assert_array_equal(other.noise_block(3).random(10), noise)
+        # and are independent of each other
+        self.assertFalse(np.array_equal(other.load(3).random(10), load))
+        self.assertFalse(np.array_equal(other.worker(2).random(10), load))
+        self.assertFalse(np.array_equal(SeedStreams(43).load(2).random(10), load))
+
+    def test_unseeded_streams_can_be_reproduced(self):
+        seeds = SeedStreams()
+        np.testing.assert_array_equal(SeedStreams(seeds.seed).load(2).random(10),
+                                      seeds.load(2).random(10))
+
@@ -0,0 +1,142 @@
+import unittest
+from unittest import mock
+import tempfile
+import os
+import asyncio
+import numpy as np
+
+from nilm_synth.models.segment_cache import SegmentCache, SegmentReader
+
+
+class TestSegmentCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_stores_and_retrieves_segments(self):
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        data = np.arange(80, dtype='float32').reshape(10, 8)
+        self.assertIsNone(cache.get("/library/heater/prep", 0, 100))
+        cache.put("/library/heater/prep", 0, 100, data)
+        np.testing.assert_array_equal(cache.get("/library/heater/prep", 0, 100), data)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        cache.close()
+        # the index persists across instances
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        np.testing.assert_array_equal(cache.get("/library/heater/prep", 0, 100), data)
+        cache.close()
+
+    def test_evicts_least_recently_used_segments(self):
+        data = np.ones((100, 8), dtype='float32')  # 3200 bytes
+        cache = SegmentCache(self.tmp_dir.name, 2 * data.nbytes)
+        cache.put("/a", 0, 1, data)
+        cache.put("/b", 0, 1, data)
+        cache.get("/a", 0, 1)  # /b is now the oldest
+        cache.put("/c", 0, 1, data)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get("/b", 0, 1))
+        self.assertIsNotNone(cache.get("/a", 0, 1))
+        self.assertIsNotNone(cache.get("/c", 0, 1))
+        self.assertLessEqual(cache.size, cache.max_bytes)
+        cache.close()
+
+    def test_discards_corrupt_segments(self):
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        cache.put("/a", 0, 1, np.zeros((10, 8), dtype='float32'))
+        npy_files = [f for f in os.listdir(self.tmp_dir.name) if f.endswith('.npy')]
+        with open(os.path.join(self.tmp_dir.name, npy_files[0]), 'r+b') as f:
+            f.seek(-4, os.SEEK_END)
+            f.write(b'\xff\xff\xff\xff')
+        self.assertIsNone(cache.get("/a", 0, 1))
+        self.assertEqual(cache.size, 0)
+        cache.close()
+
+    def test_verifies_checksum_once(self):
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        cache.put("/a", 0, 1, np.zeros((10, 8), dtype='float32'))
+        self.assertIsNotNone(cache.get("/a", 0, 1))
+        with mock.patch('zlib.crc32') as crc32:
+            self.assertIsNotNone(cache.get("/a", 0, 1))
+            crc32.assert_not_called()
+        cache.close()
+
+    def test_expands_home_directory(self):
+        with mock.patch.dict(os.environ, {'HOME': self.tmp_dir.name}):
+            cache = SegmentCache('~/cache', 1024 ** 2)
+        self.assertEqual(cache.path, os.path.join(self.tmp_dir.name, 'cache'))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir.name, 'cache', 'index.sqlite')))
+        cache.close()
+
+    def test_read_only_cache_does_not_write(self):
+        data = np.ones((10, 8), dtype='float32')
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        cache.put("/a", 0, 1, data)
+        reader = SegmentCache(self.tmp_dir.name, 1024 ** 2, read_only=True)
+        np.testing.assert_array_equal(reader.get("/a", 0, 1), data)
+        reader.put("/b", 0, 1, data)
+        self.assertIsNone(reader.get("/b", 0, 1))
+        self.assertEqual(len([f for f in os.listdir(self.tmp_dir.name) if f.endswith('.npy')]), 1)
+        reader.close()
+        cache.close()
+
+    def test_reader_only_fetches_misses(self):
+        node = _CountingNode(np.ones((50, 8), dtype='float32'))
+        cache = SegmentCache(self.tmp_dir.name, 1024 ** 2)
+        reader = SegmentReader(node, cache)
+        for _ in range(3):
+            data = asyncio.run(reader.read("/a/prep", 0, 1))
+            self.assertEqual(data.shape, (50, 8))
+        self.assertEqual(node.reads, 1)
+        cache.close()
+
+    def test_prefetch_merges_duplicate_segments(self):
+        node = _CountingNode(np.ones((50, 8), dtype='float32'))
+        reader = SegmentReader(node, max_concurrency=2)
+
+        async def run():
+            segments = [("/a/prep", 0, 1), ("/a/prep", 0, 1), ("/b/prep", 0, 1), ("/c/prep", 0, 1)]
+            await asyncio.gather(reader.prefetch(segments), reader.read("/b/prep", 0, 1))
+            # prefetched segments are served from memory
+            await reader.read("/a/prep", 0, 1)
+
+        asyncio.run(run())
+        self.assertEqual(node.reads, 3)
+        self.assertLessEqual(node.max_active, 2)
+
+
+class _CountingNode:
+    # minimal stand in for the data_read method of a joule node
+    def __init__(self, data):
+        self.data = data
+        self.reads = 0
+        self.active = 0
+        self.max_active = 0
+
+    async def data_read(self, stream, start, end):
+        self.reads += 1
+        self.active += 1
+        self.max_active = max(self.active, self.max_active)
+        return _ArrayPipe(self.data, self)
+
+
+class _ArrayPipe:
+    def __init__(self, data, node):
+        self.node = node
+        self.sdata = np.empty(len(data), dtype=[('timestamp', '<i8'), ('data', '<f4', (8,))])
+        self.sdata['data'] = data
+
+    def is_empty(self):
+        return len(self.sdata) == 0
+
+    async def read(self):
+        return self.sdata
+
+    def consume(self, num_rows):
+        self.sdata = self.sdata[num_rows:]
+
+    async def close(self):
+        self.node.active -= 1
@@ -0,0 +1,145 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import numpy as np
+
+from nilm_synth.builders import (
+    initialize_hdf_data, add_baseline_hd5_data, add_runs_hd5_data,
+    RenderBuffer, NoiseSource, WorkingBuffer,
+    build_sharded_data, add_submeter_datasets, submeter_dataset)
+from nilm_synth.builders.build_sharded_data import plan_shards, BaselineSource
+from nilm_synth.file_node import FileNode
+from nilm_synth.models.catalog import ExemplarCatalog
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+from nilm_synth.models.segment_cache import SegmentReader
+from nilm_synth.parsers.parse_loads import parse_loads
+from nilm_synth.seeds import SeedStreams
+from joule.utilities import human_to_timestamp
+import joule.api
+
+
+class TestShardedData(unittest.TestCase):
+
+    def setUp(self):
+        load = LibraryLoad("/Load Library/Residential/Space Heater", "heater",
+                           "Space Heater", "", "", id=2)
+        exemplar = LibraryExemplar(0, 2000000, 2000000, 3000000, 3000000, 4000000,
+                                   load_id=2, id=1)
+        self.catalog = ExemplarCatalog([load], [exemplar])
+        self.start_ts = human_to_timestamp("7:00 July 1 2021")
+        self.end_ts = human_to_timestamp("7:30 July 1 2021")
+        loads = [{'name': 'Heater A', 'load_id': 2, 'runs': 'random 12:40s'},
+                 {'name': 'Heater B', 'load_id': 2, 'runs': 'random 20:20s', 'phase': 'B'}]
+        self.seeds = SeedStreams(4)
+        self.runs = parse_loads(loads, self.start_ts, self.end_ts, self.seeds, self.catalog, 3)
+
+    def test_plans_shards(self):
+        self.assertEqual(plan_shards(100, 2), [(0, 12), (12, 25), (25, 38), (38, 50),
+                                               (50, 62), (62, 75), (75, 88), (88, 100)])
+        self.assertEqual(plan_shards(3, 4), [(0, 1), (1, 2), (2, 3)])
+
+    def test_matches_serial_build(self):
+        with tempfile.TemporaryDirectory() as path:
+            serial = asyncio.run(self._build_serial(os.path.join(path, 'serial.d')))
+            sharded = asyncio.run(self._build_sharded(os.path.join(path, 'sharded.d')))
+            # runs cross the shard boundaries, the data is the same to the bit
+            np.testing.assert_array_equal(sharded['data'], serial['data'])
+            for meter_id in [2, 3]:
+                np.testing.assert_array_equal(sharded[submeter_dataset(meter_id)],
+                                              serial[submeter_dataset(meter_id)])
+            np.testing.assert_array_equal(sharded['energy'], serial['energy'])
+            self.assertGreater(np.sum(serial['data'][:, 8]), 0)
+
+    def test_fills_baseline_gaps_across_shards(self):
+        # a baseline sample each second with a gap of more than an hour, longer than
+        # a baseline window, that crosses the shard boundaries
+        start_ts = human_to_timestamp("7:00 July 1 2021")
+        end_ts = human_to_timestamp("10:00 July 1 2021")
+        timestamps = np.arange(start_ts, end_ts, int(1e6))
+        timestamps = timestamps[(timestamps < start_ts + 50 * 60e6) | (timestamps >= start_ts + 130 * 60e6)]
+        with tempfile.TemporaryDirectory() as path:
+            asyncio.run(self._create_baseline(os.path.join(path, 'node'), timestamps))
+            for fill in ['hold', 'interpolate']:
+                serial = asyncio.run(self._build_baseline_serial(os.path.join(path, 'serial.d'), path,
+                                                                 start_ts, end_ts, fill))
+                sharded = asyncio.run(self._build_baseline_sharded(os.path.join(path, 'sharded.d'), path,
+                                                                   start_ts, end_ts, fill))
+                np.testing.assert_array_equal(sharded, serial)
+                # the middle of the gap is filled from the samples on either side
+                self.assertTrue(np.all(serial[90 * 3600, :] > 0))
+
+    async def _create_baseline(self, path, timestamps):
+        node = FileNode(path)
+        stream = joule.api.DataStream('house', datatype='float32',
+                                      elements=[joule.api.Element(f'e{i}', 'W') for i in range(8)])
+        await node.data_stream_create(stream, '/base')
+        sdata = np.zeros(len(timestamps), dtype=[('timestamp', '<i8'), ('data', '<f4', (8,))])
+        sdata['timestamp'] = timestamps
+        sdata['data'] = np.arange(1, len(timestamps) + 1)[:, None]
+        node.insert('/base/house', sdata)
+        await node.close()
+
+    async def _build_baseline_serial(self, path, node_path, start_ts, end_ts, fill):
+        node = FileNode(os.path.join(node_path, 'node'))
+        f = WorkingBuffer(path)
+        initialize_hdf_data(f, start_ts, end_ts)
+        await add_baseline_hd5_data(f, '/base/house', node, start_ts, end_ts, fill=fill)
+        await node.close()
+        result = np.array(f['data'])
+        f.close()
+        return result
+
+    async def _build_baseline_sharded(self, path, node_path, start_ts, end_ts, fill):
+        f = WorkingBuffer(path)
+        initialize_hdf_data(f, start_ts, end_ts)
+        runs = self.runs.take(np.zeros(0, dtype=int))
+        baseline = BaselineSource('file://' + os.path.join(node_path, 'node'), '/base/house', fill)
+        await build_sharded_data(f, runs, SegmentReader(None), start_ts, end_ts, self.seeds,
+                                 baseline=baseline, workers=2)
+        result = np.array(f['data'])
+        f.close()
+        return result
+
+    async def _build_serial(self, path):
+        runs = self.runs.take(np.arange(len(self.runs)))
+        f = WorkingBuffer(path)
+        initialize_hdf_data(f, self.start_ts, self.end_ts, num_phases=3)
+        noise = NoiseSource(self.seeds, 2.0, len(f['data']), columns=24)
+        await add_baseline_hd5_data(f, None, None, self.start_ts, self.end_ts, noise=noise)
+        noise.close()
+        result = {}
+        for meter_id in [2, 3]:
+            phase = runs.phase(meter_id)
+            buffer = RenderBuffer(f['submeter'], zeroed=True, aggregate=f['data'],
+                                  aggregate_columns=slice(phase * 8, (phase + 1) * 8))
+            meter_runs = runs.for_meter(meter_id)
+            await add_runs_hd5_data(meter_runs, self.start_ts, self.end_ts, self._reader(), hdf_group=buffer)
+            result[submeter_dataset(meter_id)] = np.array(f['submeter'])
+            buffer.clear_tiles(buffer.written_tiles)
+            runs.energy[runs.meter_id == meter_id] = meter_runs.energy
+        result['data'] = np.array(f['data'])
+        result['energy'] = runs.energy
+        f.close()
+        return result
+
+    async def _build_sharded(self, path):
+        runs = self.runs.take(np.arange(len(self.runs)))
+        f = WorkingBuffer(path)
+        initialize_hdf_data(f, self.start_ts, self.end_ts, num_phases=3)
+        add_submeter_datasets(f, [2, 3])
+        # small windows so runs also cross the windows inside each shard
+        await build_sharded_data(f, runs, self._reader(), self.start_ts, self.end_ts, self.seeds,
+                                 noise=2.0, num_phases=3, workers=2, window_rows=1000)
+        result = {name: np.array(f[name]) for name in ['data', submeter_dataset(2), submeter_dataset(3)]}
+        result['energy'] = runs.energy
+        f.close()
+        return result
+
+    def _reader(self) -> SegmentReader:
+        # library segments held in memory, one row per line cycle
+        reader = SegmentReader(None)
+        rng = np.random.default_rng(seed=9)
+        reader.hold({(stream, start, end): rng.uniform(0, 100, (round((end - start) * 60e-6), 8))
+                     for (stream, start, end) in self.runs.segments()})
+        return reader
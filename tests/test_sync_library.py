@@ -0,0 +1,133 @@
+import unittest
+import asyncio
+import os
+import tempfile
+import numpy as np
+import joule.api
+
+from nilm_synth.file_node import FileNode
+from nilm_synth.models.library_types import LibraryLoad, LibraryExemplar
+from nilm_synth.models.segment_cache import SegmentReader
+from nilm_synth.sync_library import (
+    sync_library, merge_intervals, subtract_intervals, SyncManifest, MANIFEST_FILE)
+
+STREAM = '/Library/Fridge/prep'
+
+
+class TestSyncLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.loads = [LibraryLoad('/Library/Fridge', 'fridge', 'Fridge', '', '', id=1)]
+        self.exemplars = [LibraryExemplar(100, 200, 200, 300, 300, 400, load_id=1, id=1),
+                          LibraryExemplar(1000, 1100, None, None, 1150, 1200, load_id=1, id=2)]
+
+    def test_merges_and_subtracts_intervals(self):
+        self.assertEqual(merge_intervals([(5, 8), (0, 2), (2, 4), (7, 9)]), [(0, 4), (5, 9)])
+        self.assertEqual(subtract_intervals([(0, 10), (20, 30)], [(2, 4), (8, 22)]),
+                         [(0, 2), (4, 8), (22, 30)])
+        self.assertEqual(subtract_intervals([(0, 10)], []), [(0, 10)])
+        self.assertEqual(subtract_intervals([(0, 10)], [(0, 10)]), [])
+
+    def test_syncs_new_intervals(self):
+        with tempfile.TemporaryDirectory() as root:
+            source = FileNode(os.path.join(root, 'library'))
+            mirror = FileNode(os.path.join(root, 'mirror'))
+
+            async def run():
+                stream = joule.api.DataStream('prep', datatype='float32',
+                                              elements=[joule.api.Element(f'E{i}', 'W') for i in range(8)])
+                await source.data_stream_create(stream, '/Library/Fridge')
+                source.insert(STREAM, _rows(0, 2000))
+                stats = await sync_library(self.loads, self.exemplars, source, mirror, max_concurrency=2)
+                # the on, steady state and off segments of exemplar 1 are one interval
+                self.assertEqual((stats.intervals, stats.rows), (3, 300 + 100 + 50))
+                data = await SegmentReader(mirror).read(STREAM, 1150, 1200)
+                np.testing.assert_array_equal(data[:, 0], np.arange(1150, 1200))
+                # nothing changed, nothing is downloaded
+                stats = await sync_library(self.loads, self.exemplars, source, mirror)
+                self.assertEqual(stats.intervals, 0)
+                # the stream grows and a new exemplar overlaps a mirrored interval
+                source.insert(STREAM, _rows(2000, 3000))
+                exemplars = self.exemplars + [LibraryExemplar(350, 2500, None, None, 2500, 2600, load_id=1, id=3)]
+                stats = await sync_library(self.loads, exemplars, source, mirror)
+                self.assertEqual(stats.reset_streams, 0)
+                self.assertEqual(stats.rows, (1000 - 400) + (1150 - 1100) + (2600 - 1200))
+                self.assertEqual(SyncManifest(os.path.join(mirror.root, MANIFEST_FILE)).intervals(STREAM),
+                                 [(100, 2600)])
+                # the library stream is rewritten, the mirror copy is replaced
+                await source.data_delete(STREAM, 0, 150)
+                stats = await sync_library(self.loads, exemplars, source, mirror)
+                self.assertEqual(stats.reset_streams, 1)
+                self.assertEqual(stats.rows, 2600 - 150)
+                data = await SegmentReader(mirror).read(STREAM, 150, 2600)
+                np.testing.assert_array_equal(data[:, 0], np.arange(150, 2600))
+                await source.close()
+                await mirror.close()
+
+            asyncio.run(run())
+
+    def test_records_empty_intervals(self):
+        exemplars = self.exemplars + [LibraryExemplar(3000, 3100, None, None, 3100, 3200, load_id=1, id=3)]
+        with tempfile.TemporaryDirectory() as root:
+            source = FileNode(os.path.join(root, 'library'))
+            mirror = FileNode(os.path.join(root, 'mirror'))
+
+            async def run():
+                stream = joule.api.DataStream('prep', datatype='float32',
+                                              elements=[joule.api.Element(f'E{i}', 'W') for i in range(8)])
+                await source.data_stream_create(stream, '/Library/Fridge')
+                # exemplar 2 is in a gap of the stream, exemplar 3 is after its end
+                source.insert(STREAM, _rows(0, 1000))
+                source.insert(STREAM, _rows(1300, 2000))
+                stats = await sync_library(self.loads, exemplars, source, mirror)
+                self.assertEqual((stats.intervals, stats.skipped), (1, 3))
+                # the gap stays empty, the end of the stream may still grow
+                stats = await sync_library(self.loads, exemplars, source, mirror)
+                self.assertEqual((stats.intervals, stats.skipped), (0, 1))
+                source.insert(STREAM, _rows(3000, 3300))
+                stats = await sync_library(self.loads, exemplars, source, mirror)
+                self.assertEqual((stats.intervals, stats.skipped), (1, 0))
+                await source.close()
+                await mirror.close()
+
+            asyncio.run(run())
+
+    def test_writes_intervals_in_time_order(self):
+        # later intervals are read first, they are still written in time order
+        exemplars = [LibraryExemplar(i * 100, i * 100 + 50, None, None, i * 100 + 50, i * 100 + 60,
+                                     load_id=1, id=i + 1) for i in range(6)]
+        with tempfile.TemporaryDirectory() as root:
+            source = _SlowNode(os.path.join(root, 'library'))
+            mirror = FileNode(os.path.join(root, 'mirror'))
+            written = []
+            insert = mirror.insert
+            mirror.insert = lambda stream, sdata: (written.append(int(sdata['timestamp'][0])),
+                                                   insert(stream, sdata))
+
+            async def run():
+                stream = joule.api.DataStream('prep', datatype='float32',
+                                              elements=[joule.api.Element(f'E{i}', 'W') for i in range(8)])
+                await source.data_stream_create(stream, '/Library/Fridge')
+                source.insert(STREAM, _rows(0, 1000))
+                stats = await sync_library(self.loads, exemplars, source, mirror, max_concurrency=6)
+                self.assertEqual(stats.intervals, 6)
+                await source.close()
+                await mirror.close()
+
+            asyncio.run(run())
+            self.assertEqual(written, sorted(written))
+
+
+class _SlowNode(FileNode):
+    # reads of earlier intervals take longer
+    async def data_read(self, stream, start_ts, end_ts):
+        await asyncio.sleep((1000 - start_ts) / 1e5)
+        return await super().data_read(stream, start_ts, end_ts)
+
+
+def _rows(start: int, end: int) -> np.ndarray:
+    # one row per us with the timestamp as the data
+    sdata = np.empty(end - start, dtype=[('timestamp', '<i8'), ('data', '<f4', (8,))])
+    sdata['timestamp'] = np.arange(start, end)
+    sdata['data'] = np.arange(start, end)[:, None]
+    return sdata
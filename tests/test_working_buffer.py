@@ -0,0 +1,31 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+
+from nilm_synth.builders.working_buffer import WorkingBuffer, zero_rows
+from nilm_synth.builders.render_buffer import RenderBuffer
+
+
+class TestWorkingBuffer(unittest.TestCase):
+
+    def test_renders_into_sparse_files(self):
+        with tempfile.TemporaryDirectory() as path:
+            f = WorkingBuffer(os.path.join(path, 'dataset.raw.d'))
+            f.create_dataset('data', shape=(100000, 8), dtype='f', fillvalue=0, chunks=(10000, 8))
+            f.create_dataset('submeter', shape=(100000, 8), dtype='f', fillvalue=0)
+            self.assertIn('data', f)
+            # nothing is allocated until it is written
+            self.assertEqual(f.disk_usage, 0)
+            buffer = RenderBuffer(f['submeter'], tile_rows=30000, zeroed=True, aggregate=f['data'])
+            buffer.add(5, np.ones((90000, 8)))
+            buffer.flush()
+            self.assertEqual(np.sum(f['data'][:, 0]), 90000)
+            self.assertGreater(f.disk_usage, 0)
+            # rows are zeroed by releasing whole pages and writing the edges
+            zero_rows(f['submeter'], 7, 80003)
+            np.testing.assert_array_equal(f['submeter'][7:80003], 0)
+            np.testing.assert_array_equal(f['submeter'][5:7], 1)
+            np.testing.assert_array_equal(f['submeter'][80003:90005], 1)
+            np.testing.assert_array_equal(f['data'][5:90005], 1)
+            f.close()
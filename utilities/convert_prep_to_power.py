@@ -1,14 +1,19 @@
 import click
 import asyncio
 import numpy as np
-import pandas as pd
 
 import joule.api
 import joule.errors
 from joule.api import BaseNode
+from typing import Optional
 
+from nilm_synth.flow_control import FlowControl
+from nilm_synth.builders.decimate import PowerDecimator
 
-async def main(folder, node: BaseNode, delete: bool):
+
+async def main(folder, node: BaseNode, delete: bool, flow_control: Optional[FlowControl] = None):
+    if flow_control is None:
+        flow_control = FlowControl()
     prep_stream = await node.data_stream_get(folder + '/prep')
 
     try:
@@ -43,55 +48,68 @@ async def main(folder, node: BaseNode, delete: bool):
             joule.api.Element(name='apparent', units='VA'),
         ])
         power_stream = await node.data_stream_create(power_stream, folder)
-    await asyncio.sleep(0.1)
-    prep_pipe = await node.data_read(prep_stream)
-    power_pipe = await node.data_write(power_stream)
+    prep_pipe = await flow_control.call(node.data_read, prep_stream)
+    power_pipe = await flow_control.call(node.data_write, power_stream)
     last_ts = None
     add_zero_sample = True
+    decimator = PowerDecimator()
     try:
         while not prep_pipe.is_empty():
             data = await prep_pipe.read(flatten=True)
-            apparent = np.sqrt(data[:, 1] ** 2 + data[:, 2] ** 2)
+            await flow_control.throttle(data.nbytes)
             prep_pipe.consume(len(data))
-            df = pd.DataFrame(data=np.hstack((data[:, :3], apparent[:, None])))
-            df.set_index(0, inplace=True)
-            df.index = pd.to_datetime(df.index.values, unit='us', utc=True)
-            df = df.resample('1S').mean()
-            resampled_data = df.to_numpy()
-            df.reset_index(inplace=True)
-            resampled_timestamps = np.array([val.timestamp() * 1e6 for val in df['index']])
-            result = np.hstack((resampled_timestamps[:, None], resampled_data))
-            if add_zero_sample:  # first data block
-                # start the data with zeros
-                await power_pipe.write(np.array([[result[0, 0] - 1e6, 0, 0, 0]]))
-                add_zero_sample = False
+            result = decimator.process(data[:, 0], data[:, 1], data[:, 2])
+            if prep_pipe.end_of_interval:
+                # do not average a second across the interval boundary
+                result = np.vstack((result, decimator.flush()))
             if len(result) != 0:
-                if last_ts == result[0, 0]:
-                    result = result[1:, :]  # ignore the first sample since it is a duplicate timestamp
+                add_zero_sample = await _write_power(power_pipe, result, add_zero_sample, flow_control)
                 last_ts = result[-1, 0]
-                await asyncio.sleep(0.1)
-                await power_pipe.write(result)
 
             if prep_pipe.end_of_interval:
-                await power_pipe.write(np.array([[last_ts + 1e6, 0, 0, 0]]))
+                await _write_zero(power_pipe, last_ts + 1e6, flow_control)
                 add_zero_sample = True
+                # paced like the writes, waits for the data before it to fit under the limit
+                await flow_control.pace(0)
                 await power_pipe.close_interval()
             print(".", end="")
     except joule.errors.EmptyPipeError:
         pass
+    # write the last second of data
+    result = decimator.flush()
+    if len(result) != 0:
+        await _write_power(power_pipe, result, add_zero_sample, flow_control)
     await prep_pipe.close()
     await power_pipe.close()
     await node.close()
     print("[DONE]")
 
 
+async def _write_power(power_pipe, result, add_zero_sample: bool, flow_control: FlowControl) -> bool:
+    if add_zero_sample:  # first data block
+        # start the data with zeros
+        await _write_zero(power_pipe, result[0, 0] - 1e6, flow_control)
+    await flow_control.throttle(result.nbytes)
+    await power_pipe.write(result)
+    return False
+
+
+async def _write_zero(power_pipe, ts, flow_control: FlowControl):
+    zero = np.array([[ts, 0, 0, 0]])
+    await flow_control.throttle(zero.nbytes)
+    await power_pipe.write(zero)
+
+
 @click.command()
 @click.argument("folder")
 @click.option("-d", "--delete", is_flag=True, help="delete existing power data")
 @click.option('-n', '--node')
-def run_main(folder, node, delete):
+@click.option('-r', '--rate', type=float, help="maximum transfer rate in MB/s (default unlimited)")
+def run_main(folder, node, delete, rate):
+    if rate is not None:
+        rate = rate * 1024 ** 2
     try:
-        asyncio.run(main(folder, joule.api.get_node(node), delete))
+        asyncio.run(main(folder, joule.api.get_node(node), delete, FlowControl(rate)))
     except ValueError as e:
         raise click.ClickException(str(e))
 